@@ -12,6 +12,7 @@ def doreader():
 	startTime = utime.time()
 	ctr = 0
 	while True:
+		lr.service()	# gives up on a send whose TxDone never came, so receiving carries on
 		if lr.is_packet_available():
 			packet = None
 			try:
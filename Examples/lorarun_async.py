@@ -0,0 +1,32 @@
+import uasyncio
+import utime
+from LightLora import aiolora
+# the lorarun ping-pong as uasyncio tasks, no polling loop
+# do:
+#      import lorarun_async
+#      lorarun_async.run()
+# Ctrl-C to stop.
+async def reader(radio, startTime):
+	ctr = 0
+	async for packet in radio:
+		txt = packet.msg_txt
+		if txt:
+			await radio.send(0xff, 0x41, (txt + str(ctr)).encode(), wait=False)
+			etime = str(int(utime.time() - startTime))
+			print("@" + etime + "r=" + str(txt))
+		ctr = ctr + 1
+
+async def pinger(radio):
+	ctr = 0
+	while True:
+		await uasyncio.sleep(4)
+		await radio.send(0xff, 0x41, ('P Lora' + str(ctr)).encode())
+		ctr = ctr + 1
+
+async def main():
+	radio = aiolora.AsyncLora()
+	uasyncio.create_task(pinger(radio))
+	await reader(radio, utime.time())
+
+def run():
+	uasyncio.run(main())
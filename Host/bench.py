@@ -0,0 +1,302 @@
+"""Benchmarks for SpiControl, SX127x and LoraUtil on the host emulator.
+
+Run from the repository root:
+    python Host/bench.py [--count N] [--size BYTES] [--profile fast|long_range]
+
+SPI figures are counted by the emulated chip. Time is reported twice: the
+emulated time (airtime plus SPI clocking at the configured baudrate) and
+the wall-clock time CPython spent in the driver. Heap figures come from
+tracemalloc; they are CPython numbers, so treat them as a relative measure
+of allocation, not as MicroPython heap usage.
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import hostsim  # noqa: E402
+import utime  # noqa: E402
+import sx127x_sim  # noqa: E402
+from sx127x_sim import SimRadio, VirtualChannel  # noqa: E402
+from LightLora import lorautil, sx127x  # noqa: E402
+
+# second radio pins, the first uses the spicontrol defaults
+PINS_B = {'pin_id_lora_ss': 5, 'pin_id_lora_dio0': 18, 'pin_id_lora_reset': 19}
+PINS_C = {'pin_id_lora_ss': 21, 'pin_id_lora_dio0': 22, 'pin_id_lora_reset': 23}
+
+
+def make_pair(channel=None, **kwargs):
+    "Two linked emulated radios, each driven by its own LoraUtil."
+    sx127x_sim.reset()
+    channel = channel or VirtualChannel()
+    ra = SimRadio(channel, 'a')
+    rb = SimRadio(channel, 'b', cs=5, dio0=18, reset=19)
+    a = lorautil.LoraUtil(**kwargs)
+    b_kwargs = dict(kwargs)
+    b_kwargs.update(PINS_B)
+    b = lorautil.LoraUtil(**b_kwargs)
+    return ra, rb, a, b
+
+
+class Meter:
+    "Counts SPI traffic, emulated time, wall time and peak heap over a block."
+
+    def __init__(self, *radios):
+        self.radios = radios
+
+    def __enter__(self):
+        self.spi = [r.spi_transactions for r in self.radios]
+        self.bytes = [r.spi_bytes for r in self.radios]
+        self.emu_us = hostsim.now_us()
+        tracemalloc.start()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall = time.perf_counter() - self.wall
+        self.heap_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.emu_us = hostsim.now_us() - self.emu_us
+        self.spi = [r.spi_transactions - s for r, s in zip(self.radios, self.spi)]
+        self.bytes = [r.spi_bytes - s for r, s in zip(self.radios, self.bytes)]
+
+
+def report(title, rows):
+    print(title)
+    for name, value in rows:
+        print('  %-36s %s' % (name, value))
+
+
+def bench_registers(count):
+    ra, _, a, _ = make_pair()
+    lora = a.lora
+    with Meter(ra) as m:
+        for _ in range(count):
+            lora.readRegister(sx127x.REG_VERSION)
+    with Meter(ra) as w:
+        for i in range(count):
+            lora.writeRegister(sx127x.REG_SYNC_WORD, i & 0xff)
+    with Meter(ra) as c:
+        for i in range(count):
+            lora.setSpreadingFactor(7 + (i & 1))
+            lora.setSignalBandwidth(125000 if i & 1 else 250000)
+    report('register access', (
+        ('SPI transactions per read', '%.2f' % (m.spi[0] / count)),
+        ('SPI transactions per write', '%.2f' % (w.spi[0] / count)),
+        ('SPI transactions per SF+BW change', '%.2f' % (c.spi[0] / count)),
+        ('wall us per read', '%.1f' % (m.wall * 1e6 / count)),
+    ))
+
+
+def bench_profiles(count):
+    ra, _, a, _ = make_pair()
+    with Meter(ra) as m:
+        for i in range(count):
+            a.lora.applyProfile('fast' if i & 1 else 'long_range')
+    report('profile switch', (
+        ('SPI transactions per switch', '%.2f' % (m.spi[0] / count)),
+        ('emulated us per switch', '%.1f' % (m.emu_us / count)),
+    ))
+
+
+def bench_fifo(count, size):
+    ra, _, a, _ = make_pair()
+    lora = a.lora
+    payload = bytes(range(256))[:size]
+    buf = bytearray(sx127x.MAX_PKT_LENGTH)
+    with Meter(ra) as w:
+        for _ in range(count):
+            lora.beginPacket()
+            lora.write(payload)
+    lora.standby()
+    ra.regs[sx127x.REG_RX_NB_BYTES] = size
+    with Meter(ra) as r:
+        for _ in range(count):
+            lora.read_payload_into(buf)
+    report('FIFO load/unload, %d bytes' % size, (
+        ('SPI transactions per load', '%.2f' % (w.spi[0] / count)),
+        ('SPI transactions per unload', '%.2f' % (r.spi[0] / count)),
+        ('emulated bus us per load', '%.1f' % (w.emu_us / count)),
+        ('emulated bus us per unload', '%.1f' % (r.emu_us / count)),
+    ))
+
+
+def bench_link(count, size, profile):
+    ra, rb, a, b = make_pair(tx_queue_size=count, rx_queue_size=count)
+    a.set_profile(profile)
+    b.set_profile(profile)
+    payload = bytes(size)
+    received = 0
+    with Meter(ra, rb) as m:
+        for _ in range(count):
+            a.send_packet(1, 2, payload)
+        while a.is_transmitting():
+            a.service()
+            utime.sleep_ms(1)
+        utime.sleep_ms(10)
+        received = len(b.read_packets())
+    # heap used by the receive path alone: replay one delivery into b
+    rb.deliver(bytes(4) + payload, -60, 9.0, True)
+    tracemalloc.start()
+    hostsim.run_scheduled()
+    handler_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    tracemalloc.start()
+    b.read_packet()
+    read_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    report('link, %d x %d byte packets, %s' % (count, size, profile), (
+        ('packets received', '%d/%d' % (received, count)),
+        ('SPI transactions per packet, TX side', '%.2f' % (m.spi[0] / count)),
+        ('SPI transactions per packet, RX side', '%.2f' % (m.spi[1] / max(received, 1))),
+        ('SPI bytes per packet, both sides', '%.1f' % ((m.bytes[0] + m.bytes[1]) / count)),
+        ('packets per second, emulated', '%.2f' % (received * 1e6 / m.emu_us)),
+        ('packets per second, wall clock', '%.0f' % (received / m.wall)),
+        ('receive handler peak heap bytes', '%d' % handler_peak),
+        ('read_packet peak heap bytes', '%d' % read_peak),
+    ))
+
+
+def bench_filter(count, size):
+    "Receive cost of frames for another node, with and without an address filter."
+    rows = []
+    for address in (None, 3):
+        sx127x_sim.reset()
+        rb = SimRadio(VirtualChannel(), 'b')
+        b = lorautil.LoraUtil(address=address, rx_queue_size=count)
+        frame = bytes((1, 2, 0, size)) + bytes(size)
+        with Meter(rb) as m:
+            for _ in range(count):
+                rb.deliver(frame, -60, 9.0, True)
+                hostsim.run_scheduled()
+        b.read_packets()
+        label = 'filtered' if address is not None else 'unfiltered'
+        rows.append(('SPI transactions per frame, %s' % label, '%.2f' % (m.spi[0] / count)))
+        rows.append(('SPI bytes per frame, %s' % label, '%.1f' % (m.bytes[0] / count)))
+    report('frames for another node, %d x %d bytes' % (count, size), rows)
+
+
+def bench_lbt(count, size):
+    "Two senders contending for one receiver, with and without listen-before-talk."
+    rows = []
+    for lbt in (False, True):
+        sx127x_sim.reset()
+        channel = VirtualChannel()
+        SimRadio(channel, 'a')
+        SimRadio(channel, 'b', cs=5, dio0=18, reset=19)
+        SimRadio(channel, 'r', cs=21, dio0=22, reset=23)
+        a = lorautil.LoraUtil(lbt=lbt, tx_queue_size=count)
+        b = lorautil.LoraUtil(lbt=lbt, tx_queue_size=count, **PINS_B)
+        r = lorautil.LoraUtil(rx_queue_size=2 * count, **PINS_C)
+        start = hostsim.now_us()
+        for i in range(count):
+            a.send_packet(1, 9, bytes(size))
+            utime.sleep_ms(7)
+            b.send_packet(2, 9, bytes(size))
+        while a.is_transmitting() or b.is_transmitting():
+            a.service()
+            b.service()
+            utime.sleep_ms(1)
+        elapsed = hostsim.now_us() - start
+        utime.sleep_ms(10)
+        received = len(r.read_packets())
+        label = 'lbt' if lbt else 'no lbt'
+        rows.append(('packets received, %s' % label, '%d/%d' % (received, 2 * count)))
+        rows.append(('goodput packets per second, %s' % label, '%.2f' % (received * 1e6 / elapsed)))
+        if lbt:
+            rows.append(('busy channel detections', '%d' % (a.cad_busy + b.cad_busy)))
+    report('two senders, %d x %d byte packets each' % (count, size), rows)
+
+
+def bench_sniff(count, interval_ms=500):
+    "RX sniff: estimated vs emulated radio current on an idle channel, and downlink latency."
+    ra, rb, a, b = make_pair()
+    estimate = b.sniff(interval_ms)
+    a.wake_preamble(interval_ms)
+    rb._account()
+    before = list(rb.mode_us)
+    start = hostsim.now_us()
+    end = utime.ticks_add(utime.ticks_ms(), count * interval_ms)
+    while utime.ticks_diff(end, utime.ticks_ms()) > 0:
+        b.lightsleep()
+    rb._account()
+    elapsed = hostsim.now_us() - start
+    spent = [t - t0 for t, t0 in zip(rb.mode_us, before)]
+    active = spent[sx127x.MODE_RX_CONTINUOUS] + spent[sx127x.MODE_CAD] + spent[6]
+    current = (active * lorautil.SNIFF_RX_UA + spent[sx127x.MODE_STDBY] * 1600
+               + spent[sx127x.MODE_SLEEP] * lorautil.SNIFF_SLEEP_UA) / elapsed
+    latencies = []
+    for i in range(count // 5 + 1):
+        utime.sleep_ms(interval_ms * i // (count // 5 + 1))     # spread over the cycle
+        sent = hostsim.now_us()
+        a.send_packet(1, 2, b'wake up')
+        while not b.is_packet_available():
+            a.service()
+            b.lightsleep(10)
+        latencies.append(hostsim.now_us() - sent)
+        b.read_packets()
+    report('RX sniff every %d ms, %s' % (interval_ms, b.lora.profile.name if b.lora.profile else 'defaults'), (
+        ('estimated radio current uA', '%d' % estimate['current_ua']),
+        ('emulated idle radio current uA', '%.0f' % current),
+        ('continuous receive current uA', '%d' % estimate['continuous_ua']),
+        ('estimated worst latency ms', '%d' % estimate['latency_ms']),
+        ('emulated latency ms, mean / max', '%.0f / %.0f' % (
+            sum(latencies) / len(latencies) / 1000, max(latencies) / 1000)),
+    ))
+
+
+def bench_turnaround(size):
+    "SPI work between a packet arriving and the reply going on air, with and without split_fifo."
+    rows = []
+    for split in (False, True):
+        ra, rb, a, b = make_pair(split_fifo=split)
+        marks = []
+        deliver, start_tx = rb.deliver, rb._start_tx
+
+        def mark_rx(*args):
+            marks.append((rb.spi_transactions, rb.spi_bytes))
+            deliver(*args)
+
+        def mark_tx():
+            marks.append((rb.spi_transactions, rb.spi_bytes))
+            start_tx()
+        rb.deliver, rb._start_tx = mark_rx, mark_tx
+        reply = bytes(size)
+        if split:
+            b.stage_reply(2, 1, reply)
+            b.rx_notify = b.send_staged
+        else:
+            b.rx_notify = lambda: b.send_packet(2, 1, reply)
+        a.send_packet(1, 2, b'ping')
+        a.flush()
+        utime.sleep_ms(100)
+        (t0, b0), (t1, b1) = marks[:2]
+        label = 'split fifo, staged' if split else 'shared fifo'
+        rows.append(('SPI transactions, %s' % label, '%d' % (t1 - t0)))
+        rows.append(('SPI bytes, %s' % label, '%d' % (b1 - b0)))
+    report('receive to reply, %d byte reply' % size, rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--count', type=int, default=50)
+    parser.add_argument('--size', type=int, default=64)
+    parser.add_argument('--profile', default='fast', choices=sorted(sx127x.PROFILES))
+    args = parser.parse_args()
+    bench_registers(args.count * 10)
+    bench_profiles(args.count)
+    bench_fifo(args.count, args.size)
+    bench_link(args.count, args.size, args.profile)
+    bench_filter(args.count, args.size)
+    bench_lbt(args.count, args.size)
+    bench_sniff(args.count)
+    bench_turnaround(min(args.size, 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""Discrete-event kernel shared by the host emulation modules.
+
+Time is virtual: it only moves when the code under test sleeps or when SPI
+traffic is clocked out, so airtime and bus time are modelled without making
+benchmarks wait on the wall clock.
+"""
+
+import heapq
+
+_now_us = 0
+_events = []
+_seq = 0
+_scheduled = []
+_irq_disabled = 0
+_pending_irqs = []
+_in_scheduled = False
+_debt_us = 0
+
+
+def now_us():
+    return _now_us
+
+
+def call_at(when_us, fn, *args):
+    "Queue fn(*args) to run when virtual time reaches when_us."
+    global _seq
+    _seq += 1
+    heapq.heappush(_events, (when_us, _seq, fn, args))
+
+
+def call_later(delay_us, fn, *args):
+    call_at(_now_us + int(delay_us), fn, *args)
+
+
+def advance(delta_us):
+    "Move virtual time forward, firing every event that falls due."
+    global _now_us
+    target = _now_us + int(delta_us)
+    while _events and _events[0][0] <= target:
+        when, _, fn, args = heapq.heappop(_events)
+        if when > _now_us:
+            _now_us = when
+        fn(*args)
+    _now_us = target
+
+
+def spend(delta_us):
+    "Account bus time now; it is settled at the next chip-select release or sleep."
+    global _debt_us
+    _debt_us += delta_us
+
+
+def settle():
+    global _debt_us
+    if _debt_us:
+        delta = _debt_us
+        _debt_us = 0
+        advance(delta)
+
+
+def next_event_us():
+    return _events[0][0] if _events else None
+
+
+def raise_irq(handler, arg):
+    "Run a hard interrupt handler, unless interrupts are masked."
+    if _irq_disabled:
+        _pending_irqs.append((handler, arg))
+    else:
+        handler(arg)
+
+
+def disable_irq():
+    global _irq_disabled
+    _irq_disabled += 1
+    return _irq_disabled - 1
+
+
+def enable_irq(state=0):
+    global _irq_disabled
+    _irq_disabled = state
+    if not _irq_disabled:
+        while _pending_irqs:
+            handler, arg = _pending_irqs.pop(0)
+            handler(arg)
+
+
+def schedule(fn, arg):
+    if len(_scheduled) >= 16:
+        raise RuntimeError('schedule queue full')
+    _scheduled.append((fn, arg))
+
+
+def run_scheduled():
+    "Run queued soft callbacks, as MicroPython does between bytecodes."
+    global _in_scheduled
+    if _in_scheduled:
+        return
+    _in_scheduled = True
+    try:
+        # one pass: a callback that schedules itself again runs on the next call
+        for _ in range(len(_scheduled)):
+            fn, arg = _scheduled.pop(0)
+            fn(arg)
+    finally:
+        _in_scheduled = False
+
+
+def reset():
+    "Forget all time, events and callbacks (between benchmark runs)."
+    global _now_us, _seq, _irq_disabled, _debt_us
+    _now_us = 0
+    _debt_us = 0
+    _seq = 0
+    _irq_disabled = 0
+    del _events[:]
+    del _scheduled[:]
+    del _pending_irqs[:]
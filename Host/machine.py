@@ -0,0 +1,161 @@
+"""Host stand-in for the parts of MicroPython's machine module LightLora uses.
+
+Pins are shared by id, so the emulated radios in sx127x_sim see the same
+chip-select, reset and DIO0 lines the driver drives.
+"""
+
+import hostsim
+
+
+class _PinState:
+    def __init__(self, pin_id):
+        self.pin_id = pin_id
+        self.level = 0
+        self.handler = None
+        self.trigger = 0
+        self.listeners = []
+
+
+_pins = {}
+
+
+def _state(pin_id):
+    st = _pins.get(pin_id)
+    if st is None:
+        st = _pins[pin_id] = _PinState(pin_id)
+    return st
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    IRQ_FALLING = 1
+    IRQ_RISING = 2
+
+    def __init__(self, pin_id, mode=-1, *args, **kwargs):
+        self._st = _state(pin_id)
+        if kwargs.get('value') is not None:
+            self.drive(kwargs['value'])
+
+    def value(self, level=None):
+        st = self._st
+        if level is None:
+            return st.level
+        self.drive(level)
+
+    def __call__(self, level=None):
+        return self.value(level)
+
+    def drive(self, level):
+        "Set the line level and notify listeners/handlers of edges."
+        st = self._st
+        level = 1 if level else 0
+        prior = st.level
+        st.level = level
+        if prior == level:
+            return
+        for fn in st.listeners:
+            fn(level)
+        if level:
+            hostsim.settle()
+        if st.handler:
+            if (level and st.trigger & Pin.IRQ_RISING) or \
+               (not level and st.trigger & Pin.IRQ_FALLING):
+                hostsim.raise_irq(st.handler, self)
+
+    def irq(self, handler=None, trigger=0, hard=False):
+        self._st.handler = handler
+        self._st.trigger = trigger
+
+    def listen(self, fn):
+        self._st.listeners.append(fn)
+
+
+class SPI:
+    MSB = 0
+    LSB = 1
+    _buses = {}
+
+    def __init__(self, spi_id, baudrate=1000000, **kwargs):
+        self.spi_id = spi_id
+        self.baudrate = baudrate
+        self.devices = SPI._buses.setdefault(spi_id, [])
+
+    def _device(self):
+        for cs, dev in self.devices:
+            if cs.value() == 0:
+                return dev
+        return None
+
+    def _clock(self, nbytes):
+        hostsim.spend(2 + (nbytes * 8 * 1000000) // self.baudrate)
+
+    def write(self, buf):
+        dev = self._device()
+        if dev:
+            for b in buf:
+                dev.spi_byte(b)
+        self._clock(len(buf))
+        hostsim.run_scheduled()
+
+    def readinto(self, buf, write=0x00):
+        dev = self._device()
+        for i in range(len(buf)):
+            buf[i] = dev.spi_byte(write) if dev else 0
+        self._clock(len(buf))
+        hostsim.run_scheduled()
+
+    def read(self, nbytes, write=0x00):
+        buf = bytearray(nbytes)
+        self.readinto(buf, write)
+        return bytes(buf)
+
+    def write_readinto(self, wbuf, rbuf):
+        dev = self._device()
+        for i in range(len(wbuf)):
+            b = wbuf[i]
+            rbuf[i] = dev.spi_byte(b) if dev else 0
+        self._clock(len(wbuf))
+        hostsim.run_scheduled()
+
+    @classmethod
+    def attach(cls, spi_id, cs_pin_id, device):
+        "Connect an emulated device to bus spi_id behind chip-select cs_pin_id."
+        cls._buses.setdefault(spi_id, []).append((Pin(cs_pin_id), device))
+
+
+def disable_irq():
+    return hostsim.disable_irq()
+
+
+def enable_irq(state=0):
+    hostsim.enable_irq(state)
+
+
+def lightsleep(ms=None):
+    "Sleep for ms, or until the next emulated event; an interrupt wakes it early."
+    hostsim.settle()
+    if ms is None:
+        nxt = hostsim.next_event_us()
+        ms = 0 if nxt is None else max(0, (nxt - hostsim.now_us() + 999) // 1000)
+    target = hostsim.now_us() + ms * 1000
+    while hostsim.now_us() < target and not hostsim._scheduled:
+        nxt = hostsim.next_event_us()
+        if nxt is None or nxt > target:
+            hostsim.advance(target - hostsim.now_us())
+        else:
+            hostsim.advance(max(nxt - hostsim.now_us(), 0))
+    hostsim.run_scheduled()
+
+
+def idle():
+    pass
+
+
+class RTC:
+    _memory = b''
+
+    def memory(self, data=None):
+        if data is None:
+            return RTC._memory
+        RTC._memory = bytes(data)
@@ -0,0 +1,15 @@
+"Host stand-in for the micropython module."
+
+import hostsim
+
+
+def const(value):
+    return value
+
+
+def schedule(fn, arg):
+    hostsim.schedule(fn, arg)
+
+
+def alloc_emergency_exception_buf(size):
+    pass
@@ -0,0 +1,340 @@
+"""Register-level model of a Semtech SX127x in LoRa mode.
+
+SimRadio answers SPI traffic the way the chip does (address byte with the
+write bit, auto-incrementing bursts, FIFO access through RegFifoAddrPtr),
+raises DIO0 according to RegDioMapping1 and holds TX for the real time on
+air. VirtualChannel connects several SimRadios with configurable loss and
+RSSI so two LoraUtil instances can talk to each other on the host.
+"""
+
+import random
+
+import hostsim
+import machine
+from machine import Pin, SPI
+
+REG_FIFO = 0x00
+REG_OP_MODE = 0x01
+REG_FRF_MSB = 0x06
+REG_FIFO_ADDR_PTR = 0x0d
+REG_FIFO_TX_BASE_ADDR = 0x0e
+REG_FIFO_RX_BASE_ADDR = 0x0f
+REG_FIFO_RX_CURRENT_ADDR = 0x10
+REG_IRQ_FLAGS_MASK = 0x11
+REG_IRQ_FLAGS = 0x12
+REG_RX_NB_BYTES = 0x13
+REG_PKT_SNR_VALUE = 0x19
+REG_PKT_RSSI_VALUE = 0x1a
+REG_MODEM_CONFIG_1 = 0x1d
+REG_MODEM_CONFIG_2 = 0x1e
+REG_PREAMBLE_MSB = 0x20
+REG_PREAMBLE_LSB = 0x21
+REG_PAYLOAD_LENGTH = 0x22
+REG_FIFO_RX_BYTE_ADDR = 0x25
+REG_MODEM_CONFIG_3 = 0x26
+REG_SYNC_WORD = 0x39
+REG_DIO_MAPPING_1 = 0x40
+REG_VERSION = 0x42
+
+MODE_SLEEP = 0x00
+MODE_STDBY = 0x01
+MODE_TX = 0x03
+MODE_RX_CONTINUOUS = 0x05
+MODE_RX_SINGLE = 0x06
+MODE_CAD = 0x07
+
+IRQ_CAD_DETECTED = 0x01
+IRQ_CAD_DONE = 0x04
+IRQ_TX_DONE = 0x08
+IRQ_CRC_ERROR = 0x20
+IRQ_RX_DONE = 0x40
+IRQ_RX_TIMEOUT = 0x80
+
+BANDWIDTHS = (7800, 10400, 15600, 20800, 31250, 41700, 62500, 125000, 250000, 500000)
+
+# LoRa-mode register values after a reset pulse
+RESET_VALUES = {
+    0x01: 0x09, 0x06: 0x6c, 0x07: 0x80, 0x08: 0x00, 0x09: 0x4f, 0x0a: 0x09,
+    0x0b: 0x2b, 0x0c: 0x20, 0x0e: 0x80, 0x0f: 0x00, 0x1d: 0x72, 0x1e: 0x70,
+    0x1f: 0x64, 0x20: 0x00, 0x21: 0x08, 0x22: 0x01, 0x23: 0xff, 0x26: 0x00,
+    0x31: 0xc3, 0x37: 0x0a, 0x39: 0x12, 0x42: 0x12,
+}
+
+READ_ONLY = (0x10, 0x13, 0x14, 0x15, 0x16, 0x17, 0x18, 0x19, 0x1a, 0x1b,
+             0x1c, 0x25, 0x42)
+
+
+def airtime_us(sf, bw, cr, preamble, length, implicit, crc, ldro):
+    "Semtech AN1200.13 time-on-air for one LoRa frame."
+    tsym = ((1 << sf) * 1000000) / bw
+    de = 1 if ldro else 0
+    num = 8 * length - 4 * sf + 28 + (16 if crc else 0) - (20 if implicit else 0)
+    den = 4 * (sf - 2 * de)
+    nsym = 8 + max(-(-num // den) * (cr + 4), 0)
+    return int((preamble + 4.25) * tsym + nsym * tsym)
+
+
+def reset():
+    "Start a fresh emulation: no time, events, pins, buses or radios."
+    hostsim.reset()
+    machine._pins.clear()
+    SPI._buses.clear()
+
+
+class SimRadio:
+    "One emulated chip, wired to pins and an SPI bus through machine."
+
+    def __init__(self, channel, name, spi_id=1, cs=14, dio0=15, reset=27,
+                 rssi=-60, snr=9.0):
+        self.channel = channel
+        self.name = name
+        self.rssi = rssi
+        self.snr = snr
+        self.regs = bytearray(128)
+        self.fifo = bytearray(256)
+        self.spi_transactions = 0
+        self.spi_bytes = 0
+        self.tx_count = 0
+        self.rx_count = 0
+        self._addr = None
+        self._tx_end = 0
+        self._cad_end = 0   # a CAD restarted before then is still running
+        self._rx_write = 0
+        self.mode_us = [0] * 8      # emulated time spent in each operating mode
+        self._mode_since = hostsim.now_us()
+        self._dio0 = Pin(dio0, Pin.IN)
+        self._cs = Pin(cs, Pin.OUT)
+        self._cs.listen(self._on_cs)
+        Pin(reset, Pin.OUT).listen(self._on_reset)
+        SPI.attach(spi_id, cs, self)
+        self.reset()
+        channel.radios.append(self)
+
+    # -- pins and SPI ---------------------------------------------------
+    def reset(self):
+        self._account()
+        self.regs[:] = bytes(128)
+        for reg, val in RESET_VALUES.items():
+            self.regs[reg] = val
+        self.fifo[:] = bytes(256)
+        self._update_dio0()
+
+    def _on_reset(self, level):
+        if level == 0:
+            self.reset()
+
+    def _on_cs(self, level):
+        if level == 0:
+            self._addr = None
+            self.spi_transactions += 1
+
+    def spi_byte(self, b):
+        self.spi_bytes += 1
+        if self._addr is None:
+            self._write = bool(b & 0x80)
+            self._addr = b & 0x7f
+            return 0
+        addr = self._addr
+        if addr == REG_FIFO:
+            ptr = self.regs[REG_FIFO_ADDR_PTR]
+            if self._write:
+                self.fifo[ptr] = b
+                ret = 0
+            else:
+                ret = self.fifo[ptr]
+            self.regs[REG_FIFO_ADDR_PTR] = (ptr + 1) & 0xff
+            return ret
+        ret = self.regs[addr]
+        if self._write:
+            self._write_reg(addr, b)
+        self._addr = (addr + 1) & 0x7f
+        return ret
+
+    def _write_reg(self, addr, value):
+        if addr in READ_ONLY:
+            return
+        if addr == REG_IRQ_FLAGS:
+            self.regs[addr] &= ~value & 0xff
+            self._update_dio0()
+            return
+        if addr == REG_OP_MODE:
+            self._set_mode(value)
+            return
+        self.regs[addr] = value
+        if addr == REG_DIO_MAPPING_1 or addr == REG_IRQ_FLAGS_MASK:
+            self._update_dio0()
+
+    def _update_dio0(self):
+        mapping = self.regs[REG_DIO_MAPPING_1] >> 6
+        mask = (IRQ_RX_DONE, IRQ_TX_DONE, IRQ_CAD_DONE, 0)[mapping]
+        flags = self.regs[REG_IRQ_FLAGS] & ~self.regs[REG_IRQ_FLAGS_MASK]
+        self._dio0.drive(flags & mask)
+
+    def _set_irq(self, mask):
+        self.regs[REG_IRQ_FLAGS] |= mask
+        self._update_dio0()
+
+    # -- modem state ----------------------------------------------------
+    @property
+    def mode(self):
+        return self.regs[REG_OP_MODE] & 0x07
+
+    def _account(self):
+        "Charge the time since the last mode change to the current mode."
+        now = hostsim.now_us()
+        self.mode_us[self.regs[REG_OP_MODE] & 0x07] += now - self._mode_since
+        self._mode_since = now
+
+    def _standby(self):
+        self._account()
+        self.regs[REG_OP_MODE] = (self.regs[REG_OP_MODE] & 0xf8) | MODE_STDBY
+
+    def _set_mode(self, value):
+        prior = self.mode
+        self._account()
+        self.regs[REG_OP_MODE] = (value & 0x87) | 0x00
+        mode = value & 0x07
+        if mode == MODE_SLEEP:
+            self.fifo[:] = bytes(256)
+        if mode == MODE_TX and prior != MODE_TX:
+            self._start_tx()
+        elif mode in (MODE_RX_CONTINUOUS, MODE_RX_SINGLE) and \
+                prior not in (MODE_RX_CONTINUOUS, MODE_RX_SINGLE):
+            self._rx_write = self.regs[REG_FIFO_RX_BASE_ADDR]
+            self.channel.join(self)
+        elif mode == MODE_CAD and prior != MODE_CAD:
+            self._cad_end = hostsim.now_us() + self.cad_us()
+            hostsim.call_later(self.cad_us(), self._cad_done)
+
+    def config(self):
+        "Decode (frequency, sf, bw, cr, preamble, implicit, crc, ldro, sync)."
+        r = self.regs
+        frf = (r[0x06] << 16) | (r[0x07] << 8) | r[0x08]
+        mc1 = r[REG_MODEM_CONFIG_1]
+        mc2 = r[REG_MODEM_CONFIG_2]
+        bw = BANDWIDTHS[min(mc1 >> 4, 9)]
+        return (int(frf * 61.03515625), mc2 >> 4, bw, (mc1 >> 1) & 0x07,
+                (r[REG_PREAMBLE_MSB] << 8) | r[REG_PREAMBLE_LSB], mc1 & 0x01,
+                (mc2 >> 2) & 0x01, (r[REG_MODEM_CONFIG_3] >> 3) & 0x01,
+                r[REG_SYNC_WORD])
+
+    def channel_key(self):
+        freq, sf, bw, _, _, _, _, _, sync = self.config()
+        return (freq // 1000, sf, bw, sync)
+
+    def symbol_us(self):
+        _, sf, bw = self.config()[:3]
+        return ((1 << sf) * 1000000) // bw
+
+    def cad_us(self):
+        return 2 * self.symbol_us() + 300
+
+    def airtime_us(self, length):
+        _, sf, bw, cr, pre, ih, crc, ldro, _ = self.config()
+        return airtime_us(sf, bw, cr, pre, length, ih, crc, ldro)
+
+    def _start_tx(self):
+        length = self.regs[REG_PAYLOAD_LENGTH]
+        base = self.regs[REG_FIFO_TX_BASE_ADDR]
+        data = bytes(self.fifo[(base + i) & 0xff] for i in range(length))
+        duration = self.airtime_us(length)
+        self._tx_end = hostsim.now_us() + duration
+        self.tx_count += 1
+        self.channel.transmit(self, data, duration)
+        hostsim.call_later(duration, self._tx_done)
+
+    def _tx_done(self):
+        if self.mode == MODE_TX:
+            self._standby()
+            self._set_irq(IRQ_TX_DONE)
+
+    def _cad_done(self):
+        # a CAD left and entered again starts over, the earlier one never finishes
+        if self.mode != MODE_CAD or hostsim.now_us() < self._cad_end:
+            return
+        self._standby()
+        busy = self.channel.busy(self)
+        self._set_irq(IRQ_CAD_DONE | (IRQ_CAD_DETECTED if busy else 0))
+
+    def listening(self):
+        return self.mode in (MODE_RX_CONTINUOUS, MODE_RX_SINGLE)
+
+    def deliver(self, data, rssi, snr, crc_ok):
+        "A frame finished arriving from the channel."
+        r = self.regs
+        if r[REG_MODEM_CONFIG_1] & 0x01:
+            data = (data + bytes(256))[:r[REG_PAYLOAD_LENGTH]]
+        start = self._rx_write
+        for i, b in enumerate(data):
+            self.fifo[(start + i) & 0xff] = b
+        self._rx_write = (start + len(data)) & 0xff
+        r[REG_FIFO_RX_CURRENT_ADDR] = start
+        r[REG_FIFO_RX_BYTE_ADDR] = self._rx_write
+        r[REG_RX_NB_BYTES] = len(data)
+        r[REG_PKT_RSSI_VALUE] = max(0, min(255, rssi + (164 if self.config()[0] < 868000000 else 157)))
+        r[REG_PKT_SNR_VALUE] = int(snr * 4) & 0xff
+        self.rx_count += 1
+        if self.mode == MODE_RX_SINGLE:
+            self._standby()
+        self._set_irq(IRQ_RX_DONE | (0 if crc_ok else IRQ_CRC_ERROR))
+
+
+class VirtualChannel:
+    "Air between SimRadios: frames reach radios listening with matching settings."
+
+    def __init__(self, loss=0.0, crc_error=0.0, seed=1):
+        self.radios = []
+        self.loss = loss
+        self.crc_error = crc_error
+        self.rng = random.Random(seed)
+        self.links = {}
+        self.on_air = []
+
+    def link(self, a, b, rssi=None, snr=None, loss=None):
+        "Override RSSI/SNR/loss for frames from a to b (SimRadio or name)."
+        self.links[(getattr(a, 'name', a), getattr(b, 'name', b))] = (rssi, snr, loss)
+
+    def busy(self, radio):
+        key = radio.channel_key()
+        now = hostsim.now_us()
+        return any(tx.channel_key() == key and start <= now < end and tx is not radio
+                   for tx, start, end, _, _ in self.on_air)
+
+    def join(self, radio):
+        "A radio started listening: it can still lock onto frames whose preamble is running."
+        now = hostsim.now_us()
+        key = radio.channel_key()
+        ih = radio.regs[REG_MODEM_CONFIG_1] & 0x01
+        for tx, start, end, hearers, lock_by in self.on_air:
+            if start <= now <= lock_by and tx is not radio and radio not in hearers \
+                    and tx.channel_key() == key \
+                    and (tx.regs[REG_MODEM_CONFIG_1] & 0x01) == ih:
+                hearers.append(radio)
+
+    def transmit(self, radio, data, duration):
+        now = hostsim.now_us()
+        key = radio.channel_key()
+        ih = radio.regs[REG_MODEM_CONFIG_1] & 0x01
+        hearers = [r for r in self.radios if r is not radio and r.listening()
+                   and r.channel_key() == key
+                   and (r.regs[REG_MODEM_CONFIG_1] & 0x01) == ih]
+        # a receiver needs a few preamble symbols to lock on
+        lock_by = now + max(0, radio.config()[4] - 4) * radio.symbol_us()
+        entry = (radio, now, now + duration, hearers, lock_by)
+        self.on_air = [t for t in self.on_air if t[2] > now]
+        self.on_air.append(entry)
+        hostsim.call_later(duration, self._arrive, entry, data)
+
+    def _arrive(self, entry, data):
+        radio, start, end, hearers, _ = entry
+        for rx in hearers:
+            rssi, snr, loss = self.links.get((radio.name, rx.name), (None, None, None))
+            rssi = radio.rssi if rssi is None else rssi
+            snr = radio.snr if snr is None else snr
+            loss = self.loss if loss is None else loss
+            collided = any(t is not entry and t[0] is not rx and t[1] < end and t[2] > start
+                           and rx in t[3] for t in self.on_air)
+            if collided or not rx.listening() or self.rng.random() < loss:
+                continue
+            crc_ok = self.rng.random() >= self.crc_error
+            rx.deliver(data, rssi, snr, crc_ok)
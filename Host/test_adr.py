@@ -0,0 +1,74 @@
+"""Link table and adaptive data rate on emulated radios.
+
+Run from the repository root with pytest, or directly:
+    python Host/test_adr.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utime  # noqa: E402
+from bench import make_pair  # noqa: E402
+from sx127x_sim import VirtualChannel  # noqa: E402
+from LightLora import adr  # noqa: E402
+
+
+def _heard(rssi, snr, **kwargs):
+    "b with an AdrPolicy, after hearing six packets from a at rssi and snr."
+    channel = VirtualChannel()
+    ra, rb, a, b = make_pair(channel)
+    channel.link(ra, rb, rssi=rssi, snr=snr)
+    policy = adr.AdrPolicy(b, **kwargs)
+    for i in range(6):
+        a.send_packet(0x01, 0x02, b'hello %d' % i)
+        utime.sleep_ms(100)
+    b.read_packets()
+    return rb, b, policy
+
+
+def test_link_table_averages_and_loss():
+    table = adr.LinkTable(size=2)
+    table.observe(0x01, 10, -80, 20)
+    table.observe(0x01, 11, -80, 20)
+    rssi, snr, loss, count = table.link(0x01)
+    assert (rssi, snr, loss, count) == (-80, 5, 0, 2)
+    table.observe(0x01, 14, -80, 20)     # two lost
+    assert table.link(0x01)[2] > 0.2
+    table.observe(0x02, 0, -90, 0)
+    table.observe(0x03, 0, -90, 0)      # the least recently heard makes room
+    assert table.peers() == [0x03, 0x02]
+
+
+def test_power_only_by_default():
+    _, b, policy = _heard(-80, 9.0)
+    assert policy.sf_range == (7, 7)
+    assert policy.table.link(0x01)[3] == 6
+    sf, power = policy.choose(0x01)
+    assert sf == 7 and power < b.lora.parameters['tx_power_level']
+
+
+def test_wider_sf_range_sets_ldro_and_restores():
+    rb, b, policy = _heard(-135, -20.0, sf_range=(7, 12))
+    before = rb.config()
+    sf, power = policy.choose(0x01)
+    assert sf >= 11     # symbols over 16ms at 125kHz
+    policy.tx_configure(0x01)
+    p = b.lora.parameters
+    assert p['spreading_factor'] == sf and p['low_data_rate_optimize']
+    handle = b.send_packet(0x02, 0x01, b'far away')
+    for _ in range(300):
+        utime.sleep_ms(10)
+        if handle.done:
+            break
+    assert handle.done
+    assert rb.config() == before and b.lora.verifyRegisters()
+
+
+if __name__ == '__main__':
+    test_link_table_averages_and_loss()
+    test_power_only_by_default()
+    test_wider_sf_range_sets_ldro_and_restores()
+    print('ok')
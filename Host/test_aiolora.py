@@ -0,0 +1,46 @@
+"""AsyncLora on the host emulator, driven by the uasyncio stand-in.
+
+Run from the repository root with pytest, or directly:
+    python Host/test_aiolora.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uasyncio as asyncio  # noqa: E402
+from bench import make_pair  # noqa: E402
+from LightLora import aiolora, lorautil  # noqa: E402
+
+WALL_TIMEOUT_S = 5  # real seconds; a send that never wakes fails here instead of hanging
+
+
+def _send(a, b, payload):
+    async def main():
+        radio = aiolora.AsyncLora(a)
+        return await asyncio.wait_for(radio.send(1, 2, payload), WALL_TIMEOUT_S)
+    handle = asyncio.run(main())
+    return handle, [bytes(p.msg) for p in b.read_packets()]
+
+
+def test_send_waits_until_sent():
+    _, _, a, b = make_pair()
+    handle, received = _send(a, b, b'hello')
+    assert handle.status == lorautil.TX_DONE
+    assert received == [b'hello']
+
+
+def test_send_wakes_on_a_timeout():
+    ra, _, a, b = make_pair(stats=True)
+    ra._tx_done = lambda: None  # TxDone never comes
+    handle, _ = _send(a, b, b'lost')
+    assert handle.status == lorautil.TX_TIMEOUT
+    assert a.tx_timeouts == 1
+
+
+if __name__ == '__main__':
+    test_send_waits_until_sent()
+    test_send_wakes_on_a_timeout()
+    print('ok')
@@ -0,0 +1,96 @@
+"""Heap checks for the receive path on the host emulator.
+
+Run from the repository root with pytest, or directly:
+    python Host/test_alloc.py
+
+tracemalloc sees CPython's own objects too (frames, ints past the small-int
+cache, the memoryview slice that sizes the FIFO read), so the checks are
+relative: the receive handler must not allocate in proportion to the payload,
+and what it holds on to must not grow from packet to packet.
+"""
+
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import hostsim  # noqa: E402
+from bench import make_pair  # noqa: E402
+
+LIBRARY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                       'LightLora', '*')
+SMALL = 8
+LARGE = 200
+# a copy of a LARGE payload is over 200 bytes, CPython's noise is well under this
+SLACK_BYTES = 64
+LEAK_PACKETS = 200
+
+
+def _deliver(radio, size, seq):
+    radio.deliver(bytes((1, 2, seq & 0xff, size)) + bytes(size), -60, 9.0, True)
+
+
+def library_allocations(fn):
+    """Bytes allocated from LightLora code while fn() runs. Live blocks are gathered
+    at every call and return, so short-lived ones passed to a call count too."""
+    seen = set()
+    only_library = [tracemalloc.Filter(True, LIBRARY)]
+
+    def profile(frame, event, arg):
+        for trace in tracemalloc.take_snapshot().filter_traces(only_library).traces:
+            seen.add((trace.size, trace.traceback))
+
+    tracemalloc.start(4)
+    sys.setprofile(profile)
+    try:
+        fn()
+    finally:
+        sys.setprofile(None)
+        tracemalloc.stop()
+    return sum(size for size, _ in seen)
+
+
+def handler_allocations(size, runs=3):
+    """Library allocations of a receive handler run for a size byte payload, the
+    least of several: the first run in a process also pays for one-off setup."""
+    _, rb, _, b = make_pair(rx_queue_size=4)
+    least = None
+    for i in range(runs):
+        _deliver(rb, size, i)
+        allocated = library_allocations(hostsim.run_scheduled)
+        assert len(b.read_packets()) == 1
+        least = allocated if least is None else min(least, allocated)
+    return least
+
+
+def test_handler_does_not_copy_the_payload():
+    small = handler_allocations(SMALL)
+    large = handler_allocations(LARGE)
+    assert large - small < SLACK_BYTES, (small, large)
+
+
+def test_handler_holds_nothing_per_packet():
+    _, rb, _, b = make_pair(rx_queue_size=4)
+    tracemalloc.start()
+    # once every pooled packet has been used, each holds its latest ints and msg view
+    for i in range(20):
+        _deliver(rb, 100, i)
+        hostsim.run_scheduled()
+        b.read_packets()
+    first = tracemalloc.get_traced_memory()[0]
+    for i in range(20, 20 + LEAK_PACKETS):
+        _deliver(rb, 100, i)
+        hostsim.run_scheduled()
+        b.read_packets()
+    last = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # anything kept per packet, even one int, would add LEAK_PACKETS * 28 bytes or more
+    assert last - first < 4 * SLACK_BYTES, (first, last)
+
+
+if __name__ == '__main__':
+    test_handler_does_not_copy_the_payload()
+    test_handler_holds_nothing_per_packet()
+    print('ok')
@@ -0,0 +1,85 @@
+"""Sliding-window ARQ between two emulated radios, over a lossy channel.
+
+Run from the repository root with pytest, or directly:
+    python Host/test_arq.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utime  # noqa: E402
+from bench import make_pair  # noqa: E402
+from sx127x_sim import VirtualChannel  # noqa: E402
+from LightLora import arq  # noqa: E402
+
+
+class Pair:
+    "A link each way between radios a and b; b can be taken offline."
+
+    def __init__(self, channel=None, **kwargs):
+        _, _, self.a, self.b = make_pair(channel)
+        self.la = arq.ArqLink(self.a, 0x01, 0x02, **kwargs)
+        self.lb = arq.ArqLink(self.b, 0x02, 0x01)
+        self.b_online = True
+        self.received = []
+
+    def step(self):
+        for lu, link, online in ((self.a, self.la, True), (self.b, self.lb, self.b_online)):
+            lu.service()
+            for pkt in lu.read_packets():
+                if online:
+                    assert link.feed(pkt)
+            link.service()
+        msg = self.lb.read()
+        while msg is not None:
+            self.received.append(bytes(msg))
+            msg = self.lb.read()
+        utime.sleep_ms(5)
+
+    def run(self, ms):
+        for _ in range(ms // 5):
+            self.step()
+
+
+def test_in_order_at_20_percent_loss():
+    pair = Pair(VirtualChannel(loss=0.2, seed=3), window=4)
+    payloads = [b'packet %d' % i for i in range(40)]
+    queued = 0
+    for _ in range(120000 // 5):
+        if queued < len(payloads) and pair.la.send(payloads[queued]) is not None:
+            queued += 1
+        pair.step()
+        if queued == len(payloads) and pair.la.idle:
+            break
+    assert pair.received == payloads
+    assert pair.la.retransmits > 0
+    assert pair.la.failed == 0
+
+
+def test_gives_up_after_max_retries():
+    pair = Pair(max_retries=2)
+    for i in range(3):
+        pair.la.send(b'p%d' % i)
+    pair.run(3000)
+    assert pair.received == [b'p0', b'p1', b'p2']
+    pair.b_online = False
+    for i in range(3, 6):
+        pair.la.send(b'p%d' % i)
+    pair.run(30000)
+    assert pair.la.failed == 3
+    assert pair.la.pending == 0 and pair.la.can_send()
+    # the peer comes back and resynchronizes on the next packets
+    pair.b_online = True
+    for i in range(6, 9):
+        pair.la.send(b'p%d' % i)
+    pair.run(5000)
+    assert pair.received == [b'p0', b'p1', b'p2', b'p6', b'p7', b'p8']
+
+
+if __name__ == '__main__':
+    test_in_order_at_20_percent_loss()
+    test_gives_up_after_max_retries()
+    print('ok')
@@ -0,0 +1,81 @@
+"""Fragmentation and reassembly between two emulated radios.
+
+Run from the repository root with pytest, or directly:
+    python Host/test_fragment.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utime  # noqa: E402
+from bench import make_pair  # noqa: E402
+from LightLora import fragment  # noqa: E402
+
+
+def _message(size):
+    return bytes((i * 7 + (i >> 8)) & 0xff for i in range(size))
+
+
+def _transfer(data, length=None, limit_ms=60000):
+    "Send data from a to b, return the messages b put back together."
+    _, _, a, b = make_pair()
+    sender = fragment.FragmentSender(a, 0x01, 0x11, data, length)
+    rx = fragment.Reassembler(slots=2, max_size=4096)
+    received = []
+    for _ in range(limit_ms // 10):
+        sender.poll()
+        a.service()
+        for pkt in b.read_packets():
+            assert rx.feed(pkt)
+        for src, msg in rx.messages():
+            received.append((src, bytes(msg)))
+        if sender.done and received:
+            break
+        utime.sleep_ms(10)
+    return received
+
+
+def test_round_trip():
+    data = _message(3000)
+    assert _transfer(data) == [(0x01, data)]
+
+
+def test_round_trip_streamed():
+    data = _message(1000)
+    chunks = (data[i:i + 100] for i in range(0, len(data), 100))
+    assert _transfer(chunks, len(data)) == [(0x01, data)]
+
+
+def test_short_stream_raises():
+    _, _, a, _ = make_pair()
+    sender = fragment.FragmentSender(a, 0x01, 0x11, iter([bytes(100)]), 600)
+    try:
+        for _ in range(100):
+            sender.poll()
+            utime.sleep_ms(10)
+    except ValueError:
+        return
+    raise AssertionError('no ValueError')
+
+
+def test_length_limit():
+    _, _, a, _ = make_pair()
+    limit = fragment.max_length(a)
+    assert limit == 256 * (255 - 4 - fragment.SUBHEADER_LENGTH)
+    fragment.FragmentSender(a, 0x01, 0x11, bytes(limit))
+    try:
+        fragment.FragmentSender(a, 0x01, 0x11, bytes(limit + 1))
+    except ValueError:
+        return
+    raise AssertionError('no ValueError')
+
+
+if __name__ == '__main__':
+    test_round_trip()
+    test_round_trip_streamed()
+    test_short_stream_raises()
+    test_length_limit()
+    print('ok')
@@ -0,0 +1,188 @@
+"""LoraUtil behaviour on the host emulator: queues, listen-before-talk, sniffing.
+
+Run from the repository root with pytest, or directly:
+    python Host/test_lorautil.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import hostsim  # noqa: E402
+import utime  # noqa: E402
+from bench import make_pair, PINS_B  # noqa: E402
+from LightLora import lorautil  # noqa: E402
+
+
+def _slow(*radios):
+    "SF12 at 62.5kHz: a CAD takes about 131ms, longer than the fixed send margin."
+    for lu in radios:
+        lu.lora.setSpreadingFactor(12)
+        lu.lora.setSignalBandwidth(62.5e3)
+        lu.lora.setLowDataRateOptimize(True)
+        lu._listen()
+
+
+def _run(until, *radios, limit_ms=60000):
+    "Service radios every 10ms of emulated time until until() is true."
+    for _ in range(limit_ms // 10):
+        if until():
+            return True
+        for lu in radios:
+            lu.service()
+        utime.sleep_ms(10)
+    return until()
+
+
+def test_lbt_sends_at_slow_settings():
+    _, _, a, b = make_pair(lbt=True)
+    _slow(a, b)
+    handle = a.send_packet(1, 2, b'slow')
+    assert _run(lambda: handle.done, a, b)
+    assert handle.status == lorautil.TX_DONE
+    assert [bytes(p.msg) for p in b.read_packets()] == [b'slow']
+
+
+def test_lost_cad_done_counts_as_a_try():
+    ra, _, a, _ = make_pair(lbt=True)
+    ra._cad_done = lambda: None
+    handle = a.send_packet(1, 2, b'lost')
+    assert _run(lambda: handle.done, a)
+    assert handle.status == lorautil.TX_BUSY
+    assert a.lbt_giveups == 1
+    assert not a.is_transmitting()
+
+
+def test_sniff_receives_at_slow_settings():
+    _, _, a, b = make_pair()
+    _slow(a, b)
+    b.sniff(2000)
+    a.wake_preamble(2000)
+    utime.sleep_ms(500)
+    a.send_packet(1, 2, b'wake up')
+    assert _run(lambda: b.is_packet_available(), a, b)
+    assert b.sniff_wakes == 1
+    assert [bytes(p.msg) for p in b.read_packets()] == [b'wake up']
+
+
+def _warm_start(stale):
+    "Restart b's MCU from an image while its radio stays powered, in receive."
+    _, rb, a, b = make_pair()
+    image = b.save_image()
+    if stale:
+        rb.deliver(bytes((1, 2, 0, 5)) + b'stale', -60, 9.0, True)
+        del hostsim._scheduled[:]   # the MCU slept before servicing RxDone
+    b = lorautil.LoraUtil(image=image, **PINS_B)
+    assert b.warm_started
+    assert rb.regs[0x12] == 0   # REG_IRQ_FLAGS
+    a.send_packet(1, 2, b'fresh')
+    utime.sleep_ms(300)
+    return [bytes(p.msg) for p in b.read_packets()]
+
+
+def test_warm_start_receives():
+    assert _warm_start(False) == [b'fresh']
+
+
+def test_warm_start_clears_a_stale_rx_done():
+    assert _warm_start(True) == [b'fresh']
+
+
+def test_set_profile_waits_for_the_queue():
+    ra, _, a, b = make_pair()
+    handles = [a.send_packet(1, 2, b'one'), a.send_packet(1, 2, b'two')]
+    a.set_profile('long_range')
+    assert a.lora.parameters['spreading_factor'] == 7
+    assert _run(lambda: not a.is_transmitting(), a)
+    assert [h.status for h in handles] == [lorautil.TX_DONE, lorautil.TX_DONE]
+    assert [bytes(p.msg) for p in b.read_packets()] == [b'one', b'two']
+    assert a.lora.parameters['spreading_factor'] == 12
+    assert ra.config()[1] == 12 and ra.listening()
+
+
+def test_fixed_length_must_fit_the_fifo():
+    for kwargs in ({'fixed_length': 252}, {'fixed_length': 125, 'split_fifo': True}):
+        try:
+            make_pair(**kwargs)
+        except ValueError:
+            continue
+        raise AssertionError(kwargs)
+    ra, _, a, b = make_pair(fixed_length=124, split_fifo=True)
+    assert a.max_payload() == 124
+    a.send_packet(1, 2, b'padded')
+    utime.sleep_ms(300)
+    assert [bytes(p.msg[:6]) for p in b.read_packets()] == [b'padded']
+
+
+def _deliver(radio, seq, payload=b'x'):
+    radio.deliver(bytes((1, 2, seq, len(payload))) + payload, -60, 9.0, True)
+    hostsim.run_scheduled()
+
+
+def _ring(policy):
+    "Line counts queued after 10 packets arrive at a 4 deep queue nobody reads."
+    _, rb, _, b = make_pair(rx_queue_size=4, rx_overflow=policy)
+    for seq in range(10):
+        _deliver(rb, seq)
+    assert b.rx_dropped == 6
+    return [p.src_line_count for p in b.read_packets()]
+
+
+def test_drop_oldest_keeps_the_newest():
+    assert _ring(lorautil.RX_DROP_OLDEST) == [6, 7, 8, 9]
+
+
+def test_drop_newest_keeps_the_oldest():
+    assert _ring(lorautil.RX_DROP_NEWEST) == [0, 1, 2, 3]
+
+
+def test_drop_oldest_leaves_packets_being_read_alone():
+    _, rb, _, b = make_pair(rx_queue_size=4, rx_overflow=lorautil.RX_DROP_OLDEST)
+    for seq in range(2):
+        _deliver(rb, seq, b'held %d' % seq)
+    held = b.read_packets()
+    for seq in range(2, 12):
+        _deliver(rb, seq, b'new %d' % seq)
+    assert [bytes(p.msg) for p in held] == [b'held 0', b'held 1']
+    assert [p.src_line_count for p in b.read_packets()] == [8, 9, 10, 11]
+
+
+def test_pending_rx_done_is_read_before_sending():
+    ra, rb, a, b = make_pair()
+    # RxDone fired but its scheduled handler has not run when the reply is loaded
+    rb.deliver(bytes((1, 2, 7, 5)) + b'hello', -60, 9.0, True)
+    handle = b.send_packet(2, 1, b'reply')
+    assert _run(lambda: handle.done, a, b)
+    assert handle.status == lorautil.TX_DONE
+    assert [(p.src_line_count, bytes(p.msg)) for p in b.read_packets()] == [(7, b'hello')]
+    assert [bytes(p.msg) for p in a.read_packets()] == [b'reply']
+
+
+def test_sniff_off_restores_the_configured_preamble():
+    _, _, _, b = make_pair()
+    b.lora.setPreambleLength(12)
+    b.sniff(500)
+    b.sniff(1000)
+    assert b.lora.parameters['preamble_length'] > 12
+    b.sniff(0)
+    assert b.lora.parameters['preamble_length'] == 12
+    b.wake_preamble(0)
+    assert b.lora.parameters['preamble_length'] == 12
+
+
+if __name__ == '__main__':
+    test_lbt_sends_at_slow_settings()
+    test_lost_cad_done_counts_as_a_try()
+    test_sniff_receives_at_slow_settings()
+    test_warm_start_receives()
+    test_warm_start_clears_a_stale_rx_done()
+    test_set_profile_waits_for_the_queue()
+    test_fixed_length_must_fit_the_fifo()
+    test_drop_oldest_keeps_the_newest()
+    test_drop_newest_keeps_the_oldest()
+    test_drop_oldest_leaves_packets_being_read_alone()
+    test_pending_rx_done_is_read_before_sending()
+    test_sniff_off_restores_the_configured_preamble()
+    print('ok')
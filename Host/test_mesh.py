@@ -0,0 +1,85 @@
+"""Mesh relaying between emulated radios that do not all hear each other.
+
+Run from the repository root with pytest, or directly:
+    python Host/test_mesh.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utime  # noqa: E402
+import sx127x_sim  # noqa: E402
+from bench import PINS_B, PINS_C  # noqa: E402
+from sx127x_sim import SimRadio, VirtualChannel  # noqa: E402
+from LightLora import lorautil, mesh  # noqa: E402
+
+PINS_D = {'pin_id_lora_ss': 25, 'pin_id_lora_dio0': 26, 'pin_id_lora_reset': 32}
+PINS = ({}, PINS_B, PINS_C, PINS_D)
+
+
+def _mesh(names, links):
+    '''A MeshRelay per name, node address index + 1. links maps (from, to) names to
+       channel.link() arguments; a pair given loss=1 cannot hear each other'''
+    sx127x_sim.reset()
+    channel = VirtualChannel()
+    for name, pins in zip(names, PINS):
+        SimRadio(channel, name, cs=pins.get('pin_id_lora_ss', 14),
+                 dio0=pins.get('pin_id_lora_dio0', 15),
+                 reset=pins.get('pin_id_lora_reset', 27))
+    for (a, b), kwargs in links.items():
+        channel.link(a, b, **kwargs)
+    return [mesh.MeshRelay(lorautil.LoraUtil(**pins), i + 1)
+            for i, pins in enumerate(PINS[:len(names)])]
+
+
+def _run(nodes, ms):
+    "Service every node for ms of emulated time, return what each read."
+    inboxes = [[] for _ in nodes]
+    for _ in range(ms // 5):
+        for node, inbox in zip(nodes, inboxes):
+            node.lu.service()
+            for pkt in node.lu.read_packets():
+                assert node.feed(pkt)
+            node.service()
+            message = node.read()
+            while message is not None:
+                src, hops, msg = message
+                inbox.append((src, hops, bytes(msg)))
+                message = node.read()
+        utime.sleep_ms(5)
+    return inboxes
+
+
+def _deaf(a, b):
+    return {(a, b): {'loss': 1.0}, (b, a): {'loss': 1.0}}
+
+
+def test_relay_through_a_middle_node():
+    src, middle, dst = _mesh(('a', 'm', 'd'), _deaf('a', 'd'))
+    src.send(3, b'over the hill')
+    inboxes = _run((src, middle, dst), 3000)
+    assert inboxes[2] == [(1, 2, b'over the hill')]
+    assert middle.relayed == 1
+    assert inboxes[1] == []     # not for the middle node
+
+
+def test_farther_relay_goes_first_and_the_other_cancels():
+    links = _deaf('a', 'd')
+    links[('a', 'far')] = {'rssi': -110}
+    links[('a', 'near')] = {'rssi': -50}
+    src, far, near, dst = _mesh(('a', 'far', 'near', 'd'), links)
+    src.send(mesh.BROADCAST, b'everyone')
+    inboxes = _run((src, far, near, dst), 3000)
+    assert far.relayed == 1
+    assert near.relayed == 0 and near.cancelled == 1
+    assert inboxes[3] == [(1, 2, b'everyone')]
+    assert inboxes[1] == inboxes[2] == [(1, 1, b'everyone')]
+
+
+if __name__ == '__main__':
+    test_relay_through_a_middle_node()
+    test_farther_relay_goes_first_and_the_other_cancels()
+    print('ok')
@@ -0,0 +1,68 @@
+"""TDMA slots and RX timestamps between an emulated gateway and node.
+
+Run from the repository root with pytest, or directly:
+    python Host/test_tdma.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utime  # noqa: E402
+from bench import make_pair  # noqa: E402
+from LightLora import tdma  # noqa: E402
+from LightLora.lorautil import HEADER_LENGTH  # noqa: E402
+
+SLOT = 3
+
+
+def _star():
+    _, _, a, b = make_pair()
+    return a, b, tdma.TdmaGateway(a, 0x01, slots=4), tdma.TdmaNode(b, 0x01, SLOT)
+
+
+def _run(gateway, node, ms, uplinks):
+    "Run both ends for ms; uplinks collects (frame position us, payload) at the gateway."
+    a, b = gateway.lu, node.lu
+    for _ in range(ms):
+        gateway.service()
+        a.service()
+        b.service()
+        for pkt in a.read_packets():
+            start = utime.ticks_add(pkt.rx_ticks_us,
+                                    -a.lora.timeOnAir(HEADER_LENGTH + len(pkt.msg)))
+            uplinks.append((gateway._frame_pos(start), bytes(pkt.msg)))
+        for pkt in b.read_packets():
+            assert node.feed(pkt)
+        utime.sleep_ms(1)
+
+
+def test_node_waits_for_a_beacon():
+    _, b, gateway, node = _star()
+    handle = b.send_packet(0x13, 0x01, b'early')
+    assert not node.synced
+    uplinks = []
+    _run(gateway, node, 10, uplinks)
+    assert not handle.done and uplinks == []
+
+
+def test_node_sends_in_its_slot():
+    _, b, gateway, node = _star()
+    uplinks = []
+    _run(gateway, node, 3 * gateway.frame_us // 1000, uplinks)
+    assert node.synced and node.beacons >= 2
+    for i in range(3):
+        b.send_packet(0x13, 0x01, b'reading %d' % i)
+    _run(gateway, node, 4 * gateway.frame_us // 1000, uplinks)
+    assert [msg for _, msg in uplinks] == [b'reading 0', b'reading 1', b'reading 2']
+    slot_us = gateway.slot_ms * 1000
+    for pos, _ in uplinks:
+        assert SLOT * slot_us <= pos < (SLOT + 1) * slot_us, (pos, slot_us)
+
+
+if __name__ == '__main__':
+    test_node_waits_for_a_beacon()
+    test_node_sends_in_its_slot()
+    print('ok')
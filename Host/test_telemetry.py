@@ -0,0 +1,75 @@
+"""Telemetry codec round trips, alone and over the fixed-length radio mode.
+
+Run from the repository root with pytest, or directly:
+    python Host/test_telemetry.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utime  # noqa: E402
+from bench import make_pair  # noqa: E402
+from LightLora import telemetry  # noqa: E402
+
+SCHEMA = telemetry.Schema((('temp', 'h', 0.01), ('hum', 'B', 0.5), ('vbat', 'B', 0.02)))
+
+
+def _reading(i):
+    return (21.5 + (i % 7) * 0.01, 45.5, 3.7)
+
+
+def _close(values, expected):
+    return all(abs(v - e) <= s / 2 + 1e-9 for v, e, s in zip(values, expected, SCHEMA.scales))
+
+
+def test_keyframes_and_deltas():
+    enc = telemetry.Encoder(SCHEMA, keyframe_every=4)
+    dec = telemetry.Decoder(SCHEMA)
+    sizes = []
+    for i in range(64):
+        frame = bytes(enc.encode(_reading(i)))
+        sizes.append(len(frame))
+        assert frame[0] < 0xc0
+        assert _close(dec.decode(frame), _reading(i))
+    assert sizes[0] == enc.max_size and min(sizes) < enc.max_size
+    assert dec.missed == 0
+
+
+def test_delta_without_its_keyframe():
+    enc = telemetry.Encoder(SCHEMA, keyframe_every=4)
+    dec = telemetry.Decoder(SCHEMA)
+    enc.encode(_reading(0))     # keyframe lost
+    assert dec.decode(bytes(enc.encode(_reading(1)))) is None
+    assert dec.missed == 1
+
+
+def test_other_modules_frames_are_rejected():
+    dec = telemetry.Decoder(SCHEMA)
+    for magic in (0xc0, 0xfa, 0xfb, 0xfd, 0xfe):
+        assert dec.decode(bytes((magic,)) + bytes(8)) is None
+    assert dec.missed == 0
+
+
+def test_fixed_length_round_trip():
+    enc = telemetry.Encoder(SCHEMA, keyframe_every=1)
+    _, _, a, b = make_pair(fixed_length=enc.max_size)
+    dec = telemetry.Decoder(SCHEMA)
+    for i in range(3):
+        a.send_packet(0x01, 0x11, enc.encode(_reading(i)))
+        utime.sleep_ms(100)
+    packets = b.read_packets()
+    assert len(packets) == 3
+    for i, pkt in enumerate(packets):
+        assert len(pkt.msg) == enc.max_size
+        assert _close(dec.decode(pkt.msg), _reading(i))
+
+
+if __name__ == '__main__':
+    test_keyframes_and_deltas()
+    test_delta_without_its_keyframe()
+    test_other_modules_frames_are_rejected()
+    test_fixed_length_round_trip()
+    print('ok')
@@ -0,0 +1,54 @@
+"""uasyncio on top of CPython asyncio, driven by the virtual clock.
+
+Adds ThreadSafeFlag, and makes sleep() advance the emulated time so radio
+events fire while tasks wait.
+"""
+
+import asyncio
+from asyncio import CancelledError, Event, Lock, TimeoutError, create_task, gather, wait_for  # noqa: F401
+
+import hostsim
+
+
+class ThreadSafeFlag:
+    "Single-waiter flag that may be set from an interrupt handler."
+
+    def __init__(self):
+        self._flag = False
+
+    def set(self):
+        self._flag = True
+
+    def clear(self):
+        self._flag = False
+
+    async def wait(self):
+        while not self._flag:
+            await _idle()
+        self._flag = False
+
+
+async def _idle():
+    "Yield to other tasks; when nothing is runnable, jump to the next event."
+    await asyncio.sleep(0)
+    nxt = hostsim.next_event_us()
+    if nxt is not None:
+        import utime
+        utime.sleep_us(max(0, min(nxt - hostsim.now_us(), 1000)))
+
+
+async def sleep_ms(ms):
+    import utime
+    end = utime.ticks_add(utime.ticks_ms(), int(ms))
+    while utime.ticks_diff(end, utime.ticks_ms()) > 0:
+        step = min(utime.ticks_diff(end, utime.ticks_ms()), 1)
+        utime.sleep_ms(step)
+        await asyncio.sleep(0)
+
+
+async def sleep(s):
+    await sleep_ms(s * 1000)
+
+
+def run(coro):
+    return asyncio.run(coro)
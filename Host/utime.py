@@ -0,0 +1,41 @@
+"Virtual-clock stand-in for MicroPython's utime."
+
+import hostsim
+
+_TICKS_PERIOD = 1 << 30
+_TICKS_MAX = _TICKS_PERIOD - 1
+_TICKS_HALF = _TICKS_PERIOD // 2
+
+
+def ticks_us():
+    return hostsim.now_us() & _TICKS_MAX
+
+
+def ticks_ms():
+    return (hostsim.now_us() // 1000) & _TICKS_MAX
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & _TICKS_MAX
+
+
+def ticks_diff(end, start):
+    return ((end - start + _TICKS_HALF) & _TICKS_MAX) - _TICKS_HALF
+
+
+def sleep_us(us):
+    hostsim.settle()
+    hostsim.advance(us)
+    hostsim.run_scheduled()
+
+
+def sleep_ms(ms):
+    sleep_us(ms * 1000)
+
+
+def sleep(s):
+    sleep_us(int(s * 1000000))
+
+
+def time():
+    return hostsim.now_us() // 1000000
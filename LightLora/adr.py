@@ -0,0 +1,176 @@
+"Per-peer link quality and adaptive data rate: the fastest setting that still reaches each node"
+
+from array import array
+from math import log10
+from utime import ticks_ms, ticks_diff
+from micropython import const
+from LightLora import sx127x
+from LightLora.lorautil import BROADCAST
+
+EWMA_SHIFT = const(3)       # each packet moves the averages 1/8 of the way
+LOSS_ONE = const(0xffff)    # loss estimate of every packet lost
+MAX_GAP = const(16)         # larger line count jumps are a restart, not losses
+LOSS_STEP_DB = const(3)     # extra margin asked for per 10% packet loss
+
+# noise floor per sx127x.BANDWIDTHS setting, 1/16 dB: -174dBm/Hz, bandwidth, 6dB noise figure
+_NOISE16 = tuple(int((-168 + 10 * log10(bw)) * 16) for bw in sx127x.BANDWIDTHS)
+
+def _snrLimit16(sf):
+    "SNR the demodulator needs at spreading factor sf, 1/16 dB: -5dB at SF6, 2.5dB less per step."
+    return -80 - 40 * (sf - 6)
+
+class LinkTable:
+    '''Exponentially weighted RSSI, SNR and packet loss for up to size peers, kept in
+       fixed arrays. Set it as a LoraUtil's link_table and the receive handler updates
+       it for every packet without allocating; the least recently heard peer makes
+       room for a new one. Loss is taken from gaps in a peer's line counts, so
+       packets it sent to other nodes count as lost unless this node receives them too'''
+    def __init__(self, size=8):
+        self._addr = bytearray(size)
+        self._count = bytearray(size)   # packets heard, up to 255. 0 for a free entry
+        self._seq = bytearray(size)     # latest line count
+        self._rssi = array('h', bytes(2 * size))    # dBm, 1/16 dB
+        self._snr = array('h', bytes(2 * size))     # dB, 1/16 dB
+        self._loss = array('H', bytes(2 * size))    # fraction of LOSS_ONE
+        self._seen = [0] * size     # ticks_ms() of the latest packet
+
+    def _find(self, address):
+        count = self._count
+        addr = self._addr
+        for i in range(len(addr)):
+            if count[i] and addr[i] == address:
+                return i
+        return -1
+
+    def _claim(self, address, now):
+        "A free entry for address, or the least recently heard one's."
+        count = self._count
+        oldest = 0
+        for i in range(len(count)):
+            if not count[i]:
+                oldest = i
+                break
+            if ticks_diff(self._seen[oldest], self._seen[i]) > 0:
+                oldest = i
+        self._addr[oldest] = address
+        self._count[oldest] = 0
+        return oldest
+
+    def observe(self, address, seq, rssi, snrRaw):
+        "Take in a packet from address: its line count, RSSI (dBm) and raw SNR (0.25dB)."
+        now = ticks_ms()
+        i = self._find(address)
+        if i < 0:
+            i = self._claim(address, now)
+            self._rssi[i] = rssi << 4
+            self._snr[i] = snrRaw << 2
+            self._loss[i] = 0
+        else:
+            gap = (seq - self._seq[i] - 1) & 0xff
+            if gap <= MAX_GAP:
+                loss = self._loss[i]
+                for _ in range(gap):
+                    loss += (LOSS_ONE - loss) >> EWMA_SHIFT
+                self._loss[i] = loss - (loss >> EWMA_SHIFT)
+            self._rssi[i] += ((rssi << 4) - self._rssi[i]) >> EWMA_SHIFT
+            self._snr[i] += ((snrRaw << 2) - self._snr[i]) >> EWMA_SHIFT
+        self._seq[i] = seq
+        self._seen[i] = now
+        if self._count[i] < 0xff:
+            self._count[i] += 1
+
+    def forget(self, address):
+        "Drop what is known about address."
+        i = self._find(address)
+        if i >= 0:
+            self._count[i] = 0
+
+    def link(self, address):
+        "(rssi dBm, snr dB, loss fraction, packets heard) for address, or None."
+        i = self._find(address)
+        if i < 0:
+            return None
+        return self._rssi[i] / 16, self._snr[i] / 16, self._loss[i] / LOSS_ONE, self._count[i]
+
+    def peers(self):
+        "The addresses in the table."
+        return [self._addr[i] for i in range(len(self._addr)) if self._count[i]]
+
+class AdrPolicy:
+    '''Sends to each peer with the lowest spreading factor, then the lowest TX power,
+       that leaves margin_db of SNR margin on that link (LOSS_STEP_DB more per 10%
+       loss), judged from the table's averages for packets received from it.
+       Peers are assumed to transmit at ref_power (default the power set now).
+       Broadcasts, peers heard fewer than min_packets times and receiving use the
+       settings the radio had before. A receiver only hears the spreading factor it
+       listens on, so by default sf_range is the spreading factor set now and only
+       the power adapts. Give a wider (low, high) range only when peers listen on
+       all of it, e.g. a MultiLora gateway.
+       Installs itself on lora_util as link_table and tx_configure'''
+    def __init__(self, lora_util, table=None, sf_range=None, power_range=(2, 17),
+                 margin_db=10, min_packets=3, ref_power=None):
+        self.lora = lora_util.lora
+        self.table = table if table is not None else LinkTable()
+        p = self.lora.parameters
+        if sf_range is None:
+            sf_range = (p['spreading_factor'], p['spreading_factor'])
+        self.sf_range = sf_range
+        self.power_range = power_range
+        self.margin_db = margin_db
+        self.min_packets = min_packets
+        self.ref_power = p['tx_power_level'] if ref_power is None else ref_power
+        self._saved = False     # _rx_* hold the settings to restore after sending
+        self._rx_sf = p['spreading_factor']
+        self._rx_power = p['tx_power_level']
+        self._rx_ldro = p['low_data_rate_optimize']
+        lora_util.link_table = self.table
+        lora_util.tx_configure = self.tx_configure
+
+    def choose(self, address):
+        "(spreading factor, TX power) for sending to address, or None to leave them."
+        table = self.table
+        i = table._find(address)
+        if address == BROADCAST or i < 0 or table._count[i] < self.min_packets:
+            return None
+        bw = sx127x._bandwidthBits(self.lora.parameters['signal_bandwidth'])
+        # SNR is only reported up to about +10dB, above that the RSSI tells more
+        snr = max(table._snr[i], table._rssi[i] - _NOISE16[bw])
+        margin = self.margin_db + (table._loss[i] * 10 * LOSS_STEP_DB >> 16)
+        need = (margin + self.ref_power) * 16 - snr
+        lo, hi = self.power_range
+        for sf in range(self.sf_range[0], self.sf_range[1] + 1):
+            power = -(-(need + _snrLimit16(sf)) // 16)
+            if power <= hi:
+                return sf, max(power, lo)
+        return self.sf_range[1], hi
+
+    def _apply(self, sf, power, ldro=None):
+        "Switch to sf and power. ldro=None works it out: symbols over 16ms need it."
+        lora = self.lora
+        if ldro is None:
+            bw = sx127x._bandwidthBits(lora.parameters['signal_bandwidth'])
+            ldro = (1 << sf) * 1000000 // sx127x.BANDWIDTHS[bw] > 16000
+        lora.setSpreadingFactor(sf)
+        lora.setTxPower(power)
+        lora.setLowDataRateOptimize(ldro)
+
+    def tx_configure(self, address):
+        '''Called by LoraUtil before each packet with its destination, and with None
+           before receiving again. Register writes happen only on a change'''
+        p = self.lora.parameters
+        if address is None:
+            if self._saved:
+                self._saved = False
+                self._apply(self._rx_sf, self._rx_power, self._rx_ldro)
+            return
+        if not self._saved:
+            self._saved = True
+            self._rx_sf = p['spreading_factor']
+            self._rx_power = p['tx_power_level']
+            self._rx_ldro = p['low_data_rate_optimize']
+        choice = self.choose(address)
+        if choice is None:
+            self._apply(self._rx_sf, self._rx_power, self._rx_ldro)
+            return
+        sf, power = choice
+        self._apply(sf, power)
@@ -0,0 +1,58 @@
+"uasyncio front end for LoraUtil: await send/recv and async iteration over packets"
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+from LightLora import lorautil
+
+
+class AsyncLora:
+    '''Wraps a LoraUtil so tasks await radio events instead of polling.
+       The receive and TxDone interrupts set a ThreadSafeFlag, which wakes the
+       waiting task; other tasks run while a packet is on air.
+         await radio.send(src, dst, payload) -> the TxHandle, once sent
+         await radio.recv() -> the next LoraPacket
+         async for pkt in radio: ...
+       Only one task at a time should wait in recv(). A background task runs
+       LoraUtil.service() every service_ms for airtime budget and TX timeouts.
+    '''
+    def __init__(self, lora_util=None, service_ms=50, **kwargs):
+        self.lu = lora_util if lora_util else lorautil.LoraUtil(**kwargs)
+        self.service_ms = service_ms
+        self._rx_flag = asyncio.ThreadSafeFlag()
+        self._tx_flag = asyncio.ThreadSafeFlag()
+        self._tx_lock = asyncio.Lock()
+        self.lu.rx_notify = self._rx_flag.set
+        self.lu.tx_notify = self._tx_flag.set
+        self._service_task = asyncio.create_task(self._service())
+
+    async def _service(self):
+        while True:
+            self.lu.service()
+            await asyncio.sleep_ms(self.service_ms)
+
+    async def send(self, src_address, dst_address, payload, wait=True):
+        '''Queue a packet, waiting for room in the transmit queue if needed.
+           With wait=False return the TxHandle as soon as it is queued'''
+        async with self._tx_lock:
+            while not self.lu.can_send():
+                await self._tx_flag.wait()
+            handle = self.lu.send_packet(src_address, dst_address, payload)
+            while wait and not handle.done:
+                await self._tx_flag.wait()
+        return handle
+
+    async def recv(self):
+        "Wait for the next received packet and return it"
+        while True:
+            pkt = self.lu.read_packet()
+            if pkt:
+                return pkt
+            await self._rx_flag.wait()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.recv()
@@ -0,0 +1,287 @@
+"Reliable, in-order delivery between two nodes: a sliding window with selective acknowledgements"
+
+from utime import ticks_ms, ticks_add, ticks_diff
+from micropython import const
+try:
+    from urandom import getrandbits
+except ImportError:
+    from random import getrandbits
+from LightLora.lorautil import HEADER_LENGTH
+
+# every ARQ packet's payload starts with
+#   ARQ_MAGIC, flags, sequence, base, ack base, ack map
+# base is the sender's oldest unacknowledged sequence, so a receiver that has just
+# started (or whose peer restarted) knows where the stream begins. ack base is the next
+# sequence the sender of the packet expects in order, and bit k of ack map is set if
+# it also holds ack base + 1 + k. Acknowledgements ride on data packets going the
+# other way; a bare ACK packet is sent only when there is none
+ARQ_MAGIC = const(0xfd)
+SUBHEADER_LENGTH = const(6)
+FLAG_DATA = const(0x01)     # sequence and base are valid
+FLAG_ACK = const(0x02)      # ack base and ack map are valid
+ARQ_MAX_WINDOW = const(8)   # frames beyond ack base an ack map describes
+ARQ_MARGIN_MS = const(200)  # on top of the airtime a round trip takes
+ARQ_MAX_BACKOFF = const(3)  # retransmit timeout doubles per try, up to 8 times
+ARQ_MAX_RETRIES = const(8)  # retransmissions of a packet before the window is given up on
+
+# window slot states
+SLOT_EMPTY = const(0)
+SLOT_WAITING = const(1)     # sending: not acknowledged yet. receiving: held out of order
+SLOT_ACKED = const(2)       # sending: selectively acknowledged, base not there yet
+SLOT_READY = const(3)       # receiving: in order, waiting for read()
+
+class ArqLink:
+    '''Reliable transport over a LoraUtil between src_address (this node) and dst_address.
+       Up to window packets are in flight at once; each is retransmitted until the
+       peer acknowledges it, after a timeout worked out from the airtime of a full
+       window and its acknowledgement. Received packets are put back in order and
+       duplicates (same sender, same sequence) dropped. A packet still not
+       acknowledged after max_retries retransmissions fails the transfer: everything
+       in the window is dropped and counted in failed, and the next send() starts
+       afresh, which resynchronizes the peer. max_retries=None retries forever.
+         send(payload) -> sequence number, or None while the window is full
+         feed(pkt) -> True if pkt was for this link (it is consumed), False otherwise
+         read() -> memoryview of the next payload in order, valid until the next read()
+       Call service() regularly: it sends, retransmits and acknowledges.
+       Sequence numbers are 8 bits; a node that restarts resynchronizes its peer'''
+    def __init__(self, lora_util, src_address, dst_address, window=4, ack_delay_ms=None,
+                 max_retries=ARQ_MAX_RETRIES):
+        if not 0 < window <= ARQ_MAX_WINDOW or window & (window - 1):
+            raise ValueError('window must be 1, 2, 4 or 8')
+        if max_retries is not None and not 0 <= max_retries < 0xff:
+            raise ValueError('max_retries must be 0 to 254, or None')
+        self.lu = lora_util
+        self.src_address = src_address
+        self.dst_address = dst_address
+        self.window = window
+        self.chunk = lora_util.max_payload() - SUBHEADER_LENGTH
+        if self.chunk <= 0:
+            raise ValueError('packets too short for ARQ: %d bytes' % lora_util.max_payload())
+        self.ack_delay_ms = ack_delay_ms
+        self.max_retries = max_retries
+        self._mask = window - 1     # slot of a sequence, 256 sequences wrap evenly
+        self._tx_bufs = [bytearray(SUBHEADER_LENGTH + self.chunk) for _ in range(window)]
+        self._tx_len = bytearray(window)
+        self._tx_state = bytearray(window)
+        self._tx_tries = bytearray(window)
+        self._tx_due = [0] * window     # ticks_ms() the packet is sent again if not acked
+        self._base = getrandbits(8)     # oldest unacknowledged sequence
+        self._next = self._base         # next sequence send() hands out
+        # receiving side
+        self._rx_bufs = [bytearray(self.chunk) for _ in range(window)]
+        self._rx_len = bytearray(window)
+        self._rx_state = bytearray(window)
+        self._rx_synced = False
+        self._expected = 0      # next sequence due in order, the ack base we report
+        self._read = 0          # sequence read() returns next
+        self._reading = False   # read() handed out _read, its slot is in use
+        self._ack_pending = False
+        self._ack_due = 0
+        self._ackbuf = bytearray(SUBHEADER_LENGTH)
+        self._ackbuf[0] = ARQ_MAGIC
+        self.sent = 0
+        self.retransmits = 0
+        self.acked = 0
+        self.received = 0
+        self.duplicates = 0
+        self.acks_sent = 0
+        self.failed = 0     # packets dropped unacknowledged when max_retries ran out
+
+    def _airtime_ms(self, size):
+        return self.lu.lora.timeOnAir(HEADER_LENGTH + SUBHEADER_LENGTH + size) // 1000 + 1
+
+    def _ack_delay(self, size):
+        "How long to hold an ack after a size byte packet, hoping for data to ride on."
+        if self.ack_delay_ms is not None:
+            return self.ack_delay_ms
+        # long enough for the next packet of a burst to arrive, so one ack covers both
+        return self._airtime_ms(size) + ARQ_MARGIN_MS // 4
+
+    def rto_ms(self, size=None):
+        '''Retransmit timeout for a size byte payload (default the largest): a window
+           of such packets out, the peer's ack delay and its ack back'''
+        if size is None:
+            size = self.chunk
+        return self.window * self._airtime_ms(size) + self._ack_delay(size) + \
+            self._airtime_ms(0) + ARQ_MARGIN_MS
+
+    @property
+    def pending(self):
+        "Packets sent or waiting to be sent that the peer has not acknowledged"
+        return (self._next - self._base) & 0xff
+
+    @property
+    def idle(self):
+        "Everything acknowledged and no acknowledgement owed to the peer"
+        return not self.pending and not self._ack_pending
+
+    def can_send(self):
+        "True if the window has room for another packet."
+        return self.pending < self.window
+
+    def send(self, payload):
+        '''Put payload (up to chunk bytes) in the window and start sending it.
+           Returns its sequence number, or None if the window is full'''
+        if len(payload) > self.chunk:
+            raise ValueError('payload too long: %d bytes' % len(payload))
+        if not self.can_send():
+            return None
+        seq = self._next
+        i = seq & self._mask
+        self._tx_bufs[i][SUBHEADER_LENGTH:SUBHEADER_LENGTH + len(payload)] = payload
+        self._tx_len[i] = len(payload)
+        self._tx_state[i] = SLOT_WAITING
+        self._tx_tries[i] = 0
+        self._next = (seq + 1) & 0xff
+        self._transmit(ticks_ms())
+        return seq
+
+    def _ack_fields(self, buf, flags):
+        "Fill in the acknowledgement for the peer, returns the flags to send."
+        if not self._rx_synced:
+            buf[4] = 0
+            buf[5] = 0
+            return flags
+        expected = self._expected
+        amap = 0
+        for k in range(self.window - 1):
+            seq = (expected + 1 + k) & 0xff
+            if ((seq - self._read) & 0xff) < self.window and \
+                    self._rx_state[seq & self._mask] == SLOT_WAITING:
+                amap |= 1 << k
+        buf[4] = expected
+        buf[5] = amap
+        self._ack_pending = False
+        return flags | FLAG_ACK
+
+    def _transmit(self, now):
+        "Send what is due: new packets, timed out ones, then a bare ack if still owed."
+        lu = self.lu
+        for k in range(self.pending):
+            if not lu.can_send():
+                return
+            seq = (self._base + k) & 0xff
+            i = seq & self._mask
+            tries = self._tx_tries[i]
+            if self._tx_state[i] != SLOT_WAITING:
+                continue
+            if tries:
+                if ticks_diff(now, self._tx_due[i]) < 0:
+                    continue
+                if self.max_retries is not None and tries > self.max_retries:
+                    self._give_up()
+                    break
+                self.retransmits += 1
+            size = self._tx_len[i]
+            buf = self._tx_bufs[i]
+            buf[0] = ARQ_MAGIC
+            buf[2] = seq
+            buf[3] = self._base
+            buf[1] = self._ack_fields(buf, FLAG_DATA)
+            lu.send_packet(self.src_address, self.dst_address,
+                           memoryview(buf)[:SUBHEADER_LENGTH + size])
+            # a random extra of up to a packet's airtime keeps two nodes that lost
+            # packets to each other from retrying in lockstep
+            self._tx_due[i] = ticks_add(now, (self.rto_ms(size) << min(tries, ARQ_MAX_BACKOFF)) +
+                                        (getrandbits(8) * self._airtime_ms(size) >> 8))
+            self._tx_tries[i] = min(tries + 1, 0xff)
+            self.sent += 1
+        if self._ack_pending and ticks_diff(now, self._ack_due) >= 0 and lu.can_send():
+            buf = self._ackbuf
+            buf[1] = self._ack_fields(buf, 0)
+            lu.send_packet(self.src_address, self.dst_address, buf)
+            self.acks_sent += 1
+
+    def _give_up(self):
+        "Drop every unacknowledged packet: the peer is gone or out of reach."
+        for k in range(self.pending):
+            self._tx_state[(self._base + k) & self._mask] = SLOT_EMPTY
+        self.failed += self.pending
+        # the peer sees the next base past what it expects and resynchronizes
+        self._base = self._next
+
+    def service(self):
+        "Send, retransmit and acknowledge as due. Call regularly from the main loop."
+        self._transmit(ticks_ms())
+
+    def _on_ack(self, ack_base, amap):
+        span = self.pending
+        advance = (ack_base - self._base) & 0xff
+        if advance > span:
+            return      # older than what we know, or not ours
+        window = self.window
+        mask = self._mask
+        for k in range(advance):
+            self._tx_state[(self._base + k) & mask] = SLOT_EMPTY
+        self.acked += advance
+        self._base = ack_base
+        span -= advance
+        for k in range(window - 1):
+            if amap & (1 << k) and k + 1 < span:
+                i = (ack_base + 1 + k) & mask
+                if self._tx_state[i] == SLOT_WAITING:
+                    self._tx_state[i] = SLOT_ACKED
+
+    def _on_data(self, seq, base, payload, now):
+        window = self.window
+        mask = self._mask
+        if not self._rx_synced or ((self._expected - base) & 0xff) > window:
+            # first packet heard, or the sender's base is not one we could have
+            # acknowledged up to: it restarted, or we did
+            if self._reading:
+                self._rx_state[self._read & mask] = SLOT_EMPTY
+                self._reading = False
+            for i in range(window):
+                self._rx_state[i] = SLOT_EMPTY
+            self._expected = base
+            self._read = base
+            self._rx_synced = True
+        # acknowledge every data packet, duplicates too: our last ack may have been lost
+        self._ack_pending = True
+        self._ack_due = ticks_add(now, self._ack_delay(len(payload)))
+        if ((seq - self._expected) & 0xff) >= 0x80:
+            self.duplicates += 1    # already delivered
+            return
+        if ((seq - self._read) & 0xff) >= window:
+            return      # beyond what we can hold until read() catches up, it comes again
+        i = seq & mask
+        if self._rx_state[i] != SLOT_EMPTY:
+            self.duplicates += 1
+            return
+        self._rx_bufs[i][:len(payload)] = payload
+        self._rx_len[i] = len(payload)
+        self._rx_state[i] = SLOT_WAITING
+        while self._rx_state[self._expected & mask] == SLOT_WAITING:
+            self._rx_state[self._expected & mask] = SLOT_READY
+            self._expected = (self._expected + 1) & 0xff
+            self.received += 1
+
+    def feed(self, pkt):
+        "Take in a received packet. Returns False if it is not for this link."
+        msg = pkt.msg
+        if len(msg) < SUBHEADER_LENGTH or msg[0] != ARQ_MAGIC or \
+                pkt.src_address != self.dst_address or pkt.dst_address != self.src_address:
+            return False
+        flags = msg[1]
+        if flags & FLAG_ACK:
+            self._on_ack(msg[4], msg[5])
+        now = ticks_ms()
+        if flags & FLAG_DATA:
+            self._on_data(msg[2], msg[3], msg[SUBHEADER_LENGTH:], now)
+        # freed window slots and owed acks go out now rather than at the next service()
+        self._transmit(now)
+        return True
+
+    def read(self):
+        "Return the next payload in order as a memoryview, or None."
+        window = self.window
+        mask = self._mask
+        if self._reading:
+            self._rx_state[self._read & mask] = SLOT_EMPTY
+            self._read = (self._read + 1) & 0xff
+            self._reading = False
+        if self._read == self._expected:
+            return None
+        i = self._read & mask
+        self._reading = True
+        return memoryview(self._rx_bufs[i])[:self._rx_len[i]]
@@ -0,0 +1,238 @@
+"Splits messages larger than one LoRa packet into fragments and puts them back together"
+
+from array import array
+from utime import sleep_ms, ticks_ms, ticks_diff
+from micropython import const
+
+# every fragment's payload starts with
+#   FRAGMENT_MAGIC, first line count, chunk size, total length (2 bytes, big endian)
+# and fragment i is sent with line count first + i, so its index is recovered from
+# src_line_count. Every fragment but the last carries exactly chunk size bytes
+FRAGMENT_MAGIC = const(0xfe)
+SUBHEADER_LENGTH = const(5)
+MAX_FRAGMENTS = const(256)  # line counts are 8 bits
+
+# reassembly slot states
+SLOT_FREE = const(0)
+SLOT_FILLING = const(1)
+SLOT_COMPLETE = const(2)
+SLOT_READING = const(3)
+
+class FragmentSender:
+    '''Sends one message as consecutive fragments through a LoraUtil.
+       data is a buffer, sent from a memoryview without copying, or an iterable of
+       buffers (e.g. a generator reading a file) with its total length given as length,
+       so the message never has to be in RAM at once. A message can be up to
+       max_length(lora_util) bytes. Call poll() until it returns True: each call
+       queues as many fragments as the transmit queue has room for'''
+    def __init__(self, lora_util, src_address, dst_address, data, length=None):
+        self.lu = lora_util
+        self.src_address = src_address
+        self.dst_address = dst_address
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            self._view = memoryview(data)
+            self._source = None
+            total = len(data) if length is None else min(length, len(data))
+        else:
+            if length is None:
+                raise ValueError('length is needed to stream a message')
+            self._view = None
+            self._source = iter(data)
+            total = length
+        self.chunk = min(lora_util.max_payload() - SUBHEADER_LENGTH, 0xff)
+        if self.chunk <= 0:
+            raise ValueError('packets too short for fragments: %d bytes'
+                             % lora_util.max_payload())
+        self.count = max((total + self.chunk - 1) // self.chunk, 1)
+        if total > MAX_FRAGMENTS * self.chunk:
+            raise ValueError('message too long: %d bytes, at most %d'
+                             % (total, MAX_FRAGMENTS * self.chunk))
+        self.total = total
+        self.first = lora_util.reserve_seq(self.count)
+        self.queued = 0     # fragments handed to the transmit queue so far
+        self.last_handle = None
+        self._pending = None    # what is left of the last chunk from the source
+        self._buf = bytearray(SUBHEADER_LENGTH + self.chunk)
+        self._buf[0] = FRAGMENT_MAGIC
+        self._buf[1] = self.first
+        self._buf[2] = self.chunk
+        self._buf[3] = total >> 8
+        self._buf[4] = total & 0xff
+
+    def _fill(self, size):
+        "Copy the next size bytes of a streamed message after the subheader."
+        buf = self._buf
+        pos = SUBHEADER_LENGTH
+        end = pos + size
+        while pos < end:
+            if not self._pending:
+                try:
+                    self._pending = memoryview(next(self._source))
+                except StopIteration:
+                    raise ValueError('stream ended before length bytes')
+                continue
+            n = min(len(self._pending), end - pos)
+            buf[pos:pos + n] = self._pending[:n]
+            self._pending = self._pending[n:]
+            pos += n
+
+    def poll(self):
+        "Queue the fragments that fit; True once all of them are queued."
+        lu = self.lu
+        while self.queued < self.count and lu.can_send():
+            offset = self.queued * self.chunk
+            size = min(self.chunk, self.total - offset)
+            if self._view is not None:
+                self._buf[SUBHEADER_LENGTH:SUBHEADER_LENGTH + size] = \
+                    self._view[offset:offset + size]
+            else:
+                self._fill(size)
+            self.last_handle = lu.send_packet(self.src_address, self.dst_address,
+                                              memoryview(self._buf)[:SUBHEADER_LENGTH + size],
+                                              seq=self.first + self.queued)
+            self.queued += 1
+        return self.queued == self.count
+
+    @property
+    def done(self):
+        "True once every fragment went out (or failed, see last_handle.status)"
+        return self.queued == self.count and self.last_handle is not None \
+            and self.last_handle.done
+
+def max_length(lora_util):
+    '''Largest message FragmentSender takes: MAX_FRAGMENTS fragments of one packet's
+       payload less the subheader, 62976 bytes with the default 255-byte packets'''
+    return MAX_FRAGMENTS * min(lora_util.max_payload() - SUBHEADER_LENGTH, 0xff)
+
+def send_message(lora_util, src_address, dst_address, data, length=None):
+    '''Send a message of up to max_length(lora_util) bytes and wait until it is queued.
+       Returns the FragmentSender, lora_util.flush() waits for it to go out'''
+    sender = FragmentSender(lora_util, src_address, dst_address, data, length)
+    while not sender.poll():
+        lora_util.service()
+        sleep_ms(10)
+    return sender
+
+class Reassembler:
+    '''Puts fragmented messages back together in preallocated buffers.
+       slots messages can be in progress at once, each up to max_size bytes; larger
+       messages are dropped unread. A message whose next fragment is more than
+       timeout_ms late is given up on.
+         feed(pkt) -> True if pkt was a fragment (it is consumed), False for other packets
+         read_message -> (src_address, memoryview) of the next complete message, or None
+         messages -> generator over the complete messages
+       A message's view is valid until the next read_message() or release()'''
+    def __init__(self, slots=2, max_size=4096, timeout_ms=30000):
+        self.max_size = max_size
+        self.timeout_ms = timeout_ms
+        self._bufs = [bytearray(max_size) for _ in range(slots)]
+        self._maps = [bytearray(MAX_FRAGMENTS // 8) for _ in range(slots)]   # fragments held
+        self._state = bytearray(slots)
+        self._src = bytearray(slots)
+        self._first = bytearray(slots)
+        self._total = array('H', bytes(2 * slots))
+        self._missing = array('H', bytes(2 * slots))
+        self._last = [0] * slots    # ticks_ms() of the latest fragment
+        self._ready = []            # complete slots, oldest first
+        self._reading = -1
+        self.completed = 0
+        self.timeouts = 0
+        self.duplicates = 0
+        self.dropped = 0    # fragments of messages too large, malformed or without a free slot
+
+    def _expire(self, now):
+        for i in range(len(self._state)):
+            if self._state[i] == SLOT_FILLING and \
+                    ticks_diff(now, self._last[i]) > self.timeout_ms:
+                self._state[i] = SLOT_FREE
+                self.timeouts += 1
+
+    def _slot(self, src, first, total, count, now):
+        "The slot collecting this message, a newly claimed one, or -1."
+        free = -1
+        for i in range(len(self._state)):
+            state = self._state[i]
+            if state == SLOT_FILLING and self._src[i] == src and self._first[i] == first \
+                    and self._total[i] == total:
+                return i
+            if state == SLOT_FREE and free < 0:
+                free = i
+        if free < 0:
+            self._expire(now)
+            for i in range(len(self._state)):
+                if self._state[i] == SLOT_FREE:
+                    free = i
+                    break
+        if free >= 0:
+            fmap = self._maps[free]
+            for j in range(len(fmap)):
+                fmap[j] = 0
+            self._state[free] = SLOT_FILLING
+            self._src[free] = src
+            self._first[free] = first
+            self._total[free] = total
+            self._missing[free] = count
+        return free
+
+    def feed(self, pkt):
+        "Take in a received packet. Returns False if it is not a fragment."
+        msg = pkt.msg
+        if len(msg) < SUBHEADER_LENGTH or msg[0] != FRAGMENT_MAGIC:
+            return False
+        first = msg[1]
+        chunk = msg[2]
+        total = (msg[3] << 8) | msg[4]
+        count = max((total + chunk - 1) // chunk, 1) if chunk else 0
+        index = (pkt.src_line_count - first) & 0xff
+        offset = index * chunk
+        size = len(msg) - SUBHEADER_LENGTH
+        if index >= count or total > self.max_size or size != min(chunk, total - offset):
+            self.dropped += 1
+            return True
+        now = ticks_ms()
+        i = self._slot(pkt.src_address, first, total, count, now)
+        if i < 0:
+            self.dropped += 1
+            return True
+        fmap = self._maps[i]
+        bit = 1 << (index & 7)
+        if fmap[index >> 3] & bit:
+            self.duplicates += 1
+            return True
+        fmap[index >> 3] |= bit
+        self._bufs[i][offset:offset + size] = msg[SUBHEADER_LENGTH:]
+        self._last[i] = now
+        self._missing[i] -= 1
+        if not self._missing[i]:
+            self._state[i] = SLOT_COMPLETE
+            self._ready.append(i)
+            self.completed += 1
+        return True
+
+    def service(self):
+        "Give up on messages whose fragments stopped coming, call now and then."
+        self._expire(ticks_ms())
+
+    def release(self):
+        "Free the buffer of the message read last."
+        if self._reading >= 0:
+            self._state[self._reading] = SLOT_FREE
+            self._reading = -1
+
+    def read_message(self):
+        "Return (src_address, memoryview) of the oldest complete message, or None."
+        self.release()
+        if not self._ready:
+            return None
+        i = self._ready.pop(0)
+        self._state[i] = SLOT_READING
+        self._reading = i
+        return self._src[i], memoryview(self._bufs[i])[:self._total[i]]
+
+    def messages(self):
+        "Yield each complete message as (src_address, memoryview), see read_message."
+        while True:
+            message = self.read_message()
+            if message is None:
+                return
+            yield message
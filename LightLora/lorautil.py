@@ -1,100 +1,868 @@
 "Provides lightweight management for sx1276 chips"
 
-from utime import sleep_ms
+from utime import sleep_ms, ticks_ms, ticks_add, ticks_diff
+from micropython import const
+import machine
+try:
+    import esp32
+except ImportError:
+    esp32 = None
+try:
+    from urandom import getrandbits
+except ImportError:
+    from random import getrandbits
 from LightLora import spicontrol, sx127x
+from LightLora.stats import LoraStats
 
+# what the receive queue does when a packet arrives and it is full
+RX_DROP_OLDEST = const(0)
+RX_DROP_NEWEST = const(1)
+
+# TxHandle.status
+TX_QUEUED = const(0)
+TX_SENDING = const(1)
+TX_DONE = const(2)
+TX_REJECTED = const(3)  # over the airtime budget with budget_policy TX_REJECT
+TX_TIMEOUT = const(4)   # no TxDone long after the packet's airtime
+TX_BUSY = const(5)      # listen-before-talk found the channel busy on every try
+
+BROADCAST = const(0xff)
+HEADER_LENGTH = const(4)    # src, dst, line count, payload length
+
+# what send_packet does with a packet that would exceed the airtime budget
+TX_DEFER = const(0)
+TX_REJECT = const(1)
+
+# extra wait on top of twice the airtime before a send counts as timed out
+TX_TIMEOUT_MARGIN_MS = const(100)
+
+# listen-before-talk: a busy channel doubles the backoff window (in packet airtimes)
+# up to LBT_MAX_WINDOW, a clear one halves it. LBT_MAX_TRIES busy results drop the packet
+LBT_MAX_WINDOW = const(32)
+LBT_MAX_TRIES = const(6)
+
+# RX sniff: where the radio is in its duty cycle
+SNIFF_IDLE = const(0)   # asleep, or busy sending
+SNIFF_CAD = const(1)
+SNIFF_RX = const(2)
+# sniff_estimate() radio model, SX1276 datasheet typicals
+SNIFF_RX_UA = const(11500)      # receive and CAD current, uA
+SNIFF_SLEEP_UA = const(1)
+SNIFF_WAKE_US = const(1500)     # sleep to CAD, oscillator start and settling
+SNIFF_MARGIN_SYMBOLS = const(8) # wake preamble beyond the interval: CAD plus detection
 
 
 class LoraPacket:
-    def __init__(self):
+    '''A received packet. LoraUtil hands out packets from a preallocated pool:
+       msg is a memoryview into the packet's own receive buffer, valid until the
+       packet is released back to the pool (copy it with bytes(pkt.msg) to keep it).
+       rx_ticks_us is the ticks_us() of the RxDone interrupt, the end of the packet'''
+    __slots__ = ('src_address', 'dst_address', 'src_line_count', 'pay_length', 'msg',
+                 'rssi', 'rx_ticks_us', '_snr', '_txt', '_buf', '_length', '_owner', '_free')
+
+    def __init__(self, owner=None, size=0):
         self.src_address = None
         self.dst_address = None
         self.src_line_count = None
         self.pay_length = None
         self.msg = None
         self.rssi = None
-        self.snr = None
+        self.rx_ticks_us = 0
+        self._snr = 0       # raw register value, 0.25dB steps
+        self._txt = None
+        self._buf = bytearray(size)
+        self._length = 0
+        self._owner = owner
+        self._free = True
+
+    @property
+    def snr(self):
+        return self._snr * 0.25
 
     @property
     def msg_txt(self):
-        return self.msg.decode('utf-8', 'ignore')
+        "msg decoded as UTF-8, decoded once and cached"
+        if self._txt is None:
+            self._txt = str(self.msg, 'utf-8', 'ignore')
+        return self._txt
 
     def clear(self):
         self.msg = b''
+        self._txt = None
+
+    def release(self):
+        "Return the packet to its pool. Call from the main program, not an interrupt."
+        if self._owner and not self._free:
+            self.msg = None
+            self._txt = None
+            self._owner._release(self)
+
+class TxHandle:
+    '''Tracks one packet handed to send_packet.
+       callback(handle), if given, is called from the transmit interrupt once it went out'''
+    def __init__(self, seq, callback=None):
+        self.seq = seq
+        self.callback = callback
+        self.status = TX_QUEUED
+        self.airtime_us = 0
+
+    @property
+    def done(self):
+        return self.status >= TX_DONE
+
+    @property
+    def ok(self):
+        return self.status == TX_DONE
+
+class AirtimeBudget:
+    '''Sliding-window airtime accounting for duty-cycle limits.
+       A 1% duty cycle over an hour is AirtimeBudget(36000, 3600000).
+       The window is tracked as nbuckets fixed slices, so memory use is constant
+       and airtime leaves the window one slice at a time'''
+    def __init__(self, budget_ms, window_ms=3600000, nbuckets=20):
+        self.budget_us = budget_ms * 1000
+        self._slice_ms = max(window_ms // nbuckets, 1)
+        self._used = [0] * nbuckets     # airtime in us per slice
+        self._index = 0
+        self._slice_start = ticks_ms()
+
+    def _advance(self):
+        "Clear the slices that have left the window."
+        elapsed = ticks_diff(ticks_ms(), self._slice_start)
+        steps = elapsed // self._slice_ms
+        for _ in range(min(steps, len(self._used))):
+            self._index = (self._index + 1) % len(self._used)
+            self._used[self._index] = 0
+        if steps:
+            self._slice_start = ticks_add(self._slice_start, steps * self._slice_ms)
+
+    def used_us(self):
+        "Airtime spent within the window."
+        self._advance()
+        return sum(self._used)
+
+    def allows(self, airtime_us):
+        "True if airtime_us more fits in the budget now."
+        return self.used_us() + airtime_us <= self.budget_us
+
+    def record(self, airtime_us):
+        self._advance()
+        self._used[self._index] += airtime_us
+
+    def wait_ms(self, airtime_us):
+        "How long until airtime_us fits in the budget, 0 if it fits now."
+        excess = self.used_us() + airtime_us - self.budget_us
+        if excess <= 0:
+            return 0
+        n = len(self._used)
+        wait = self._slice_ms - ticks_diff(ticks_ms(), self._slice_start)
+        for i in range(1, n + 1):
+            excess -= self._used[(self._index + i) % n]     # oldest slice first
+            if excess <= 0:
+                return wait
+            wait += self._slice_ms
+        return wait
+
+def load_image(path=None):
+    '''The image save_image() kept, for LoraUtil(image=), or None if there is none.
+       From RTC memory unless a file path is given'''
+    try:
+        if path is None:
+            image = machine.RTC().memory()
+        else:
+            with open(path, 'rb') as f:
+                image = f.read()
+    except (OSError, AttributeError):
+        return None
+    return image if len(image) == sx127x.IMAGE_LENGTH else None
 
 class LoraUtil:
     '''a LoraUtil object has an sx1276 and it can send and receive LoRa packets
-       send_packet -> send a string
+       send_packet -> queue a packet for sending, returns a TxHandle
        is_packet_available -> do we have a packet available?
-       read_packet -> get the latest packet
+       read_packet -> get the oldest queued packet
+       read_packets -> drain the receive queue
+       Up to rx_queue_size received packets are queued,
+       rx_overflow (RX_DROP_OLDEST or RX_DROP_NEWEST) decides what a full queue drops.
+       Packets come from a pool: with auto_release they go back to it on the next
+       read_packet(s) call, otherwise call pkt.release() when done with each.
+       The pool is 2 * rx_queue_size buffers of 255 bytes (128 with split_fifo),
+       the queue and as many packets again handed out.
+       Outgoing packets wait in a tx_queue_size queue; each TxDone interrupt starts
+       the next one and the radio goes back to receive once the queue is empty.
+       An AirtimeBudget as airtime_budget holds back (TX_DEFER, sent later by
+       service()) or refuses (TX_REJECT) packets that would exceed it.
+       With lbt each packet waits for a clear channel activity detection, backing off
+       a random number of packet airtimes (sent later by service()) while it is busy.
+       sniff() duty-cycles the receiver instead of leaving it in continuous receive.
+       With split_fifo=True the FIFO is halved (frames up to 128 bytes) so a reply
+       can be loaded with stage_reply() while receiving and sent by send_staged().
+       stats=True (or a LoraStats) counts errors and timings instead of printing
+       them, read them with stats_snapshot().
+       With an address only packets for it, BROADCAST and accept_address() ones are
+       queued; the others are dropped after reading just their header.
+       fixed_length=n sends every payload padded to n bytes in implicit header mode,
+       which leaves out the radio's own header; every node must use the same n, at
+       most 251 (124 with split_fifo).
+       image, from save_image()/load_image(), warm starts the radio: no reset pulse
+       and no init() when the image is intact and the chip takes it
     '''
-    def __init__(self, **kwargs):
+    def __init__(self, rx_queue_size=4, rx_overflow=RX_DROP_OLDEST, tx_queue_size=4,
+                 airtime_budget=None, budget_policy=TX_DEFER, stats=False, address=None,
+                 auto_release=True, lbt=False, fixed_length=0, image=None, **kwargs):
         self.linecounter = 0
-        self.packet = None
+        self.fixed_length = fixed_length
+        # frame size for receive() and the header mode, 0 for explicit header
+        self._rx_size = HEADER_LENGTH + fixed_length if fixed_length else 0
         self.done_transmit = False
+        self.tx_dropped = 0     # packets refused by a full transmit queue
+        self.tx_rejected = 0    # packets refused by the airtime budget
+        self.tx_timeouts = 0
+        self.airtime_budget = airtime_budget
+        self.budget_policy = budget_policy
+        self._tx_deferred = False   # the head of the queue waits for airtime budget or backoff
+        self._tx_resume = 0         # ticks_ms() when service() tries a deferred send again
+        self._tx_started = 0
+        self.lbt = lbt
+        self._tx_cad = False        # a channel activity detection runs before the next send
+        self._lbt_window = 1
+        self._lbt_tries = 0
+        self.cad_busy = 0       # channel activity detections that found the channel busy
+        self.lbt_giveups = 0    # packets dropped as TX_BUSY
+        self._sniff_ms = 0      # RX sniff wake interval, 0 for continuous receive
+        self._sniff_state = SNIFF_IDLE
+        self._sniff_due = 0     # ticks_ms() of the next channel activity detection
+        self._sniff_until = 0   # ticks_ms() a CAD or receive window is given up
+        self.sniff_wakes = 0    # sniff windows that found a preamble
+        self._own_preamble = None   # the configured preamble length while a wake preamble is on
+        # transmit ring: send_packet fills the head, the interrupt takes from the tail
+        self._tx_frames = [None] * (tx_queue_size + 1)
+        self._tx_handles = [None] * (tx_queue_size + 1)
+        self._tx_head = 0
+        self._tx_tail = 0
+        self._tx_busy = False   # a frame is on air, the TxDone interrupt will start the next
+        self._tx_current = None
+        self._staged = None     # (frame, handle) from stage_reply
+        self._profile_next = None   # set_profile() waiting for the transmit queue to empty
+        # optional no-argument callables run from the interrupt when a received packet is
+        # queued (rx_notify) and when a packet to send is done with, sent or given up on
+        # (tx_notify); aiolora uses them to wake tasks
+        self.rx_notify = None
+        self.tx_notify = None
+        # optional per-link hooks, see adr.AdrPolicy: link_table.observe() is run for each
+        # packet queued, tx_configure(dst) before each frame goes out and
+        # tx_configure(None) before the radio receives again
+        self.link_table = None
+        self.tx_configure = None
+        # optional tx_gate(frame, airtime_us) run before each frame goes out, returning 0
+        # to send it now or the milliseconds to hold it, see tdma
+        self.tx_gate = None
+        self._rx_overflow = rx_overflow
+        # single producer (receive handler) single consumer (read_packet) rings, no locks:
+        # the handler moves the ready head and the free tail, read_packet and release
+        # move the ready tail and the free head. To drop the oldest, a handler that finds
+        # the ready ring full moves its tail too and reuses the oldest packet, unless it
+        # ran in the middle of read_packet taking that packet (_rx_taking).
+        # The pool has rx_queue_size more packets than the ring holds, for those handed out
+        nslots = rx_queue_size + 1
+        npkts = 2 * rx_queue_size
+        self._rx_dropped = 0
+        self._rx_ready = [None] * nslots
+        self._rx_head = 0   # next slot the interrupt fills
+        self._rx_tail = 0   # next slot read_packet returns
+        self._rx_taking = False
+        rx_size = sx127x.FifoSplitAddr if kwargs.get('split_fifo') else sx127x.MAX_PKT_LENGTH
+        self._rx_free = [LoraPacket(self, rx_size) for _ in range(npkts)] + [None]
+        self._free_head = npkts     # next slot release fills
+        self._free_tail = 0         # next packet the interrupt takes
+        self.auto_release = auto_release
+        self._rx_lent = []  # packets to release on the next read with auto_release
+        self._rx_hdr = bytearray(HEADER_LENGTH)
+        self._rx_accept = bytearray(32)     # bitmap of accepted destination addresses
+        self._rx_filter = False
+        self.rx_filtered = 0    # packets for other nodes, dropped unread
+        self.address = address
+        if address is not None:
+            self.accept_address(address)
+
+        self.stats = None
+        self._stats_base = (0, 0, 0, 0, 0, 0)
 
         # init spi
         self.spic = spicontrol.SpiControl(**kwargs)
         # init lora
         self.lora = sx127x.SX127x(spiControl=self.spic, **kwargs)
-        self.spic.init_lora_pins()
-        self.lora.init()
-        self.lora.onReceive(self._do_receive)
+        if stats:
+            self.attach_stats(LoraStats() if stats is True else stats)
+        self.spic.init_lora_pins(reset=image is None)
+        self.warm_started = image is not None and self.lora.restoreImage(image)
+        if not self.warm_started:
+            if image is not None:
+                self.spic.init_lora_pins()  # the chip lost its state, start from scratch
+            self.lora.init()
+        # the FIFO split is only known once the chip is set up
+        if fixed_length and not 0 < fixed_length <= self.lora.txCapacity() - HEADER_LENGTH:
+            raise ValueError('fixed_length must be 1 to %d'
+                             % (self.lora.txCapacity() - HEADER_LENGTH))
+        self.lora.onReceiveRaw(self._do_receive)
         self.lora.onTransmit(self._do_transmit)
+        self.lora.onCadDone(self._do_cad)
         # put into receive mode and wait for an interrupt
-        self.lora.receive()
-
-    def _do_receive(self, sx12, pay):
-        "Callback function triggered when we receive a packet to deal with it."
-        pkt = LoraPacket()
-        self.packet = None
-        if pay and len(pay) > 4:
-            pkt.src_address = pay[0]
-            pkt.dst_address = pay[1]
-            pkt.src_line_count = pay[2]
-            pkt.pay_length = pay[3]
-            pkt.rssi = sx12.packetRssi()
-            pkt.snr = sx12.packetSnr()
-            pkt.msg = pay[4:]  # Slice creates a new bytes object.
-            self.packet = pkt
+        self.lora.receive(self._rx_size)
+
+    @property
+    def rx_dropped(self):
+        "Packets lost to a full receive queue."
+        return self._rx_dropped
+
+    def _do_receive(self, sx12):
+        "Callback function triggered when we receive a packet."
+        self._queue_rx(sx12)
+        if self._sniff_state == SNIFF_RX:
+            self._sniff_state = SNIFF_IDLE  # got it, back to sleep until the next window
+            sx12.sleep()
+
+    def _queue_rx(self, sx12):
+        '''Queue the received packet into a pooled buffer. Reads the header first and
+           only unloads the rest of a packet it keeps. No buffer is allocated, only the
+           small memoryview slice that tells the SPI read how many bytes to take'''
+        length = sx12.rxPacketLength()
+        if length <= HEADER_LENGTH:
+            return      # too short for a header and a message
+        hdr = self._rx_hdr
+        sx12.readFifoInto(hdr)
+        if self._rx_size:
+            length = min(length, HEADER_LENGTH + hdr[3])    # leave the padding
+        dst = hdr[1]
+        if self._rx_filter and not self._rx_accept[dst >> 3] & (1 << (dst & 7)):
+            self.rx_filtered += 1
+            return
+        ready = self._rx_ready
+        head = self._rx_head
+        nxt = (head + 1) % len(ready)
+        if nxt == self._rx_tail:
+            self._rx_dropped += 1
+            if self._rx_overflow != RX_DROP_OLDEST or self._rx_taking:
+                return
+            # overwrite the oldest: its packet takes this one, a slot further on
+            tail = self._rx_tail
+            pkt = ready[tail]
+            ready[tail] = None
+            self._rx_tail = (tail + 1) % len(ready)
+        else:
+            ftail = self._free_tail
+            if ftail == self._free_head:
+                self._rx_dropped += 1   # every packet is still held
+                return
+            pkt = self._rx_free[ftail]
+            self._rx_free[ftail] = None
+            self._free_tail = (ftail + 1) % len(self._rx_free)
+        buf = pkt._buf
+        length = min(length, len(buf))
+        buf[0] = pkt.src_address = hdr[0]
+        buf[1] = pkt.dst_address = dst
+        buf[2] = pkt.src_line_count = hdr[2]
+        buf[3] = pkt.pay_length = hdr[3]
+        sx12.readFifoInto(memoryview(buf)[HEADER_LENGTH:length])
+        pkt._length = length
+        pkt.rx_ticks_us = sx12.lastIrqTicks
+        pkt.rssi = sx12.packetRssi()
+        pkt._snr = sx12.readRegister(sx127x.REG_PKT_SNR_VALUE, signed=True)
+        pkt._free = False
+        ready[head] = pkt
+        self._rx_head = nxt     # publish the packet only once it is filled
+        st = self.stats
+        if st:
+            st.rx_packets += 1
+            st.signal(pkt.rssi, pkt._snr)
+        if self.link_table:
+            self.link_table.observe(pkt.src_address, pkt.src_line_count, pkt.rssi, pkt._snr)
+        if self.rx_notify:
+            self.rx_notify()
 
     def _do_transmit(self):
         "Callback function triggered when transmission of a packet has ended."
+        handle = self._tx_current
+        if handle is None:
+            return      # already given up on by service()
+        self._tx_current = None
+        if self.stats:
+            self.stats.tx_packets += 1
+        self._finish_tx(handle, TX_DONE)
+        self._start_next_tx()
+
+    def _finish_tx(self, handle, status):
+        "Give handle its final status: sent, or given up on. Either way its queue slot is free."
+        handle.status = status
+        if handle.callback:
+            handle.callback(handle)
+        if self.tx_notify:
+            self.tx_notify()
+
+    def _take_tx(self):
+        "Remove the oldest queued frame, return (frame, handle)."
+        tail = self._tx_tail
+        frame = self._tx_frames[tail]
+        handle = self._tx_handles[tail]
+        self._tx_frames[tail] = None
+        self._tx_handles[tail] = None
+        self._tx_tail = (tail + 1) % len(self._tx_frames)
+        return frame, handle
+
+    def _start_next_tx(self):
+        "Start sending the oldest queued frame, or go back to receive if there is none to send now."
+        budget = self.airtime_budget
+        self._sniff_state = SNIFF_IDLE  # sending takes the radio out of any sniff window
+        while self._tx_tail != self._tx_head:
+            frame = self._tx_frames[self._tx_tail]
+            if self.tx_configure:
+                self.tx_configure(frame[1])
+            airtime = self.lora.timeOnAir(len(frame))
+            if budget and not budget.allows(airtime):
+                if self.budget_policy == TX_DEFER:
+                    self._defer_tx(budget.wait_ms(airtime))
+                    return
+                self.tx_rejected += 1
+                self._finish_tx(self._take_tx()[1], TX_REJECTED)
+                continue
+            if self.tx_gate:
+                wait_ms = self.tx_gate(frame, airtime)
+                if wait_ms:
+                    self._defer_tx(wait_ms)
+                    return
+            if self.lbt:
+                self._tx_cad = True
+                self._tx_started = ticks_ms()
+                self.lora.cad()     # _do_cad sends it if the channel is clear
+                return
+            self._send_head(airtime)
+            return
+        self._tx_busy = False
         self.done_transmit = True
-        self.lora.receive() # wait for a packet (?)
+        if self._profile_next is not None:
+            self._switch_profile()
+        self._listen() # wait for a packet
+
+    def _listen(self):
+        "Wait for packets: continuous receive, or asleep until the next sniff window."
+        if self.tx_configure:
+            self.tx_configure(None)
+        if self._sniff_ms:
+            self._sniff_state = SNIFF_IDLE
+            self.lora.sleep()
+        else:
+            self.lora.receive(self._rx_size)
+
+    def _send_head(self, airtime):
+        "Put the oldest queued frame on air."
+        frame, handle = self._take_tx()
+        self._mark_sending(handle, airtime)
+        self.lora.beginPacket(self._rx_size > 0)
+        self.lora.write(frame)
+        self.lora.endPacket()
+
+    def _mark_sending(self, handle, airtime):
+        handle.airtime_us = airtime
+        handle.status = TX_SENDING
+        if self.airtime_budget:
+            self.airtime_budget.record(airtime)
+        self._tx_current = handle
+        self._tx_started = ticks_ms()
+
+    def _defer_tx(self, wait_ms):
+        "Listen while the oldest queued frame waits, service() retries it after wait_ms."
+        self._tx_resume = ticks_add(ticks_ms(), wait_ms)
+        self._tx_deferred = True
+        self._listen()
+
+    def _do_cad(self, detected):
+        "Callback at the end of a channel activity detection, before a send or in a sniff window."
+        if not self._tx_cad:
+            if self._sniff_state == SNIFF_CAD:
+                self._sniff_cad(detected)
+            return      # otherwise already given up on by service()
+        self._tx_cad = False
+        airtime = self.lora.timeOnAir(len(self._tx_frames[self._tx_tail]))
+        if not detected:
+            self._lbt_tries = 0
+            self._lbt_window = max(self._lbt_window >> 1, 1)
+            self._send_head(airtime)
+            return
+        self.cad_busy += 1
+        self._lbt_window = min(self._lbt_window << 1, LBT_MAX_WINDOW)
+        if self._lbt_give_up():
+            return
+        slots = 1 + getrandbits(8) % self._lbt_window
+        self._defer_tx(slots * (airtime // 1000 + 1))
+
+    def _lbt_give_up(self):
+        "Count a try that did not send; after LBT_MAX_TRIES drop the packet as TX_BUSY."
+        self._lbt_tries += 1
+        if self._lbt_tries < LBT_MAX_TRIES:
+            return False
+        self._lbt_tries = 0
+        self.lbt_giveups += 1
+        self._finish_tx(self._take_tx()[1], TX_BUSY)
+        self._start_next_tx()
+        return True
+
+    def _cad_ms(self):
+        "How long a channel activity detection may take before its CadDone counts as lost."
+        return (2 * self.lora.symbolTime() + SNIFF_WAKE_US) // 1000 + TX_TIMEOUT_MARGIN_MS
+
+    def _sniff_cad(self, detected):
+        if detected:
+            self.sniff_wakes += 1
+            self._sniff_state = SNIFF_RX
+            # the rest of the wake preamble plus the longest packet
+            self._sniff_until = ticks_add(ticks_ms(), self.lora.timeOnAir(sx127x.MAX_PKT_LENGTH)
+                                          // 1000 + TX_TIMEOUT_MARGIN_MS)
+            self.lora.receive(self._rx_size)
+        else:
+            self._sniff_state = SNIFF_IDLE
+            self.lora.sleep()
+
+    def _sniff_service(self):
+        now = ticks_ms()
+        state = self._sniff_state
+        if state == SNIFF_IDLE:
+            if ticks_diff(now, self._sniff_due) >= 0:
+                self._sniff_due = ticks_add(now, self._sniff_ms)
+                self._sniff_until = ticks_add(now, self._cad_ms())
+                self._sniff_state = SNIFF_CAD
+                self.lora.cad()
+        elif ticks_diff(now, self._sniff_until) >= 0:
+            self._sniff_state = SNIFF_IDLE  # no CadDone, or a preamble without a packet
+            self.lora.sleep()
+
+    def sniff(self, interval_ms):
+        '''Duty-cycle the receiver: sleep, and every interval_ms run a channel activity
+           detection, receiving only when it hears a preamble. Windows are opened by
+           service(), so call it (or lightsleep()) from the main loop. Senders need a
+           preamble that spans interval_ms, see wake_preamble(); this radio uses one too.
+           interval_ms=0 returns to continuous receive. Returns sniff_estimate(interval_ms)'''
+        self._sniff_ms = interval_ms
+        self.wake_preamble(interval_ms)
+        self._sniff_due = ticks_ms()
+        if interval_ms and esp32:
+            esp32.wake_on_ext0(pin=self.lora.irqPin, level=esp32.WAKEUP_ANY_HIGH)
+        if not self._tx_busy:
+            self._listen()
+        return self.sniff_estimate(interval_ms) if interval_ms else None
+
+    def wake_preamble(self, interval_ms):
+        '''Send with a preamble long enough for a receiver sniffing every interval_ms
+           to catch. interval_ms=0 restores the preamble length configured before'''
+        if interval_ms:
+            if self._own_preamble is None:
+                self._own_preamble = self.lora.parameters['preamble_length']
+            length = min(interval_ms * 1000 // self.lora.symbolTime() + SNIFF_MARGIN_SYMBOLS,
+                         0xffff)
+        elif self._own_preamble is not None:
+            length, self._own_preamble = self._own_preamble, None
+        else:
+            return
+        self.lora.setPreambleLength(length)
+
+    def sniff_estimate(self, interval_ms):
+        '''Expected average radio current (uA) and worst case delivery latency (ms) of
+           sniff(interval_ms) with the current modem settings, as a dict. Datasheet
+           typicals, ignoring the MCU and the cost of receiving actual packets'''
+        active_us = 2 * self.lora.symbolTime() + SNIFF_WAKE_US  # a CAD takes about 2 symbols
+        period_us = max(interval_ms * 1000, active_us)
+        current_ua = (active_us * SNIFF_RX_UA + (period_us - active_us) * SNIFF_SLEEP_UA) \
+                     // period_us
+        preamble = min(interval_ms * 1000 // self.lora.symbolTime() + SNIFF_MARGIN_SYMBOLS,
+                       0xffff)
+        return {
+            'current_ua': current_ua,
+            'continuous_ua': SNIFF_RX_UA,
+            'latency_ms': self.lora.timeOnAir(sx127x.MAX_PKT_LENGTH, preamble) // 1000,
+            'preamble_length': preamble,
+        }
+
+    def lightsleep(self, max_ms=None):
+        '''Put the MCU in machine.lightsleep until the next sniff window is due, DIO0
+           rises (where esp32.wake_on_ext0 is available) or max_ms passed, then run
+           service(). Returns at once while packets are queued or being sent'''
+        ms = 0
+        if self._sniff_ms and not self._tx_busy and not self.is_packet_available():
+            until = self._sniff_due if self._sniff_state == SNIFF_IDLE else self._sniff_until
+            ms = ticks_diff(until, ticks_ms())
+            if max_ms is not None:
+                ms = min(ms, max_ms)
+        if ms > 0:
+            machine.lightsleep(ms)
+        self.service()
+
+    def service(self):
+        '''Housekeeping to call regularly from the main loop (AsyncLora does):
+           sends packets held back by the airtime budget or a listen-before-talk
+           backoff once due, gives up on a send whose TxDone never came, twice its
+           airtime later, and opens the RX sniff windows'''
+        handle = self._tx_current
+        if handle and ticks_diff(ticks_ms(), self._tx_started) > \
+                2 * handle.airtime_us // 1000 + TX_TIMEOUT_MARGIN_MS:
+            if not self.stats:
+                print("Transmit timeout")
+            self._tx_current = None
+            self.tx_timeouts += 1
+            self._finish_tx(handle, TX_TIMEOUT)
+            self._start_next_tx()
+        elif self._tx_cad and ticks_diff(ticks_ms(), self._tx_started) > self._cad_ms():
+            self._tx_cad = False    # no CadDone: a try used up, detect again
+            if not self._lbt_give_up():
+                self._start_next_tx()
+        elif self._tx_deferred and handle is None and \
+                ticks_diff(ticks_ms(), self._tx_resume) >= 0:
+            self._tx_deferred = False
+            self._start_next_tx()
+        elif self._sniff_ms and handle is None and not self._tx_cad:
+            self._sniff_service()
+
+    def accept_address(self, address, accept=True):
+        '''Add (or with accept=False remove) a destination address the receive filter
+           lets through. The first call turns the filter on, accepting BROADCAST too'''
+        if not self._rx_filter:
+            self._rx_accept[BROADCAST >> 3] |= 1 << (BROADCAST & 7)
+        if accept:
+            self._rx_accept[address >> 3] |= 1 << (address & 7)
+        else:
+            self._rx_accept[address >> 3] &= ~(1 << (address & 7)) & 0xff
+        self._rx_filter = True
+
+    def accept_all(self):
+        "Turn the receive address filter off, every packet is queued."
+        self._rx_filter = False
+        for i in range(len(self._rx_accept)):
+            self._rx_accept[i] = 0
+
+    def attach_stats(self, st):
+        "Count into a LoraStats (None detaches) from the SPI, radio and queue code."
+        self.stats = st
+        self.lora.stats = st
+        self.spic.stats = st
+        self._stats_base = self._queue_counts()
+
+    def _queue_counts(self):
+        return (self.rx_dropped, self.tx_dropped, self.tx_rejected, self.tx_timeouts,
+                self.lora.irqOverruns, self.rx_filtered)
+
+    def stats_snapshot(self, reset=False):
+        '''A dict of the attached LoraStats plus the queue drop counters, all since
+           the last reset. reset=True starts a new period'''
+        snap = self.stats.snapshot() if self.stats else {}
+        base = self._stats_base
+        counts = self._queue_counts()
+        snap['rx_dropped'] = counts[0] - base[0]
+        snap['tx_dropped'] = counts[1] - base[1]
+        snap['tx_rejected'] = counts[2] - base[2]
+        snap['tx_timeouts'] = counts[3] - base[3]
+        snap['irq_overruns'] = counts[4] - base[4]
+        snap['rx_filtered'] = counts[5] - base[5]
+        if reset:
+            if self.stats:
+                self.stats.reset()
+            self._stats_base = counts
+        return snap
+
+    def set_profile(self, profile):
+        '''Switch to a named modem profile (see sx127x.PROFILES) between packets, then keep
+           listening. While packets are queued or on air the switch waits until the last is sent'''
+        if not isinstance(profile, sx127x.ModemProfile) and profile not in sx127x.PROFILES \
+                and profile not in self.lora._profiles:
+            raise KeyError(profile)
+        self._profile_next = profile
+        if not self._tx_busy:
+            self._switch_profile()
+            self._listen()
+
+    def _switch_profile(self):
+        if self.tx_configure:
+            self.tx_configure(None)     # back to the settings the profile builds on
+        self.lora.applyProfile(self._profile_next)
+        self._profile_next = None
+
+    def save_image(self, path=None):
+        '''Keep the radio's configuration for a warm start, see load_image().
+           Stored in RTC memory (kept over deep sleep) unless a file path is given'''
+        image = self.lora.captureImage()
+        if path is None:
+            machine.RTC().memory(image)
+        else:
+            with open(path, 'wb') as f:
+                f.write(image)
+        return image
 
     def write_int(self, value):
         "Write an int (generally as a 2-byte) using the LoRa driver."
         self.lora.write(bytearray([value]))
 
-    def send_packet(self, src_address, dst_address, outgoing_payload):
-        "Send a packet of header info and a bytearray to dst_address."
-        try:
-            self.linecounter = self.linecounter + 1
+    def _make_frame(self, src_address, dst_address, outgoing_payload, seq=None):
+        "The header and as much of the payload as fits in one frame."
+        if seq is None:
+            self.linecounter = (self.linecounter + 1) & 0xff
+            seq = self.linecounter
+        size = min(len(outgoing_payload), self.max_payload())
+        frame = bytearray(HEADER_LENGTH + (self.fixed_length or size))
+        frame[0] = src_address
+        frame[1] = dst_address
+        frame[2] = seq & 0xff
+        frame[3] = size
+        frame[HEADER_LENGTH:HEADER_LENGTH + size] = outgoing_payload[:size]
+        return frame
+
+    def send_packet(self, src_address, dst_address, outgoing_payload, callback=None, seq=None):
+        '''Queue a packet of header info and a bytearray for dst_address and return at once.
+           seq overrides the line count, see reserve_seq(). Call service() regularly:
+           a packet whose TxDone never comes is only given up on there.
+           Returns a TxHandle, or None if the transmit queue is full'''
+        if not self.can_send():
+            self.tx_dropped += 1
+            return None
+        frame = self._make_frame(src_address, dst_address, outgoing_payload, seq)
+        return self._queue_frame(frame, TxHandle(frame[2], callback))
+
+    def reserve_seq(self, count):
+        '''Reserve count consecutive line counts for send_packet(seq=) and return the
+           first; packets sent meanwhile without seq use the ones after them'''
+        first = (self.linecounter + 1) & 0xff
+        self.linecounter = (self.linecounter + count) & 0xff
+        return first
+
+    def max_payload(self):
+        "Largest payload send_packet sends in one packet, the rest is cut off."
+        capacity = self.lora.txCapacity() - HEADER_LENGTH
+        return min(self.fixed_length, capacity) if self.fixed_length else capacity
+
+    def _queue_frame(self, frame, handle):
+        head = self._tx_head
+        self._tx_frames[head] = frame
+        self._tx_handles[head] = handle
+        self._tx_head = (head + 1) % len(self._tx_frames)
+        self.done_transmit = False
+        # start sending unless the TxDone handler is already working through the queue.
+        # The head moved first, so a TxDone handler running between these lines sends it
+        start = not self._tx_busy
+        self._tx_busy = True
+        if start:
+            self._start_next_tx()
+        return handle
+
+    def stage_reply(self, src_address, dst_address, outgoing_payload, callback=None):
+        '''With split_fifo, build a packet now and load it into the radio's TX half while
+           it keeps receiving, so send_staged() can put it on air with a few register
+           writes, e.g. an acknowledgement prepared before the packet it answers.
+           Returns its TxHandle'''
+        frame = self._make_frame(src_address, dst_address, outgoing_payload)
+        handle = TxHandle(frame[2], callback)
+        self._staged = (frame, handle)
+        if not self._tx_busy and not self._sniff_ms:
+            self.lora.stageTx(frame)
+        return handle
+
+    def send_staged(self):
+        '''Send the packet prepared by stage_reply(): straight from the FIFO when the
+           radio is free to send at once, otherwise through the transmit queue.
+           Returns its TxHandle, or None if there is none or the queue is full'''
+        if self._staged is None:
+            return None
+        frame, handle = self._staged
+        self._staged = None
+        if self.tx_configure and not self._tx_busy:
+            self.tx_configure(frame[1])
+        airtime = self.lora.timeOnAir(len(frame))
+        budget = self.airtime_budget
+        if not self._tx_busy and not self.lbt and not self.tx_gate and \
+                self.lora.hasStaged() and not (budget and not budget.allows(airtime)):
+            self._tx_busy = True
             self.done_transmit = False
-            self.lora.beginPacket()
-            self.write_int(src_address)
-            self.write_int(dst_address)
-            self.write_int(self.linecounter)
-            self.write_int(len(outgoing_payload))
-            self.lora.write(outgoing_payload)
-            self.lora.endPacket()
-            slt = 0
-            while (not self.done_transmit) and (slt < 50):
-                sleep_ms(100)
-                slt = slt + 1
-            if slt == 50:
-                print("Transmit timeout")
-        except Exception as ex:
-            print(str(ex))
+            self._sniff_state = SNIFF_IDLE
+            self._mark_sending(handle, airtime)
+            self.lora.sendStaged(self._rx_size > 0)
+            return handle
+        if not self.can_send():
+            self.tx_dropped += 1
+            return None
+        return self._queue_frame(frame, handle)
+
+    def can_send(self):
+        "True if the transmit queue has room for another packet."
+        return (self._tx_head + 1) % len(self._tx_frames) != self._tx_tail
+
+    def is_transmitting(self):
+        "True while packets are on air or waiting in the transmit queue."
+        return self._tx_busy
+
+    def flush(self, timeout_ms=None):
+        '''Wait until the transmit queue is empty. Returns False on timeout.
+           The default timeout is twice the airtime of what is queued, plus margin'''
+        if timeout_ms is None:
+            timeout_ms = self.queued_airtime_us() // 500 + TX_TIMEOUT_MARGIN_MS
+            if self._tx_current:
+                timeout_ms += self._tx_current.airtime_us // 500
+        end = ticks_add(ticks_ms(), timeout_ms)
+        while self._tx_busy and ticks_diff(end, ticks_ms()) > 0:
+            self.service()
+            sleep_ms(10)
+        return not self._tx_busy
+
+    def queued_airtime_us(self):
+        "Total airtime of the packets waiting in the transmit queue."
+        total = 0
+        i = self._tx_tail
+        while i != self._tx_head:
+            total += self.lora.timeOnAir(len(self._tx_frames[i]))
+            i = (i + 1) % len(self._tx_frames)
+        return total
 
     def is_packet_available(self):
         "Indicates whether a packet is available; use read_packet() to get it."
-        return bool(self.packet)
+        return self._rx_head != self._rx_tail
 
     def read_packet(self):
-        "Return the current packet (or None) and clear it out."
-        pkt = self.packet
-        self.packet = None
+        '''Return the oldest queued packet (or None) and remove it from the queue.
+           With auto_release the packets returned by the previous call go back to the pool'''
+        self._release_lent()
+        return self._take_packet()
+
+    def read_packets(self, max_count=None):
+        "Drain up to max_count (default all) queued packets, oldest first, as a list."
+        self._release_lent()
+        pkts = []
+        while max_count is None or len(pkts) < max_count:
+            pkt = self._take_packet()
+            if pkt is None:
+                break
+            pkts.append(pkt)
+        return pkts
+
+    def _take_packet(self):
+        ready = self._rx_ready
+        self._rx_taking = True  # the receive handler leaves the tail alone meanwhile
+        tail = self._rx_tail
+        if tail == self._rx_head:
+            self._rx_taking = False
+            return None
+        pkt = ready[tail]
+        ready[tail] = None
+        self._rx_tail = (tail + 1) % len(ready)
+        self._rx_taking = False
+        pkt.msg = memoryview(pkt._buf)[HEADER_LENGTH:pkt._length]
+        pkt._txt = None
+        if self.auto_release:
+            self._rx_lent.append(pkt)
         return pkt
 
+    def _release_lent(self):
+        lent = self._rx_lent
+        while lent:
+            lent.pop().release()
+
+    def _release(self, pkt):
+        "Put a packet back in the free ring, the receive handler takes it from there."
+        pkt._free = True
+        head = self._free_head
+        self._rx_free[head] = pkt
+        self._free_head = (head + 1) % len(self._rx_free)
+
@@ -0,0 +1,205 @@
+"Multi-hop flooding: relays rebroadcast packets they have not seen, best placed relay first"
+
+from array import array
+from utime import ticks_ms, ticks_add, ticks_diff
+from micropython import const
+try:
+    from urandom import getrandbits
+except ImportError:
+    from random import getrandbits
+from LightLora.lorautil import BROADCAST, HEADER_LENGTH
+
+# every mesh packet's payload starts with MESH_MAGIC, hops left, hops taken.
+# The LoRa header is the originator's: relays keep its src_address, dst_address and
+# line count, so (src_address, src_line_count) names a packet all over the mesh
+MESH_MAGIC = const(0xfb)
+SUBHEADER_LENGTH = const(3)
+# a relay waits longer the stronger it heard a packet: a distant relay, which adds the
+# most coverage, goes first and the others hear it and cancel their copies
+RSSI_FAR = const(-120)
+RSSI_NEAR = const(-40)
+
+class SeenCache:
+    '''Recently seen (src_address, line count) pairs, in sets of ways entries kept in
+       least recently used order: a lookup touches one set, so it takes the same time
+       however large the cache, and nothing is allocated. sets must be a power of two.
+       It should hold fewer packets than a node sends before its line count wraps'''
+    def __init__(self, sets=16, ways=4):
+        self.ways = ways
+        self._mask = sets - 1
+        self._keys = array('I', bytes(4 * sets * ways))    # 0x10000 | src << 8 | seq, 0 if empty
+
+    def check(self, src, seq):
+        "True if (src, seq) was seen before. Either way it becomes the most recent entry."
+        key = 0x10000 | (src << 8) | seq
+        keys = self._keys
+        start = ((seq + src * 37) & self._mask) * self.ways
+        end = start + self.ways - 1
+        pos = end   # not found: the least recently used entry makes room
+        for i in range(start, end + 1):
+            if keys[i] == key:
+                pos = i
+                break
+        seen = keys[pos] == key
+        while pos > start:
+            keys[pos] = keys[pos - 1]
+            pos -= 1
+        keys[start] = key
+        return seen
+
+class MeshRelay:
+    '''Sends, receives and relays mesh packets over a LoraUtil for the node at address.
+       A packet is rebroadcast (at most max_hops times on its way) by every relay that
+       hears it for the first time, after a delay that grows with its RSSI, unless the
+       relay hears another relay's copy first. Relays must not filter by address.
+         send(dst_address, payload) -> TxHandle of a new packet, or None if the queue is full
+         feed(pkt) -> True if pkt was a mesh packet (it is consumed), False otherwise
+         read() -> (src_address, hops, memoryview) of the next packet for this node
+       pending rebroadcasts wait in slots buffers; inbox packets for this node are
+       held until read, the view is valid until the next read().
+       delay_ms is the longest rebroadcast wait, by default four airtimes of the packet.
+       Call service() regularly: it sends the rebroadcasts that are due'''
+    def __init__(self, lora_util, address, max_hops=3, cache=None, slots=4, inbox=4,
+                 delay_ms=None):
+        self.lu = lora_util
+        self.address = address
+        self.max_hops = max_hops
+        self.cache = cache if cache is not None else SeenCache()
+        self.delay_ms = delay_ms
+        size = lora_util.max_payload()
+        if size <= SUBHEADER_LENGTH:
+            raise ValueError('packets too short for the mesh: %d bytes' % size)
+        # rebroadcasts waiting for their delay
+        self._fwd_bufs = [bytearray(size) for _ in range(slots)]
+        self._fwd_len = bytearray(slots)
+        self._fwd_hdr = bytearray(3 * slots)     # src, dst, line count
+        self._fwd_due = [0] * slots
+        self._fwd_used = bytearray(slots)
+        # packets for this node, a ring
+        self._in_bufs = [bytearray(size - SUBHEADER_LENGTH) for _ in range(inbox + 1)]
+        self._in_len = bytearray(inbox + 1)
+        self._in_src = bytearray(inbox + 1)
+        self._in_hops = bytearray(inbox + 1)
+        self._in_head = 0
+        self._in_tail = 0
+        self._reading = False
+        self._txbuf = bytearray(size)
+        self.relayed = 0
+        self.cancelled = 0      # rebroadcasts dropped because another relay went first
+        self.duplicates = 0
+        self.dropped = 0        # rebroadcasts or inbox packets without a free slot
+
+    def send(self, dst_address, payload, max_hops=None):
+        '''Originate a packet to dst_address (or BROADCAST) through the mesh.
+           Returns its TxHandle, or None if the transmit queue is full'''
+        if not self.lu.can_send():
+            return None
+        size = min(len(payload), len(self._txbuf) - SUBHEADER_LENGTH)
+        buf = self._txbuf
+        buf[0] = MESH_MAGIC
+        buf[1] = self.max_hops if max_hops is None else max_hops
+        buf[2] = 0
+        buf[SUBHEADER_LENGTH:SUBHEADER_LENGTH + size] = payload[:size]
+        seq = self.lu.reserve_seq(1)
+        self.cache.check(self.address, seq)     # so our own packet coming back is ignored
+        return self.lu.send_packet(self.address, dst_address,
+                                   memoryview(buf)[:SUBHEADER_LENGTH + size], seq=seq)
+
+    def _cancel(self, src, seq):
+        hdr = self._fwd_hdr
+        for i in range(len(self._fwd_used)):
+            if self._fwd_used[i] and hdr[3 * i] == src and hdr[3 * i + 2] == seq:
+                self._fwd_used[i] = 0
+                self.cancelled += 1
+
+    def _deliver(self, src, hops, payload):
+        head = self._in_head
+        nxt = (head + 1) % len(self._in_bufs)
+        if nxt == self._in_tail:    # full; the tail is also the packet being read
+            self.dropped += 1
+            return
+        self._in_bufs[head][:len(payload)] = payload
+        self._in_len[head] = len(payload)
+        self._in_src[head] = src
+        self._in_hops[head] = hops
+        self._in_head = nxt
+
+    def _delay(self, rssi, length):
+        window = self.delay_ms
+        if window is None:
+            window = 4 * self.lu.lora.timeOnAir(HEADER_LENGTH + length) // 1000
+        rssi = min(max(rssi, RSSI_FAR), RSSI_NEAR)
+        # a random extra of up to 1/8 of the window splits relays that heard it alike
+        return (rssi - RSSI_FAR) * window // (RSSI_NEAR - RSSI_FAR) + \
+            (getrandbits(8) * window >> 11)
+
+    def feed(self, pkt):
+        "Take in a received packet. Returns False if it is not a mesh packet."
+        msg = pkt.msg
+        if len(msg) < SUBHEADER_LENGTH or msg[0] != MESH_MAGIC:
+            return False
+        src = pkt.src_address
+        seq = pkt.src_line_count
+        if self.cache.check(src, seq):
+            self.duplicates += 1
+            self._cancel(src, seq)
+            return True
+        dst = pkt.dst_address
+        hops_left = msg[1]
+        hops = msg[2] + 1
+        if dst == self.address or dst == BROADCAST:
+            self._deliver(src, hops, msg[SUBHEADER_LENGTH:])
+            if dst == self.address:
+                return True
+        if not hops_left:
+            return True
+        for i in range(len(self._fwd_used)):
+            if not self._fwd_used[i]:
+                break
+        else:
+            self.dropped += 1
+            return True
+        buf = self._fwd_bufs[i]
+        buf[:len(msg)] = msg
+        buf[1] = hops_left - 1
+        buf[2] = hops
+        self._fwd_len[i] = len(msg)
+        self._fwd_hdr[3 * i] = src
+        self._fwd_hdr[3 * i + 1] = dst
+        self._fwd_hdr[3 * i + 2] = seq
+        self._fwd_due[i] = ticks_add(ticks_ms(), self._delay(pkt.rssi, len(msg)))
+        self._fwd_used[i] = 1
+        return True
+
+    def service(self):
+        "Rebroadcast the packets whose delay is over. Call regularly from the main loop."
+        now = ticks_ms()
+        lu = self.lu
+        hdr = self._fwd_hdr
+        for i in range(len(self._fwd_used)):
+            if self._fwd_used[i] and ticks_diff(now, self._fwd_due[i]) >= 0:
+                if not lu.can_send():
+                    return
+                self._fwd_used[i] = 0
+                lu.send_packet(hdr[3 * i], hdr[3 * i + 1],
+                               memoryview(self._fwd_bufs[i])[:self._fwd_len[i]],
+                               seq=hdr[3 * i + 2])
+                self.relayed += 1
+
+    @property
+    def pending(self):
+        "Rebroadcasts waiting for their delay"
+        return sum(self._fwd_used)
+
+    def read(self):
+        "Return (src_address, hops, memoryview) of the next packet for this node, or None."
+        n = len(self._in_bufs)
+        if self._reading:
+            self._in_tail = (self._in_tail + 1) % n
+            self._reading = False
+        tail = self._in_tail
+        if tail == self._in_head:
+            return None
+        self._reading = True
+        return self._in_src[tail], self._in_hops[tail], \
+            memoryview(self._in_bufs[tail])[:self._in_len[tail]]
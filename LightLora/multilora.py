@@ -0,0 +1,84 @@
+"Runs several sx127x radios side by side, e.g. a gateway listening on more than one channel"
+
+from LightLora import spicontrol, lorautil
+
+class MultiLora:
+    '''Several radios, each a LoraUtil with its own chip select, DIO0 pin and handlers.
+       configs is a sequence of dicts of LoraUtil keyword arguments, one per radio;
+       common keyword arguments apply to all of them. Radios with the same spi_id
+       (default 1) share one SpiBus unless a config brings its own bus=.
+       A config may name a 'profile' (see sx127x.PROFILES) to apply after start-up.
+         read_packet -> (radio index, packet) of the next packet from any radio
+         send_packet -> queue on radio tx_radio (or the one given); the others keep listening
+       A packet stays valid until its radio is read again, as with LoraUtil
+    '''
+    def __init__(self, configs, tx_radio=0, **common):
+        self.buses = {}
+        self.radios = []
+        self.tx_radio = tx_radio
+        self._next = 0  # radio read_packet looks at first, so no radio starves the others
+        for config in configs:
+            kwargs = dict(common)
+            kwargs.update(config)
+            profile = kwargs.pop('profile', None)
+            if kwargs.get('bus') is None:
+                spi_id = kwargs.get('spi_id', 1)
+                if spi_id not in self.buses:
+                    self.buses[spi_id] = spicontrol.SpiBus(**kwargs)
+                kwargs['bus'] = self.buses[spi_id]
+            radio = lorautil.LoraUtil(**kwargs)
+            if profile:
+                radio.set_profile(profile)
+            self.radios.append(radio)
+
+    def __len__(self):
+        return len(self.radios)
+
+    def __getitem__(self, index):
+        return self.radios[index]
+
+    def is_packet_available(self):
+        "True if any radio has a packet queued."
+        for radio in self.radios:
+            if radio.is_packet_available():
+                return True
+        return False
+
+    def read_packet(self):
+        "Return (radio index, packet) for the next queued packet, taking radios in turn, or None."
+        n = len(self.radios)
+        for i in range(n):
+            index = (self._next + i) % n
+            pkt = self.radios[index].read_packet()
+            if pkt:
+                self._next = (index + 1) % n
+                return index, pkt
+        return None
+
+    def read_packets(self):
+        "Drain every radio's queue, return a list of (radio index, packet)."
+        pkts = []
+        for index, radio in enumerate(self.radios):
+            for pkt in radio.read_packets():
+                pkts.append((index, pkt))
+        return pkts
+
+    def send_packet(self, src_address, dst_address, outgoing_payload, callback=None, radio=None):
+        '''Queue a packet on radio (default tx_radio) and return its TxHandle, or None
+           if that radio's transmit queue is full'''
+        if radio is None:
+            radio = self.tx_radio
+        return self.radios[radio].send_packet(src_address, dst_address, outgoing_payload,
+                                              callback)
+
+    def service(self):
+        "Run every radio's housekeeping, call regularly from the main loop."
+        for radio in self.radios:
+            radio.service()
+
+    def flush(self, timeout_ms=None):
+        "Wait until every radio's transmit queue is empty. Returns False on timeout."
+        ok = True
+        for radio in self.radios:
+            ok = radio.flush(timeout_ms) and ok
+        return ok
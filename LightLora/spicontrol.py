@@ -12,20 +12,20 @@ PIN_ID_LORA_RESET = const(27)   # GPIO27
 
 # loraconfig is the project definition for pins <-> hardware
 
-class SpiControl:
-    "Simple higher-level SPI stuff"
+class SpiBus:
+    '''An SPI bus that several SpiControl devices can share, each with its own chip select.
+       busy is set for the length of every transaction on the bus, so a deferred
+       interrupt handler of one radio waits while another radio's transfer is running'''
 
     def __init__(self,
+                 spi_id=1,
                  pin_id_sck=PIN_ID_SCK,
                  pin_id_miso=PIN_ID_MISO,
                  pin_id_mosi=PIN_ID_MOSI,
-                 pin_id_lora_dio0=PIN_ID_LORA_DIO0,
-                 pin_id_lora_ss=PIN_ID_LORA_SS,
-                 pin_id_lora_reset=PIN_ID_LORA_RESET,
                  baudrate=5000000,
                  **kwargs):
         self.spi = SPI(
-                1,
+                spi_id,
                 baudrate=baudrate,
                 polarity=0,
                 phase=0,
@@ -35,35 +35,118 @@ class SpiControl:
                 mosi=Pin(pin_id_mosi, Pin.OUT),
                 miso=Pin(pin_id_miso, Pin.IN)
         )
-        self.pinss = Pin(pin_id_lora_ss, Pin.OUT)
-        self.pinrst = Pin(pin_id_lora_reset, Pin.OUT)
-        self.pin_id_lora_dio0 = pin_id_lora_dio0
+        self.busy = False
 
+class SpiControl:
+    '''Simple higher-level SPI stuff for one LoRa device.
+       Pass bus= an SpiBus to share it with other devices, otherwise one is made
+       from spi_id and the SPI pins'''
 
+    def __init__(self,
+                 pin_id_sck=PIN_ID_SCK,
+                 pin_id_miso=PIN_ID_MISO,
+                 pin_id_mosi=PIN_ID_MOSI,
+                 pin_id_lora_dio0=PIN_ID_LORA_DIO0,
+                 pin_id_lora_ss=PIN_ID_LORA_SS,
+                 pin_id_lora_reset=PIN_ID_LORA_RESET,
+                 baudrate=5000000,
+                 spi_id=1,
+                 bus=None,
+                 **kwargs):
+        if bus is None:
+            bus = SpiBus(spi_id, pin_id_sck, pin_id_miso, pin_id_mosi, baudrate)
+        self.bus = bus
+        self.spi = bus.spi
+        self.pinss = Pin(pin_id_lora_ss, Pin.OUT, value=1)  # deselected, the bus may be shared
+        self.pinrst = Pin(pin_id_lora_reset, Pin.OUT, value=1)  # out of reset, see init_lora_pins
+        self.pin_id_lora_dio0 = pin_id_lora_dio0
+        # preallocated so register access never touches the heap (safe in an ISR)
+        self._regbuf = bytearray(2)     # address, value
+        self._addrbuf = bytearray(1)    # burst address
+        self._response = bytearray(1)
+        self.stats = None   # a stats.LoraStats to count transfers into
+
+    @property
+    def busy(self):
+        "A transfer is in progress on the bus, deferred handlers must wait"
+        return self.bus.busy
 
     # sx127x transfer is always write 2 bytes while reading the second byte
     # a read doesn't write the second byte. a write returns the prior value
     # write register # = 0x80 | read register #
     def transfer(self, address, value=0x00):
-        response = bytearray(1)
+        "Legacy single register transfer. The returned buffer is reused by the next call."
+        self._response[0] = self._transfer(address, value)
+        return self._response
+
+    def _transfer(self, address, value):
+        buf = self._regbuf
+        buf[0] = address
+        buf[1] = value & 0xff
+        self.bus.busy = True
         self.pinss.value(0)    # hold chip select low
-        self.spi.write(bytearray([address]))  # write register address
+        self.spi.write_readinto(buf, buf)   # address then register value
+        self.pinss.value(1)
+        self.bus.busy = False
+        st = self.stats
+        if st:
+            st.spi_transactions += 1
+            st.spi_bytes += 2
+        return buf[1]
+
+    def read_register(self, address):
+        "Read one register, return its value as an int. Does not allocate."
+        return self._transfer(address & 0x7f, 0x00)
 
-        # write or read register walue
-        self.spi.write_readinto(bytearray([value]), response)
+    def write_register(self, address, value):
+        "Write one register. Does not allocate."
+        self._transfer(address | 0x80, value)
 
+    # burst access: one address byte then len(buf) data bytes under a single
+    # chip select. The sx127x auto-increments the register address, except for
+    # REG_FIFO (0x00) where each byte moves through the FIFO instead.
+    def read_burst(self, address, buf):
+        "Read len(buf) bytes starting at address into buf."
+        self._addrbuf[0] = address
+        self.bus.busy = True
+        self.pinss.value(0)
+        self.spi.write(self._addrbuf)
+        self.spi.readinto(buf, 0x00)
         self.pinss.value(1)
-        return response
+        self.bus.busy = False
+        st = self.stats
+        if st:
+            st.spi_transactions += 1
+            st.spi_bytes += 1 + len(buf)
+        return buf
+
+    def write_burst(self, address, buf):
+        "Write all of buf starting at address (address should include the 0x80 write bit)."
+        self._addrbuf[0] = address
+        self.bus.busy = True
+        self.pinss.value(0)
+        self.spi.write(self._addrbuf)
+        self.spi.write(buf)
+        self.pinss.value(1)
+        self.bus.busy = False
+        st = self.stats
+        if st:
+            st.spi_transactions += 1
+            st.spi_bytes += 1 + len(buf)
 
     def get_irq_pin(self):
         "Get handle on a machine.Pin() for the LoRa's DIO0."
         irq_pin = Pin(self.pin_id_lora_dio0, Pin.IN)
         return irq_pin
 
-    def init_lora_pins(self):
-        "Initialize the pins for the LoRa device after instantiation of SX127x."
+    def init_lora_pins(self, reset=True):
+        '''Initialize the pins for the LoRa device after instantiation of SX127x.
+           reset=False leaves the chip's configuration alone, for a warm start'''
         self.pinss.value(1)     # initialize CS to high (off)
-        self.pinrst.value(1)    # do a reset pulse
+        self.pinrst.value(1)
+        if not reset:
+            return
+        # do a reset pulse
         sleep_ms(10)
         self.pinrst.value(0)
         sleep_ms(10)
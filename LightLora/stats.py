@@ -0,0 +1,70 @@
+"Runtime counters and histograms for the SpiControl, SX127x and LoraUtil hot paths"
+
+from array import array
+from micropython import const
+
+HIST_BUCKETS = const(16)
+
+def _log2Bucket(us):
+    "Histogram bucket n holds durations in [2**n, 2**(n+1)) microseconds"
+    n = 0
+    while us > 1 and n < HIST_BUCKETS - 1:
+        us >>= 1
+        n += 1
+    return n
+
+class LoraStats:
+    '''Counters and coarse histograms, updated without allocating so they can be
+       bumped from the interrupt paths. Nothing is collected unless a LoraStats is
+       attached (LoraUtil(stats=True)); detached, each site costs one None test.
+         isr_us       hard interrupt duration, log2 buckets of microseconds
+         latency_us   DIO0 edge to handler start, log2 buckets of microseconds
+         rssi         10dB buckets from -140dBm
+         snr          2.5dB buckets from -20dB
+    '''
+    def __init__(self):
+        self.isr_us = array('I', bytes(4 * HIST_BUCKETS))
+        self.latency_us = array('I', bytes(4 * HIST_BUCKETS))
+        self.rssi = array('I', bytes(4 * HIST_BUCKETS))
+        self.snr = array('I', bytes(4 * HIST_BUCKETS))
+        self.reset()
+
+    def reset(self):
+        "Zero every counter and histogram"
+        self.tx_packets = 0
+        self.rx_packets = 0
+        self.crc_errors = 0
+        self.rx_timeouts = 0
+        self.spurious_irqs = 0
+        self.spi_transactions = 0
+        self.spi_bytes = 0
+        for hist in (self.isr_us, self.latency_us, self.rssi, self.snr):
+            for i in range(HIST_BUCKETS):
+                hist[i] = 0
+
+    def isr(self, us):
+        self.isr_us[_log2Bucket(us)] += 1
+
+    def latency(self, us):
+        self.latency_us[_log2Bucket(us)] += 1
+
+    def signal(self, rssi, snrRaw):
+        "Record a packet's RSSI (dBm) and raw SNR register value (0.25dB steps)"
+        self.rssi[min(max((rssi + 140) // 10, 0), HIST_BUCKETS - 1)] += 1
+        self.snr[min(max((snrRaw + 80) // 10, 0), HIST_BUCKETS - 1)] += 1
+
+    def snapshot(self):
+        "A dict copy of the counters and histograms"
+        return {
+            'tx_packets': self.tx_packets,
+            'rx_packets': self.rx_packets,
+            'crc_errors': self.crc_errors,
+            'rx_timeouts': self.rx_timeouts,
+            'spurious_irqs': self.spurious_irqs,
+            'spi_transactions': self.spi_transactions,
+            'spi_bytes': self.spi_bytes,
+            'isr_us': list(self.isr_us),
+            'latency_us': list(self.latency_us),
+            'rssi': list(self.rssi),
+            'snr': list(self.snr),
+        }
@@ -6,14 +6,22 @@ Call onReceive and onTransmit to define the interrupt handlers.
     Receive handler gets a packet of data
     Transmit handler is informed the transmit ended
 
+The DIO0 hard interrupt only timestamps the edge and queues it, the handlers
+themselves run a moment later through micropython.schedule where SPI access
+and allocation are allowed.
+
 Communications is handled by an SpiControl object wrapping SPI
 '''
 
 
 import gc
 import _thread
+from array import array
 from machine import Pin
-from micropython import const
+from micropython import const, schedule, alloc_emergency_exception_buf
+from utime import ticks_us, ticks_diff
+
+alloc_emergency_exception_buf(100)
 
 PA_OUTPUT_RFO_PIN = const(0)
 PA_OUTPUT_PA_BOOST_PIN = const(1)
@@ -30,7 +38,8 @@ REG_FIFO_ADDR_PTR = const(0x0d)
 
 REG_FIFO_TX_BASE_ADDR = const(0x0e)
 FifoTxBaseAddr = const(0x00)
-# FifoTxBaseAddr = 0x80
+# with split_fifo TX uses the upper half, RX the lower half
+FifoSplitAddr = const(0x80)
 
 REG_FIFO_RX_BASE_ADDR = const(0x0f)
 FifoRxBaseAddr = const(0x00)
@@ -38,13 +47,16 @@ REG_FIFO_RX_CURRENT_ADDR = const(0x10)
 REG_IRQ_FLAGS_MASK = const(0x11)
 REG_IRQ_FLAGS = const(0x12)
 REG_RX_NB_BYTES = const(0x13)
+REG_PKT_SNR_VALUE = const(0x19)
 REG_PKT_RSSI_VALUE = const(0x1a)
-REG_PKT_SNR_VALUE = const(0x1b)
 REG_MODEM_CONFIG_1 = const(0x1d)
 REG_MODEM_CONFIG_2 = const(0x1e)
+REG_SYMB_TIMEOUT_LSB = const(0x1f)
 REG_PREAMBLE_MSB = const(0x20)
 REG_PREAMBLE_LSB = const(0x21)
 REG_PAYLOAD_LENGTH = const(0x22)
+REG_MAX_PAYLOAD_LENGTH = const(0x23)
+REG_HOP_PERIOD = const(0x24)
 REG_FIFO_RX_BYTE_ADDR = const(0x25)
 REG_MODEM_CONFIG_3 = const(0x26)
 REG_RSSI_WIDEBAND = const(0x2c)
@@ -63,11 +75,14 @@ MODE_RX_CONTINUOUS = const(0x05)
 # MODE_RX_SINGLE = 0x06
 # 6 is not supported on the 1276
 MODE_RX_SINGLE = const(0x05)
+MODE_CAD = const(0x07)
 
 # PA config
 PA_BOOST = const(0x80)
 
 # IRQ masks
+IRQ_CAD_DETECTED_MASK = const(0x01)
+IRQ_CAD_DONE_MASK = const(0x04)
 IRQ_TX_DONE_MASK = const(0x08)
 IRQ_PAYLOAD_CRC_ERROR_MASK = const(0x20)
 IRQ_RX_DONE_MASK = const(0x40)
@@ -76,6 +91,27 @@ IRQ_RX_TIME_OUT_MASK = const(0x80)
 # Buffer size
 MAX_PKT_LENGTH = const(255)
 
+# DIO0 edges the hard interrupt can hold before the scheduled handler runs
+IRQ_QUEUE_SIZE = const(8)
+
+# register image for a warm start (captureImage/restoreImage): IMAGE_VERSION, then the
+# registers of each block in turn, then a 16-bit checksum of everything before it
+IMAGE_VERSION = const(1)
+IMAGE_BLOCKS = ((REG_FRF_MSB, 10),              # frequency .. FIFO base addresses
+                (REG_MODEM_CONFIG_1, 10),       # modem config, preamble .. config 3
+                (REG_DETECTION_OPTIMIZE, 9))    # detection .. sync word
+IMAGE_LENGTH = const(32)
+# bytes of the modem block that change with traffic, not configuration
+_IMAGE_VOLATILE = (REG_PAYLOAD_LENGTH - REG_MODEM_CONFIG_1, REG_FIFO_RX_BYTE_ADDR - REG_MODEM_CONFIG_1)
+
+def _imageChecksum(image):
+    "Fletcher-16 over all but the last two bytes"
+    a = b = 0
+    for i in range(len(image) - 2):
+        a = (a + image[i]) % 255
+        b = (b + a) % 255
+    return (b << 8) | a
+
 # pass in non-default parameters for any/all options in the constructor parameters argument
 DEFAULT_PARAMETERS = {
     'frequency': 915000000,
@@ -87,10 +123,89 @@ DEFAULT_PARAMETERS = {
     'implicitHeader': False,
     'sync_word': 0x12,
     'enable_CRC': True,
+    'low_data_rate_optimize': False,
+    'split_fifo': False,
+}
+
+# named modem profiles for SX127x.applyProfile(), on top of the radio's own parameters:
+# a profile changes the keys it lists and keeps the rest (frequency, power, sync word...)
+PROFILES = {
+    'fast': {'signal_bandwidth': 250000, 'spreading_factor': 7,
+             'low_data_rate_optimize': False},
+    'long_range': {'signal_bandwidth': 125000, 'spreading_factor': 12,
+                   'low_data_rate_optimize': True},
 }
 
 REQUIRED_VERSION = const(0x12)
 
+# register encodings shared by the setters and ModemProfile
+
+# Frf register setting = Freq / FSTEP where
+# FSTEP = FXOSC/2**19 where FXOSC=32MHz. So FSTEP==61.03515625
+def _frf(frequency):
+    return (int)(frequency / 61.03515625)
+
+# the bandwidth (Hz) each REG_MODEM_CONFIG_1 Bw setting selects
+BANDWIDTHS = (7800, 10400, 15600, 20800, 31250, 41700, 62500, 125000, 250000, 500000)
+
+def _bandwidthBits(sbw):
+    for bw, cutoff in enumerate(BANDWIDTHS):
+        if sbw <= cutoff:
+            return bw
+    return 9
+
+def _codingRateBits(denominator):
+    return min(max(denominator, 5), 8) - 4
+
+def _paConfig(level, outputPin=PA_OUTPUT_PA_BOOST_PIN):
+    if outputPin == PA_OUTPUT_RFO_PIN:
+        # RFO
+        return 0x70 | min(max(level, 0), 14)
+    # PA BOOST
+    return PA_BOOST | (min(max(level, 2), 17) - 2)
+
+class ModemProfile:
+    '''A full set of modem parameters, precomputed into register bytes.
+       SX127x.applyProfile writes it as one burst over 0x06-0x09 (frequency, PA),
+       one burst over 0x1d-0x26 (modem config, preamble) and at most three
+       single writes for detection and sync word, skipping what is unchanged.
+       kwargs override base (default DEFAULT_PARAMETERS), usually a radio's parameters'''
+    def __init__(self, name=None, base=None, **kwargs):
+        self.name = name
+        self.overrides = kwargs
+        self.parameters = dict(DEFAULT_PARAMETERS if base is None else base)
+        self.parameters.update(kwargs)
+        p = self.parameters
+        sf = min(max(p['spreading_factor'], 6), 12)
+        frfs = _frf(p['frequency'])
+        # REG_FRF_MSB .. REG_PA_CONFIG
+        self.rfBlock = bytearray((frfs >> 16, (frfs >> 8) & 0xff, frfs & 0xff,
+                                  _paConfig(p['tx_power_level'])))
+        # REG_MODEM_CONFIG_1 .. REG_MODEM_CONFIG_3, other bytes hold their reset values
+        self.modemBlock = bytearray((
+            (_bandwidthBits(p['signal_bandwidth']) << 4) | (_codingRateBits(p['coding_rate']) << 1) |
+                (0x01 if p['implicitHeader'] else 0x00),
+            (sf << 4) | (0x04 if p['enable_CRC'] else 0x00),
+            0x64,                                           # REG_SYMB_TIMEOUT_LSB
+            (p['preamble_length'] >> 8) & 0xff, p['preamble_length'] & 0xff,
+            0x00,                                           # REG_PAYLOAD_LENGTH, kept as is
+            0xff,                                           # REG_MAX_PAYLOAD_LENGTH
+            0x00,                                           # REG_HOP_PERIOD
+            0x00,                                           # REG_FIFO_RX_BYTE_ADDR, read only
+            0x04 | (0x08 if p['low_data_rate_optimize'] else 0x00)))   # auto AGC, LDRO
+        self.detectionOptimize = 0xc5 if sf == 6 else 0xc3
+        self.detectionThreshold = 0x0c if sf == 6 else 0x0a
+        self.syncWord = p['sync_word']
+
+    def fits(self, parameters):
+        "True if parameters are still the base this profile was built on."
+        own = self.parameters
+        overrides = self.overrides
+        for key in own:
+            if key not in overrides and parameters.get(key) != own[key]:
+                return False
+        return True
+
 class SX127x:
     ''' Standard SX127x library. Requires an spicontrol.SpiControl instance for spiControl '''
     def __init__(self,
@@ -104,16 +219,45 @@ class SX127x:
         self.parameters = dict(DEFAULT_PARAMETERS)
         self.parameters.update(kwargs)
         self._onReceive = on_receive_func
+        self._rawReceive = False
+        self._implicitHeaderMode = None
         self._onTransmit = on_transmit_func
+        self._onCadDone = None
+        self._txBase = FifoTxBaseAddr
+        self._txLimit = MAX_PKT_LENGTH  # largest frame: the whole FIFO, or its TX half
+        self._rxLimit = MAX_PKT_LENGTH
+        self._staged = 0        # length of a frame waiting in the TX half, see stageTx
         self.doAcquire = hasattr(_thread, 'allocate_lock') # micropython vs loboris
         if self.doAcquire :
             self._lock = _thread.allocate_lock()
         else :
             self._lock = True
         self._spiControl = spiControl   # the spi wrapper - see spicontrol.py
+        # shadow copies of the configuration registers we own, so setters can
+        # skip the SPI read in read-modify-write and skip unchanged writes.
+        # _shadowValid[reg] is set once _shadow[reg] is known to match the chip
+        self._shadow = bytearray(0x80)
+        self._shadowValid = bytearray(0x80)
+        self._profiles = {}
+        # DIO0 events, a single producer (hard irq) single consumer (scheduled) ring
+        self._irqTicks = array('I', bytes(4 * IRQ_QUEUE_SIZE))
+        self._irqFns = [None] * IRQ_QUEUE_SIZE    # the handler armed when the edge came
+        self._irqHead = 0
+        self._irqTail = 0
+        self._irqService = None     # handler for the next DIO0 edge
+        self._servicePending = False
+        self._loading = False       # between beginPacket and endPacket
+        self.irqOverruns = 0        # edges lost to a full event ring
+        self.lastIrqTicks = 0       # ticks_us() of the DIO0 edge being handled
+        self.stats = None           # a stats.LoraStats, errors are printed without one
+        self._hardIrqRef = self._hardIrq     # bound methods allocate, make them once
+        self._serviceIrqRef = self._serviceIrq
+        self.profile = None     # the ModemProfile last applied, if any
         self.irqPin = spiControl.get_irq_pin() # a way to need loracontrol only in spicontrol
 
     def init(self):
+        # the chip may just have been reset, forget anything we knew
+        self.invalidateRegisters()
         # check version
         version = self.readRegister(REG_VERSION)
         if version != REQUIRED_VERSION:
@@ -128,10 +272,10 @@ class SX127x:
         self.setSignalBandwidth(_parameters['signal_bandwidth'])
 
         # set LNA boost
-        self.writeRegister(REG_LNA, self.readRegister(REG_LNA) | 0x03)
+        self._setRegister(REG_LNA, self._getRegister(REG_LNA) | 0x03)
 
         # set auto AGC
-        self.writeRegister(REG_MODEM_CONFIG_3, 0x04)
+        self.setLowDataRateOptimize(_parameters['low_data_rate_optimize'])
 
         self.setTxPower(_parameters['tx_power_level'])
         self._implicitHeaderMode = None
@@ -142,19 +286,28 @@ class SX127x:
         self.setSyncWord(_parameters['sync_word'])
         self.enableCRC(_parameters['enable_CRC'])
 
-        # set base addresses
-        self.writeRegister(REG_FIFO_TX_BASE_ADDR, FifoTxBaseAddr)
-        self.writeRegister(REG_FIFO_RX_BASE_ADDR, FifoRxBaseAddr)
+        # set base addresses, split_fifo keeps received data out of the TX half
+        split = _parameters['split_fifo']
+        self._txBase = FifoSplitAddr if split else FifoTxBaseAddr
+        self._txLimit = self._rxLimit = FifoSplitAddr if split else MAX_PKT_LENGTH
+        self._staged = 0
+        self._setRegister(REG_FIFO_TX_BASE_ADDR, self._txBase)
+        self._setRegister(REG_FIFO_RX_BASE_ADDR, FifoRxBaseAddr)
+        self._setRegister(REG_MAX_PAYLOAD_LENGTH, self._rxLimit & 0xff)
 
         self.standby()
 
     # start sending a packet (reset the fifo address, go into standby)
     def beginPacket(self, implicitHeaderMode=False):
+        self._prepIrqHandler(None)     # no receive interrupts while we fill the fifo
+        self._drainReceive()
+        self._loading = True
         self.standby()
         self.implicitHeaderMode(implicitHeaderMode)
         # reset FIFO address and paload length
-        self.writeRegister(REG_FIFO_ADDR_PTR, FifoTxBaseAddr)
-        self.writeRegister(REG_PAYLOAD_LENGTH, 0)
+        self.writeRegister(REG_FIFO_ADDR_PTR, self._txBase)
+        self._setRegister(REG_PAYLOAD_LENGTH, 0)
+        self._staged = 0
 
     # finished putting packet into fifo, send it
     # non-blocking so don't immediately receive...
@@ -163,11 +316,70 @@ class SX127x:
         if self._onTransmit:
            # enable tx to raise DIO0
             self._prepIrqHandler(self._handleOnTransmit)           # attach handler
-            self.writeRegister(REG_DIO_MAPPING_1, 0x40)        # enable transmit dio0
+            self._setRegister(REG_DIO_MAPPING_1, 0x40)         # enable transmit dio0
         else:
             self._prepIrqHandler(None)                          # no handler
         # put in TX mode
         self.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_TX)
+        self._loading = False
+
+    def _drainReceive(self):
+        '''Unload a received packet whose RxDone is queued but not handled yet, or
+           flagged after the interrupt was disarmed: loading the FIFO would overwrite it.
+           Its queued event is dropped, so it is not handled twice'''
+        pending = False
+        i = self._irqTail
+        while i != self._irqHead:
+            if self._irqFns[i] == self._handleOnReceive:
+                self._irqFns[i] = None
+                if not pending:
+                    pending = True
+                    self.lastIrqTicks = self._irqTicks[i]
+            i = (i + 1) % IRQ_QUEUE_SIZE
+        if not pending:
+            # while receiving DIO0 is mapped to RxDone, its level is the flag without SPI
+            if self._shadow[REG_OP_MODE] & 0x07 != MODE_RX_CONTINUOUS or \
+               not self.irqPin or not self.irqPin.value():
+                return
+            self.lastIrqTicks = ticks_us()
+        self._handleOnReceive(self.irqPin)
+
+    def stageTx(self, buffer):
+        '''With split_fifo, load a frame into the TX half of the FIFO without leaving
+           receive mode; sendStaged() then sends it with a few register writes.
+           Returns the number of bytes staged. beginPacket discards a staged frame'''
+        if self._txBase == FifoTxBaseAddr:
+            raise ValueError('stageTx needs split_fifo')
+        size = min(len(buffer), self._txLimit)
+        if size < len(buffer):
+            buffer = memoryview(buffer)[:size]
+        self._loading = True    # keep the receive handler off the FIFO pointer
+        self.writeRegister(REG_FIFO_ADDR_PTR, self._txBase)
+        self._spiControl.write_burst(REG_FIFO | 0x80, buffer)
+        self._staged = size
+        self._loading = False
+        return size
+
+    def txCapacity(self):
+        "Largest frame that can be sent: the whole FIFO, or its TX half with split_fifo"
+        return self._txLimit
+
+    def hasStaged(self):
+        "True while a frame from stageTx() waits to be sent"
+        return self._staged > 0
+
+    def sendStaged(self, implicitHeaderMode=False):
+        "Send the frame loaded by stageTx(), like endPacket. Returns False if there is none"
+        if not self._staged:
+            return False
+        self._loading = True
+        self._prepIrqHandler(None)
+        self.standby()
+        self.implicitHeaderMode(implicitHeaderMode)
+        self._setRegister(REG_PAYLOAD_LENGTH, self._staged)
+        self._staged = 0
+        self.endPacket()
+        return True
 
     def isTxDone(self):
         "If Tx is done return True, and clear irq register - so it only returns True once"
@@ -182,15 +394,18 @@ class SX127x:
         return True
 
     def write(self, buffer):
-        currentLength = self.readRegister(REG_PAYLOAD_LENGTH)
+        currentLength = self._getRegister(REG_PAYLOAD_LENGTH)
         size = len(buffer)
         # check size
-        size = min(size, (MAX_PKT_LENGTH - FifoTxBaseAddr - currentLength))
-        # write data
-        for i in range(size):
-            self.writeRegister(REG_FIFO, buffer[i])
+        size = min(size, (self._txLimit - currentLength))
+        if size <= 0:
+            return 0
+        # write data as a single FIFO burst
+        if size < len(buffer):
+            buffer = memoryview(buffer)[:size]
+        self._spiControl.write_burst(REG_FIFO | 0x80, buffer)
         # update length
-        self.writeRegister(REG_PAYLOAD_LENGTH, currentLength + size)
+        self._setRegister(REG_PAYLOAD_LENGTH, currentLength + size)
         return size
 
     def acquire_lock(self, lock=False):
@@ -209,7 +424,7 @@ class SX127x:
                     _thread.unlock()
 
     def println(self, string, implicitHeader=False):
-        self.acquire_lock(True)  # wait until RX_Done, lock and begin writing.
+        self.acquire_lock(True)  # one writer at a time, the interrupt handlers take no lock
         self.beginPacket(implicitHeader)
         self.write(string.encode())
         self.endPacket()
@@ -225,66 +440,220 @@ class SX127x:
         return self.readRegister(REG_PKT_RSSI_VALUE) - (164 if self._frequency < 868E6 else 157)
 
     def packetSnr(self):
-        return self.readRegister(REG_PKT_SNR_VALUE) * 0.25
+        return self.readRegister(REG_PKT_SNR_VALUE, signed=True) * 0.25
 
     def standby(self):
         self.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_STDBY)
 
     def sleep(self):
+        self._staged = 0    # sleep clears the FIFO
         self.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_SLEEP)
 
+    # the setters keep self.parameters current, timeOnAir() relies on it
     def setTxPower(self, level, outputPin=PA_OUTPUT_PA_BOOST_PIN):
-        if outputPin == PA_OUTPUT_RFO_PIN:
-            # RFO
-            level = min(max(level, 0), 14)
-            self.writeRegister(REG_PA_CONFIG, 0x70 | level)
-        else:
-            # PA BOOST
-            level = min(max(level, 2), 17)
-            self.writeRegister(REG_PA_CONFIG, PA_BOOST | (level - 2))
+        self.parameters['tx_power_level'] = level
+        self._setRegister(REG_PA_CONFIG, _paConfig(level, outputPin))
 
     # set the frequency band. passed in Hz
-    # Frf register setting = Freq / FSTEP where
-    # FSTEP = FXOSC/2**19 where FXOSC=32MHz. So FSTEP==61.03515625
     def setFrequency(self, frequency):
         self._frequency = frequency
-        frfs = (int)(frequency / 61.03515625)
-        self.writeRegister(REG_FRF_MSB, frfs >> 16)
-        self.writeRegister(REG_FRF_MID, frfs >> 8)
-        self.writeRegister(REG_FRF_LSB, frfs)
+        self.parameters['frequency'] = frequency
+        frfs = _frf(frequency)
+        self._setRegister(REG_FRF_MSB, frfs >> 16)
+        self._setRegister(REG_FRF_MID, frfs >> 8)
+        self._setRegister(REG_FRF_LSB, frfs)
 
     def setSpreadingFactor(self, sf):
         sf = min(max(sf, 6), 12)
-        self.writeRegister(REG_DETECTION_OPTIMIZE, 0xc5 if sf == 6 else 0xc3)
-        self.writeRegister(REG_DETECTION_THRESHOLD, 0x0c if sf == 6 else 0x0a)
-        self.writeRegister(REG_MODEM_CONFIG_2, (self.readRegister(REG_MODEM_CONFIG_2) & 0x0f) | ((sf << 4) & 0xf0))
+        self.parameters['spreading_factor'] = sf
+        self._setRegister(REG_DETECTION_OPTIMIZE, 0xc5 if sf == 6 else 0xc3)
+        self._setRegister(REG_DETECTION_THRESHOLD, 0x0c if sf == 6 else 0x0a)
+        self._setRegister(REG_MODEM_CONFIG_2, (self._getRegister(REG_MODEM_CONFIG_2) & 0x0f) | ((sf << 4) & 0xf0))
 
     def setSignalBandwidth(self, sbw):
-        bins = (7800, 10400, 15600, 20800, 31250, 41700, 62500, 125000, 250000)
-        for bw, cutoff in enumerate(bins):
-            if sbw <= cutoff:
-                break
-        else:
-            bw = 9
-        self.writeRegister(REG_MODEM_CONFIG_1, (self.readRegister(REG_MODEM_CONFIG_1) & 0x0f) | (bw << 4))
+        bw = _bandwidthBits(sbw)
+        self.parameters['signal_bandwidth'] = sbw
+        self._setRegister(REG_MODEM_CONFIG_1, (self._getRegister(REG_MODEM_CONFIG_1) & 0x0f) | (bw << 4))
 
     def setCodingRate(self, denominator):
         "Takes a value of 5..8 as the denominator of 4/5, 4/6, 4/7, 5/8"
-        denominator = min(max(denominator, 5), 8)
-        cr = denominator - 4
-        self.writeRegister(REG_MODEM_CONFIG_1, (self.readRegister(REG_MODEM_CONFIG_1) & 0xf1) | (cr << 1))
+        cr = _codingRateBits(denominator)
+        self.parameters['coding_rate'] = denominator
+        self._setRegister(REG_MODEM_CONFIG_1, (self._getRegister(REG_MODEM_CONFIG_1) & 0xf1) | (cr << 1))
 
     def setPreambleLength(self, length):
-        self.writeRegister(REG_PREAMBLE_MSB, (length >> 8) & 0xff)
-        self.writeRegister(REG_PREAMBLE_LSB, (length >> 0) & 0xff)
+        self.parameters['preamble_length'] = length
+        self._setRegister(REG_PREAMBLE_MSB, (length >> 8) & 0xff)
+        self._setRegister(REG_PREAMBLE_LSB, (length >> 0) & 0xff)
 
     def enableCRC(self, enable_CRC=False):
-        modem_config_2 = self.readRegister(REG_MODEM_CONFIG_2)
+        self.parameters['enable_CRC'] = enable_CRC
+        modem_config_2 = self._getRegister(REG_MODEM_CONFIG_2)
         config = modem_config_2 | 0x04 if enable_CRC else modem_config_2 & 0xfb
-        self.writeRegister(REG_MODEM_CONFIG_2, config)
+        self._setRegister(REG_MODEM_CONFIG_2, config)
 
     def setSyncWord(self, sw):
-        self.writeRegister(REG_SYNC_WORD, sw)
+        self.parameters['sync_word'] = sw
+        self._setRegister(REG_SYNC_WORD, sw)
+
+    def setLowDataRateOptimize(self, enable=False):
+        "Required when a symbol lasts over 16ms (e.g. SF11/SF12 at 125kHz). Also sets auto AGC"
+        self.parameters['low_data_rate_optimize'] = enable
+        self._setRegister(REG_MODEM_CONFIG_3, 0x0c if enable else 0x04)
+
+    def symbolTime(self):
+        "Microseconds per LoRa symbol with the current spreading factor and bandwidth"
+        p = self.parameters
+        sf = min(max(p['spreading_factor'], 6), 12)
+        return (1 << sf) * 1000000 // BANDWIDTHS[_bandwidthBits(p['signal_bandwidth'])]
+
+    def timeOnAir(self, length, preambleLength=None):
+        '''Microseconds a length byte packet occupies the channel with the current
+           parameters (Semtech AN1200.13). Header mode is the one last selected'''
+        p = self.parameters
+        sf = min(max(p['spreading_factor'], 6), 12)
+        cr = _codingRateBits(p['coding_rate'])
+        de = 1 if p['low_data_rate_optimize'] else 0
+        if preambleLength is None:
+            preambleLength = p['preamble_length']
+        num = 8 * length - 4 * sf + 28 + (16 if p['enable_CRC'] else 0) - \
+              (20 if self._implicitHeaderMode else 0)
+        den = 4 * (sf - 2 * de)
+        payloadSymbols = 8 + max(-(-num // den) * (cr + 4), 0)
+        tsym = self.symbolTime()
+        # preamble is preambleLength + 4.25 symbols
+        return (4 * preambleLength + 17) * tsym // 4 + payloadSymbols * tsym
+
+    def addProfile(self, name, **kwargs):
+        '''Precompute and remember a named ModemProfile for applyProfile: the current
+           parameters with kwargs changed. It is worked out again when applied if the
+           parameters it does not change have moved on since'''
+        profile = ModemProfile(name, self.parameters, **kwargs)
+        self._profiles[name] = profile
+        return profile
+
+    def applyProfile(self, profile):
+        '''Switch every modem parameter at once to a ModemProfile or a profile name
+           (added with addProfile or listed in PROFILES). A name only changes the
+           parameters it lists. Call between packets:
+           this leaves the radio in standby, call receive() to listen again'''
+        if not isinstance(profile, ModemProfile):
+            named = self._profiles.get(profile)
+            if named is None:
+                named = self.addProfile(profile, **PROFILES[profile])
+            elif not named.fits(self.parameters):
+                named = self.addProfile(profile, **named.overrides)
+            profile = named
+        self.standby()
+        self._writeBlock(REG_FRF_MSB, profile.rfBlock)
+        block = profile.modemBlock
+        # keep the payload length register as it is, and the FIFO split
+        block[REG_PAYLOAD_LENGTH - REG_MODEM_CONFIG_1] = self._shadow[REG_PAYLOAD_LENGTH]
+        block[REG_MAX_PAYLOAD_LENGTH - REG_MODEM_CONFIG_1] = self._rxLimit & 0xff
+        self._writeBlock(REG_MODEM_CONFIG_1, block)
+        self._setRegister(REG_DETECTION_OPTIMIZE, profile.detectionOptimize)
+        self._setRegister(REG_DETECTION_THRESHOLD, profile.detectionThreshold)
+        self._setRegister(REG_SYNC_WORD, profile.syncWord)
+        split = self.parameters['split_fifo']     # fixed at init()
+        self.parameters.update(profile.parameters)
+        self.parameters['split_fifo'] = split
+        self._frequency = profile.parameters['frequency']
+        self._implicitHeaderMode = profile.parameters['implicitHeader']
+        self.profile = profile
+
+    def captureImage(self):
+        '''Read the applied configuration from the chip as an IMAGE_LENGTH byte image
+           for restoreImage(), e.g. kept in RTC memory over deep sleep'''
+        image = bytearray(IMAGE_LENGTH)
+        image[0] = IMAGE_VERSION
+        pos = 1
+        for address, size in IMAGE_BLOCKS:
+            self._spiControl.read_burst(address, memoryview(image)[pos:pos + size])
+            pos += size
+        check = _imageChecksum(image)
+        image[pos] = check >> 8
+        image[pos + 1] = check & 0xff
+        return image
+
+    def restoreImage(self, image):
+        '''Warm start: take up the configuration in image without init() or a reset.
+           If the chip kept it (the MCU slept, the radio did not lose power) this costs
+           a few reads; otherwise the image goes back in three burst writes and is read
+           back. Returns False if the image is damaged or the chip does not take it,
+           then reset the chip and call init() instead'''
+        if len(image) != IMAGE_LENGTH or image[0] != IMAGE_VERSION or \
+           _imageChecksum(image) != (image[-2] << 8) | image[-1]:
+            return False
+        self.invalidateRegisters()
+        if self.readRegister(REG_VERSION) != REQUIRED_VERSION:
+            return False
+        if self.readRegister(REG_OP_MODE) & MODE_LONG_RANGE_MODE and self._imageMatches(image):
+            self.standby()
+        else:
+            # LoRa mode can only be entered from sleep, which may take a second write
+            self.writeRegister(REG_OP_MODE, MODE_SLEEP)
+            self.sleep()
+            pos = 1
+            for address, size in IMAGE_BLOCKS:
+                self._spiControl.write_burst(address | 0x80, memoryview(image)[pos:pos + size])
+                pos += size
+            if not self._imageMatches(image):
+                return False
+            self.standby()
+        pos = 1
+        for address, size in IMAGE_BLOCKS:
+            for i in range(size):
+                self._shadow[address + i] = image[pos + i]
+                self._shadowValid[address + i] = 1
+            pos += size
+        self._shadowValid[REG_FIFO_ADDR_PTR] = 0
+        self._shadowValid[REG_FIFO_RX_BYTE_ADDR] = 0
+        self._imageParameters(image)
+        # an RxDone or TxDone from before the sleep would hold DIO0 high, and the
+        # rising edge receive() waits for would never come
+        self.writeRegister(REG_IRQ_FLAGS, 0xff)
+        return True
+
+    def _imageMatches(self, image):
+        "Read back the frequency and modem blocks, True if they hold image's configuration."
+        buf = bytearray(10)
+        pos = 1
+        for address, size in IMAGE_BLOCKS[:2]:
+            self._spiControl.read_burst(address, buf)
+            for i in range(size):
+                if buf[i] != image[pos + i] and not (address == REG_MODEM_CONFIG_1 and
+                                                     i in _IMAGE_VOLATILE) \
+                        and address + i != REG_FIFO_ADDR_PTR:
+                    return False
+            pos += size
+        return True
+
+    def _imageParameters(self, image):
+        "Bring parameters and the driver's own state in line with image's registers."
+        p = self.parameters
+        rf = memoryview(image)[1:11]
+        modem = memoryview(image)[11:21]
+        frfs = (rf[0] << 16) | (rf[1] << 8) | rf[2]
+        if _frf(p['frequency']) != frfs:
+            p['frequency'] = int(frfs * 61.03515625)
+        self._frequency = p['frequency']
+        pa = rf[REG_PA_CONFIG - REG_FRF_MSB]
+        p['tx_power_level'] = (pa & 0x0f) + 2 if pa & PA_BOOST else pa & 0x0f
+        p['signal_bandwidth'] = BANDWIDTHS[min(modem[0] >> 4, 9)]
+        p['coding_rate'] = ((modem[0] >> 1) & 0x07) + 4
+        p['implicitHeader'] = bool(modem[0] & 0x01)
+        self._implicitHeaderMode = p['implicitHeader']
+        p['spreading_factor'] = modem[1] >> 4
+        p['enable_CRC'] = bool(modem[1] & 0x04)
+        p['preamble_length'] = (modem[3] << 8) | modem[4]
+        p['low_data_rate_optimize'] = bool(modem[9] & 0x08)
+        p['sync_word'] = image[1 + 10 + 10 + REG_SYNC_WORD - REG_DETECTION_OPTIMIZE]
+        split = rf[REG_FIFO_TX_BASE_ADDR - REG_FRF_MSB] == FifoSplitAddr
+        p['split_fifo'] = split
+        self._txBase = FifoSplitAddr if split else FifoTxBaseAddr
+        self._txLimit = self._rxLimit = FifoSplitAddr if split else MAX_PKT_LENGTH
+        self._staged = 0
+        self.profile = None
 
     def dumpRegisters(self):
         for i in range(128):
@@ -293,36 +662,99 @@ class SX127x:
     def implicitHeaderMode(self, implicitHeaderMode=False):
         if self._implicitHeaderMode != implicitHeaderMode:  # set value only if different.
             self._implicitHeaderMode = implicitHeaderMode
-            modem_config_1 = self.readRegister(REG_MODEM_CONFIG_1)
+            modem_config_1 = self._getRegister(REG_MODEM_CONFIG_1)
             config = modem_config_1 | 0x01 if implicitHeaderMode else modem_config_1 & 0xfe
-            self.writeRegister(REG_MODEM_CONFIG_1, config)
+            self._setRegister(REG_MODEM_CONFIG_1, config)
 
     def _prepIrqHandler(self, handlefn):
-        "Attach the handler to the irq pin, disable if None"
+        "Arm handlefn for the next DIO0 edge, disable if None"
         if self.irqPin:
+            self._irqService = handlefn
             if handlefn:
-                self.irqPin.irq(handler=handlefn, trigger=Pin.IRQ_RISING)
+                self.irqPin.irq(handler=self._hardIrqRef, trigger=Pin.IRQ_RISING, hard=True)
             else:
                 self.irqPin.irq(handler=None, trigger=0)
 
+    def _hardIrq(self, pin):
+        "Hard interrupt: timestamp the DIO0 edge, queue it, defer the SPI work. No allocation"
+        head = self._irqHead
+        nxt = (head + 1) % IRQ_QUEUE_SIZE
+        if nxt == self._irqTail:
+            self.irqOverruns += 1
+            return
+        start = ticks_us()
+        self._irqTicks[head] = start
+        self._irqFns[head] = self._irqService
+        self._irqHead = nxt
+        if not self._servicePending:
+            self._servicePending = True
+            try:
+                schedule(self._serviceIrqRef, 0)
+            except RuntimeError:
+                self._servicePending = False    # schedule queue full, next edge retries
+        if self.stats:
+            self.stats.isr(ticks_diff(ticks_us(), start))
+
+    def _serviceIrq(self, arg):
+        "Scheduled handler: run the queued DIO0 events now that SPI may be used"
+        if self._spiControl.busy or self._loading:
+            # interrupted a transfer or a fifo load, come back once it is done
+            try:
+                schedule(self._serviceIrqRef, 0)
+            except RuntimeError:
+                self._servicePending = False
+            return
+        self._servicePending = False
+        while self._irqTail != self._irqHead:
+            tail = self._irqTail
+            handlefn = self._irqFns[tail]
+            self.lastIrqTicks = self._irqTicks[tail]
+            self._irqFns[tail] = None
+            self._irqTail = (tail + 1) % IRQ_QUEUE_SIZE
+            if self.stats:
+                self.stats.latency(ticks_diff(ticks_us(), self.lastIrqTicks))
+            if handlefn:
+                handlefn(self.irqPin)
+
     def onReceive(self, callback):
         "Establish a callback function for receive interrupts"
         self._onReceive = callback
+        self._rawReceive = False
         self._prepIrqHandler(None) # in case we have one and we're receiving. stop.
 
+    def onReceiveRaw(self, callback):
+        '''Establish a receive callback that unloads the FIFO itself.
+           It gets called as callback(sx127x) and should use read_payload_into,
+           so no payload object has to be allocated inside the interrupt'''
+        self._onReceive = callback
+        self._rawReceive = True
+        self._prepIrqHandler(None)
+
     def onTransmit(self, callback):
         "Establish a callback function for transmit interrupts"
         self._onTransmit = callback
 
+    def onCadDone(self, callback):
+        "Establish a callback(detected) for the end of a channel activity detection"
+        self._onCadDone = callback
+
+    def cad(self):
+        '''Listen for a LoRa preamble for a couple of symbols. DIO0 signals CadDone,
+           then the radio is back in standby: receive() or send to carry on'''
+        self.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_STDBY)
+        self._prepIrqHandler(self._handleOnCad)
+        self._setRegister(REG_DIO_MAPPING_1, 0x80)     # DIO0 => CadDone
+        self.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_CAD)
+
     def receive(self, size=0):
         "Enable reception - call this when you want to receive stuff"
         self.implicitHeaderMode(size > 0)
         if size > 0:
-            self.writeRegister(REG_PAYLOAD_LENGTH, size & 0xff)
+            self._setRegister(REG_PAYLOAD_LENGTH, size & 0xff)
         # enable rx to raise DIO0
         if self._onReceive:
             self._prepIrqHandler(self._handleOnReceive)         # attach handler
-            self.writeRegister(REG_DIO_MAPPING_1, 0x00)
+            self._setRegister(REG_DIO_MAPPING_1, 0x00)
         else:
             self._prepIrqHandler(None)                          # no handler
         # The last packet always starts at FIFO_RX_CURRENT_ADDR
@@ -330,19 +762,33 @@ class SX127x:
         self.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_RX_CONTINUOUS)
 
     # got a receive interrupt, handle it
+    # runs scheduled, not in the hard interrupt, so it takes no lock
     def _handleOnReceive(self, event_source):
-        self.acquire_lock(True)           # lock until TX_Done
         irqFlags = self.getIrqFlags()
         irqBad = IRQ_PAYLOAD_CRC_ERROR_MASK | IRQ_RX_TIME_OUT_MASK
         if (irqFlags & IRQ_RX_DONE_MASK) and \
            ((irqFlags & irqBad) == 0) and \
             self._onReceive:
             # it's a receive data ready interrupt
-            payload = self.read_payload()
-            self.acquire_lock(False)     # unlock when done reading
-            self._onReceive(self, payload)
+            if self._rawReceive:
+                self._onReceive(self)
+            else:
+                self._onReceive(self, self.read_payload())
+            # continuous receive stores packets back to back, with split_fifo restart
+            # it so the next one goes to the RX base again instead of the TX half
+            if self._rxLimit != MAX_PKT_LENGTH and \
+               self._shadow[REG_OP_MODE] == MODE_LONG_RANGE_MODE | MODE_RX_CONTINUOUS:
+                self.standby()
+                self.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_RX_CONTINUOUS)
+        elif self.stats:
+            st = self.stats
+            if not irqFlags & IRQ_RX_DONE_MASK:
+                st.spurious_irqs += 1
+            elif (irqFlags & IRQ_PAYLOAD_CRC_ERROR_MASK) != 0:
+                st.crc_errors += 1
+            elif (irqFlags & IRQ_RX_TIME_OUT_MASK) != 0:
+                st.rx_timeouts += 1
         else:
-            self.acquire_lock(False)             # unlock in any case.
             if not irqFlags & IRQ_RX_DONE_MASK:
                 print("not rx done mask")
             elif (irqFlags & IRQ_PAYLOAD_CRC_ERROR_MASK) != 0:
@@ -353,21 +799,32 @@ class SX127x:
                 print("no receive method defined")
 
     def _handleOnTransmit(self, event_source):
-        "Got a transmit interrupt, handle it"
-        self.acquire_lock(True)           # lock until flags cleared
+        "Got a transmit interrupt, handle it (scheduled, like _handleOnReceive)"
         irqFlags = self.getIrqFlags()
         if irqFlags & IRQ_TX_DONE_MASK:
             # it's a transmit finish interrupt
             self._prepIrqHandler(None)     # disable handler since we're done
-            self.acquire_lock(False)             # unlock
             if self._onTransmit:
                 self._onTransmit()
             else:
                 print("transmit callback but no callback method")
+        elif self.stats:
+            self.stats.spurious_irqs += 1
         else:
-            self.acquire_lock(False)             # unlock
             print("transmit callback but not txdone: " + str(irqFlags))
 
+    def _handleOnCad(self, event_source):
+        "Got a CadDone interrupt, report whether activity was detected"
+        irqFlags = self.getIrqFlags()
+        if irqFlags & IRQ_CAD_DONE_MASK:
+            self._prepIrqHandler(None)
+            if self._onCadDone:
+                self._onCadDone(irqFlags & IRQ_CAD_DETECTED_MASK != 0)
+        elif self.stats:
+            self.stats.spurious_irqs += 1
+        else:
+            print("cad callback but not caddone: " + str(irqFlags))
+
     def receivedPacket(self, size=0):
         "When no receive handler, this tells if packet ready. Preps for receive"
         if self._onReceive:
@@ -376,7 +833,7 @@ class SX127x:
         irqFlags = self.getIrqFlags()
         self.implicitHeaderMode(size > 0)
         if size > 0:
-            self.writeRegister(REG_PAYLOAD_LENGTH, size & 0xff)
+            self._setRegister(REG_PAYLOAD_LENGTH, size & 0xff)
         # if (irqFlags & IRQ_RX_DONE_MASK) and \
            # (irqFlags & IRQ_RX_TIME_OUT_MASK == 0) and \
            # (irqFlags & IRQ_PAYLOAD_CRC_ERROR_MASK == 0):
@@ -391,24 +848,105 @@ class SX127x:
         return False
 
     def read_payload(self):
+        payload = bytearray(MAX_PKT_LENGTH)
+        packetLength = self.read_payload_into(payload)
+        self._collect_garbage()
+        return bytes(payload[:packetLength])
+
+    def read_payload_into(self, buf):
+        '''Burst-read the last received packet into buf, return the number of bytes read.
+           A buf longer than the packet costs one memoryview slice, nothing else is allocated'''
+        packetLength = min(self.rxPacketLength(), len(buf))
+        if packetLength:
+            self.readFifoInto(buf if packetLength == len(buf) else memoryview(buf)[:packetLength])
+        return packetLength
+
+    def rxPacketLength(self):
+        '''Point the FIFO at the last received packet and return its length.
+           Follow with readFifoInto() calls to unload it piecewise'''
         # set FIFO address to current RX address
-        # fifo_rx_current_addr = self.readRegister(REG_FIFO_RX_CURRENT_ADDR)
         self.writeRegister(REG_FIFO_ADDR_PTR, self.readRegister(REG_FIFO_RX_CURRENT_ADDR))
-        # read packet length
-        packetLength = self.readRegister(REG_PAYLOAD_LENGTH) if self._implicitHeaderMode else \
-                       self.readRegister(REG_RX_NB_BYTES)
-        payload = bytearray()
-        for i in range(packetLength):
-            payload.append(self.readRegister(REG_FIFO))
-        self._collect_garbage()
-        return bytes(payload)
+        return self.readRegister(REG_PAYLOAD_LENGTH) if self._implicitHeaderMode else \
+               self.readRegister(REG_RX_NB_BYTES)
+
+    def readFifoInto(self, buf):
+        "Burst-read len(buf) bytes from the FIFO pointer onwards, the pointer advances past them"
+        self._spiControl.read_burst(REG_FIFO, buf)
 
     def readRegister(self, address, byteorder='big', signed=False):
-        response = self._spiControl.transfer(address & 0x7f)
-        return int.from_bytes(response, byteorder)
+        "Read a register as an int. Registers are one byte so byteorder is moot."
+        value = self._spiControl.read_register(address)
+        if signed and value & 0x80:
+            value -= 0x100
+        return value
 
     def writeRegister(self, address, value):
-        self._spiControl.transfer(address | 0x80, value)
+        self._shadow[address & 0x7f] = value & 0xff     # keep any shadow copy honest
+        self._spiControl.write_register(address, value)
+
+    def _getRegister(self, address):
+        "Read a configuration register, from the shadow copy when it is known"
+        if self._shadowValid[address]:
+            return self._shadow[address]
+        value = self.readRegister(address)
+        self._shadow[address] = value
+        self._shadowValid[address] = 1
+        return value
+
+    def _setRegister(self, address, value):
+        "Write a configuration register, unless the shadow says it already holds value"
+        value &= 0xff
+        if self._shadowValid[address] and self._shadow[address] == value:
+            return
+        self.writeRegister(address, value)
+        self._shadowValid[address] = 1
+
+    def _writeBlock(self, address, buf):
+        "Burst-write consecutive configuration registers, unless the shadow already matches"
+        shadow = self._shadow
+        valid = self._shadowValid
+        for i in range(len(buf)):
+            if not valid[address + i] or shadow[address + i] != buf[i]:
+                break
+        else:
+            return
+        self._spiControl.write_burst(address | 0x80, buf)
+        for i in range(len(buf)):
+            shadow[address + i] = buf[i]
+            valid[address + i] = 1
+        valid[REG_FIFO_RX_BYTE_ADDR] = 0    # read only, the burst write is ignored
+
+    def invalidateRegisters(self):
+        "Forget the shadow copies, e.g. after the chip was reset behind our back"
+        for i in range(len(self._shadowValid)):
+            self._shadowValid[i] = 0
+
+    def verifyRegisters(self):
+        "Read back every shadowed register. True if the chip still matches the shadow"
+        for address in range(len(self._shadowValid)):
+            if self._shadowValid[address] and \
+               self.readRegister(address) != self._shadow[address]:
+                return False
+        return True
+
+    def resyncRegisters(self, restore=False):
+        """Bring the shadow and the chip back in step.
+           restore=False re-reads the chip into the shadow,
+           restore=True rewrites the shadowed values into the chip (e.g. after a brown-out reset)
+           and leaves it in standby: call receive() or send to carry on"""
+        if restore:
+            # a reset chip is in FSK mode, where these addresses are other registers.
+            # LoRa mode can only be entered from sleep, which may take a second write
+            self.writeRegister(REG_OP_MODE, MODE_SLEEP)
+            self.sleep()
+        for address in range(len(self._shadowValid)):
+            if self._shadowValid[address] and address != REG_OP_MODE:
+                if restore:
+                    self.writeRegister(address, self._shadow[address])
+                else:
+                    self._shadow[address] = self.readRegister(address)
+        if restore:
+            self.standby()
 
     def _collect_garbage(self):
         gc.collect()
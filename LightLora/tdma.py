@@ -0,0 +1,166 @@
+"Slotted uplinks for a star network: nodes follow the gateway's beacons and send only in their slot"
+
+from utime import ticks_us, ticks_add, ticks_diff
+from micropython import const
+from LightLora.lorautil import BROADCAST, HEADER_LENGTH
+
+# a frame is slots + 1 slots of slot_ms: slot 0 is the gateway's (its beacon and any
+# downlinks), nodes send in slots 1..slots. The gateway keeps frames on a fixed grid of
+# its clock and starts each with a beacon:
+#   BEACON_MAGIC, frame number (2 bytes), slots, slot_ms (2 bytes), offset (2 bytes)
+# offset is how late, in 100us units, the beacon went out after its frame started, so a
+# beacon held up behind a downlink does not move the grid. All values big endian
+BEACON_MAGIC = const(0xfa)
+BEACON_LENGTH = const(8)
+TDMA_GUARD_US = const(4000)     # kept free at each end of a slot: timing and polling error
+TDMA_MAX_MISSED = const(8)      # frames a node may go without a beacon and still send
+TDMA_MAX_DRIFT_PPM = const(1000)    # larger clock differences are taken as bad beacons
+DRIFT_SHIFT = const(2)          # each beacon moves the drift estimate 1/4 of the way
+
+def _slotWindow(pos, start, slot_us, airtime_us, guard):
+    '''Microseconds from pos (into the frame) until a frame of airtime_us can start in
+       the slot at start, 0 if it can start now, -1 if the chance in this frame has gone'''
+    first = start + guard
+    # a frame too long for the slot still gets a start window, and overruns it
+    last = max(first + TDMA_GUARD_US, start + slot_us - airtime_us - guard)
+    if pos < first:
+        return first - pos
+    if pos <= last:
+        return 0
+    return -1
+
+class TdmaGateway:
+    '''Sends a beacon at the start of every frame and keeps its own packets in slot 0.
+       slot_ms defaults to the airtime of a max_length byte payload plus guard times.
+       Call service() often: a beacon can be no more on time than the calls are'''
+    def __init__(self, lora_util, address, slots=8, slot_ms=None, max_length=32):
+        self.lu = lora_util
+        self.address = address
+        self.slots = slots
+        if slot_ms is None:
+            slot_ms = (lora_util.lora.timeOnAir(HEADER_LENGTH + max_length) +
+                       2 * TDMA_GUARD_US) // 1000 + 1
+        self.slot_ms = slot_ms
+        self.frame_us = (slots + 1) * slot_ms * 1000
+        self.frame_number = 0
+        self._start = ticks_us()    # start of the current frame
+        self._due = self._start     # next beacon to queue
+        self._beacon = bytearray(BEACON_LENGTH)
+        self.beacons = 0
+        lora_util.tx_gate = self._gate
+
+    def _frame_pos(self, now):
+        "Catch _start up to the frame now is in, return how far into it now is."
+        pos = ticks_diff(now, self._start)
+        while pos >= self.frame_us:
+            self._start = ticks_add(self._start, self.frame_us)
+            self.frame_number = (self.frame_number + 1) & 0xffff
+            pos -= self.frame_us
+        return pos
+
+    def _gate(self, frame, airtime_us):
+        now = ticks_us()
+        pos = self._frame_pos(now)
+        wait = _slotWindow(pos, 0, self.slot_ms * 1000, airtime_us, 0)
+        if wait < 0:
+            wait = self.frame_us - pos
+        if wait:
+            return wait // 1000 + 1
+        if len(frame) == HEADER_LENGTH + BEACON_LENGTH and frame[0] == self.address and \
+                frame[HEADER_LENGTH] == BEACON_MAGIC:
+            # stamp the beacon now, as it goes out
+            number = self.frame_number
+            offset = pos // 100
+            frame[HEADER_LENGTH + 1] = number >> 8
+            frame[HEADER_LENGTH + 2] = number & 0xff
+            frame[HEADER_LENGTH + 6] = offset >> 8
+            frame[HEADER_LENGTH + 7] = offset & 0xff
+        return 0
+
+    def service(self):
+        "Queue the beacon when a frame starts. Call from the main loop, the more often the better."
+        now = ticks_us()
+        if ticks_diff(now, self._due) < 0 or not self.lu.can_send():
+            return
+        self._frame_pos(now)
+        self._due = ticks_add(self._start, self.frame_us)
+        buf = self._beacon
+        buf[0] = BEACON_MAGIC
+        buf[3] = self.slots
+        buf[4] = self.slot_ms >> 8
+        buf[5] = self.slot_ms & 0xff
+        # frame number and offset are filled in by _gate
+        self.lu.send_packet(self.address, BROADCAST, buf)
+        self.beacons += 1
+
+class TdmaNode:
+    '''Holds this node's packets until its slot (1..slots of the gateway's beacons).
+       feed() every received packet so beacons keep it in step; the frame start is
+       worked out from each beacon's rx_ticks_us less its airtime. Clock drift against
+       the gateway is estimated from successive beacons and allowed for when beacons
+       are missed, with guard times that grow the longer it has been. With no beacon
+       for TDMA_MAX_MISSED frames (or none yet) packets wait for the next one'''
+    def __init__(self, lora_util, gateway_address, slot):
+        self.lu = lora_util
+        self.gateway_address = gateway_address
+        self.slot = slot
+        self.synced = False
+        self.slots = 0
+        self.slot_us = 0
+        self.frame_us = 0
+        self.drift_ppm = 0      # how much faster our clock runs than the gateway's
+        self._drift_known = False
+        self._start = 0         # ticks_us() of the latest beacon's frame start
+        self._number = 0        # its frame number
+        self.beacons = 0
+        lora_util.tx_gate = self._gate
+
+    def feed(self, pkt):
+        "Take in a received packet. Returns True if it was the gateway's beacon."
+        msg = pkt.msg
+        if pkt.src_address != self.gateway_address or len(msg) != BEACON_LENGTH or \
+                msg[0] != BEACON_MAGIC:
+            return False
+        number = (msg[1] << 8) | msg[2]
+        self.slots = msg[3]
+        self.slot_us = ((msg[4] << 8) | msg[5]) * 1000
+        self.frame_us = (self.slots + 1) * self.slot_us
+        airtime = self.lu.lora.timeOnAir(HEADER_LENGTH + BEACON_LENGTH)
+        start = ticks_add(pkt.rx_ticks_us, -(airtime + ((msg[6] << 8) | msg[7]) * 100))
+        if self.synced:
+            frames = (number - self._number) & 0xffff
+            if 0 < frames <= TDMA_MAX_MISSED:
+                nominal = frames * self.frame_us
+                ppm = (ticks_diff(start, self._start) - nominal) * 1000000 // nominal
+                if -TDMA_MAX_DRIFT_PPM < ppm < TDMA_MAX_DRIFT_PPM:
+                    if self._drift_known:
+                        self.drift_ppm += (ppm - self.drift_ppm) >> DRIFT_SHIFT
+                    else:
+                        self.drift_ppm = ppm
+                        self._drift_known = True
+        self._start = start
+        self._number = number
+        self.synced = True
+        self.beacons += 1
+        return True
+
+    def _gate(self, frame, airtime_us):
+        if not self.synced or not 0 < self.slot <= self.slots:
+            return 100
+        elapsed = ticks_diff(ticks_us(), self._start)
+        # in gateway time: our clock runs drift_ppm fast
+        gw_elapsed = elapsed - elapsed * self.drift_ppm // 1000000
+        frames = gw_elapsed // self.frame_us
+        if frames >= TDMA_MAX_MISSED:
+            self.synced = False
+            return 100
+        pos = gw_elapsed - frames * self.frame_us
+        # +-20ppm crystals can be 40ppm apart; once measured, allow for what is left
+        guard = TDMA_GUARD_US + elapsed // (200000 if self._drift_known else 25000)
+        start = self.slot * self.slot_us
+        wait = _slotWindow(pos, start, self.slot_us, airtime_us, guard)
+        if wait < 0:
+            wait = self.frame_us - pos + start + guard
+        if not wait:
+            return 0
+        return (wait + wait * self.drift_ppm // 1000000) // 1000 + 1
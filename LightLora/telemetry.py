@@ -0,0 +1,178 @@
+"Compact binary sensor readings: packed keyframes and small deltas against them"
+
+import struct
+from micropython import const
+
+# first byte of every frame: FRAME_DELTA for a delta, and the keyframe's number (6 bits).
+# It stays below 0xc0, so a telemetry frame is never taken for one starting with the
+# subheader magic of fragment, arq, mesh or tdma (0xfa and up), and decode() skips those.
+# A keyframe is the flag byte then every field struct-packed (little endian).
+# A delta is the flag byte, a bitmask of the fields that differ from the keyframe (bit i
+# of byte i // 8 for field i), then a zigzag varint of each of those differences.
+# Deltas are taken against the latest keyframe, not the previous reading, so a lost
+# delta costs only itself; a lost keyframe makes the deltas after it undecodable
+FRAME_DELTA = const(0x80)
+KEY_MASK = const(0x3f)
+
+# value range of each struct code a field can use
+_RANGES = {'b': (-0x80, 0x7f), 'B': (0, 0xff), 'h': (-0x8000, 0x7fff), 'H': (0, 0xffff),
+           'i': (-0x80000000, 0x7fffffff), 'I': (0, 0xffffffff)}
+
+def _zigzag(n):
+    return n << 1 if n >= 0 else (-n << 1) - 1
+
+def _unzigzag(n):
+    return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+def _varintLength(n):
+    size = 1
+    while n > 0x7f:
+        n >>= 7
+        size += 1
+    return size
+
+class Schema:
+    '''The fields of a reading, shared by sender and receiver. fields is a sequence of
+       (name, struct code) or (name, struct code, scale) with an integer code (b B h H i I);
+       a field with a scale carries round(value / scale), e.g. ('temp', 'h', 0.01)
+       sends a temperature in hundredths of a degree in two bytes'''
+    def __init__(self, fields):
+        self.names = tuple(f[0] for f in fields)
+        self.format = '<' + ''.join(f[1] for f in fields)
+        self.scales = tuple(f[2] if len(f) > 2 else None for f in fields)
+        self.ranges = tuple(_RANGES[f[1]] for f in fields)
+        self.size = struct.calcsize(self.format)    # packed fields, without the flag byte
+        self.mask_size = (len(fields) + 7) // 8
+
+    def __len__(self):
+        return len(self.names)
+
+    def quantize(self, values, out):
+        "Turn readings into the integers sent, clamped to each field's range, into out."
+        for i in range(len(out)):
+            v = values[i]
+            scale = self.scales[i]
+            if scale:
+                v = round(v / scale)
+            lo, hi = self.ranges[i]
+            out[i] = min(max(int(v), lo), hi)
+
+    def scale(self, ints, out):
+        "Turn received integers back into readings, into out."
+        for i in range(len(out)):
+            scale = self.scales[i]
+            out[i] = ints[i] * scale if scale else ints[i]
+
+class Encoder:
+    '''Encodes readings for a Schema. Sends a keyframe every keyframe_every readings,
+       and whenever a delta would not be shorter; deltas in between.
+       encode() returns a memoryview into a buffer reused by the next call'''
+    def __init__(self, schema, keyframe_every=16):
+        self.schema = schema
+        self.keyframe_every = keyframe_every
+        n = len(schema)
+        self.max_size = 1 + schema.size
+        self._buf = bytearray(max(self.max_size, 1 + schema.mask_size + 5 * n))
+        self._cur = [0] * n
+        self._key = [0] * n
+        self._key_id = KEY_MASK     # the first keyframe is number 0
+        self._since_key = -1        # readings since the keyframe, -1 before the first
+
+    def keyframe(self):
+        "Make the next encode() a keyframe, e.g. after the receiver restarted."
+        self._since_key = -1
+
+    def encode(self, values):
+        "Encode one reading (a sequence in schema order) and return the frame."
+        schema = self.schema
+        cur = self._cur
+        key = self._key
+        buf = self._buf
+        schema.quantize(values, cur)
+        if 0 <= self._since_key < self.keyframe_every - 1:
+            size = 1 + schema.mask_size
+            for i in range(len(cur)):
+                if cur[i] != key[i]:
+                    size += _varintLength(_zigzag(cur[i] - key[i]))
+            if size < self.max_size:
+                self._since_key += 1
+                return self._delta(size)
+        # keyframe
+        self._key_id = (self._key_id + 1) & KEY_MASK
+        self._since_key = 0
+        buf[0] = self._key_id
+        struct.pack_into(schema.format, buf, 1, *cur)
+        for i in range(len(cur)):
+            key[i] = cur[i]
+        return memoryview(buf)[:self.max_size]
+
+    def _delta(self, size):
+        cur = self._cur
+        key = self._key
+        buf = self._buf
+        buf[0] = FRAME_DELTA | self._key_id
+        mask_size = self.schema.mask_size
+        for j in range(mask_size):
+            buf[1 + j] = 0
+        pos = 1 + mask_size
+        for i in range(len(cur)):
+            if cur[i] != key[i]:
+                buf[1 + (i >> 3)] |= 1 << (i & 7)
+                n = _zigzag(cur[i] - key[i])
+                while n > 0x7f:
+                    buf[pos] = (n & 0x7f) | 0x80
+                    n >>= 7
+                    pos += 1
+                buf[pos] = n
+                pos += 1
+        return memoryview(buf)[:size]
+
+class Decoder:
+    '''Decodes frames from an Encoder with the same Schema.
+       decode() returns the readings as a list reused by the next call, or None for a
+       delta whose keyframe was not received (counted in missed) or a frame that is
+       not telemetry'''
+    def __init__(self, schema):
+        self.schema = schema
+        n = len(schema)
+        self._key = [0] * n
+        self._cur = [0] * n
+        self._out = [0] * n
+        self._key_id = -1
+        self.missed = 0
+
+    def decode(self, frame):
+        schema = self.schema
+        key = self._key
+        cur = self._cur
+        if frame[0] & ~(FRAME_DELTA | KEY_MASK):
+            return None
+        if not frame[0] & FRAME_DELTA:
+            if len(frame) < 1 + schema.size:
+                return None
+            values = struct.unpack_from(schema.format, frame, 1)
+            for i in range(len(key)):
+                key[i] = values[i]
+            self._key_id = frame[0]
+            schema.scale(key, self._out)
+            return self._out
+        if frame[0] & KEY_MASK != self._key_id:
+            self.missed += 1
+            return None
+        pos = 1 + schema.mask_size
+        for i in range(len(cur)):
+            value = key[i]
+            if frame[1 + (i >> 3)] & (1 << (i & 7)):
+                n = 0
+                shift = 0
+                while True:
+                    b = frame[pos]
+                    pos += 1
+                    n |= (b & 0x7f) << shift
+                    shift += 7
+                    if not b & 0x80:
+                        break
+                value += _unzigzag(n)
+            cur[i] = value
+        schema.scale(cur, self._out)
+        return self._out